@@ -1,19 +1,159 @@
 """Core fog retrieval routines
 """
 
+import os
+import logging
+import pathlib
+import threading
+import importlib.util
+import pkg_resources
+
+import yaml
 import satpy
 import satpy.writers
+import pyresample.geometry
+import appdirs
 
 import sattools.ptc
 
+logger = logging.getLogger(__name__)
+
+
+class _ConfigRegistry:
+    """Process-level registry of areas and composite configurations.
+
+    Reading the area definitions and the composite and modifier
+    configurations means parsing the YAML files of several packages.  This
+    registry does so once per process and keeps the results.  They are read
+    again when any YAML file in the configuration directories of the
+    packages involved (or in satpy's ``config_path``) changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._areas = None
+        self._comps_mods = {}
+
+    @staticmethod
+    def _get_config_dirs(pkgs):
+        dirs = [pathlib.Path(p) for p in satpy.config.get("config_path", [])]
+        for pkg in pkgs:
+            try:
+                spec = importlib.util.find_spec(pkg)
+            except ModuleNotFoundError:
+                spec = None
+            if spec is not None and spec.origin is not None:
+                dirs.append(pathlib.Path(spec.origin).parent / "etc")
+        return dirs
+
+    def _get_signature(self, pkgs):
+        """Get signature identifying the state of all configuration files.
+        """
+        sig = []
+        for d in self._get_config_dirs(pkgs):
+            for (dp, _, fns) in os.walk(d):
+                for fn in fns:
+                    if fn.endswith(".yaml"):
+                        p = os.path.join(dp, fn)
+                        sig.append((p, os.stat(p).st_mtime_ns))
+        return tuple(sorted(sig))
+
+    def get_areas(self, pkgs=("satpy", "fcitools", "fogtools")):
+        """Get all areas defined in pkgs.
+
+        Packages that are not installed are skipped.
+
+        Returns:
+            Dict[str, AreaDefinition]
+        """
+        pkgs = tuple(pkgs)
+        sig = self._get_signature(pkgs)
+        with self._lock:
+            if self._areas is not None and self._areas[:2] == (pkgs, sig):
+                return self._areas[2]
+        areas = {}
+        for pkg in pkgs:
+            try:
+                areas.update(sattools.ptc.get_all_areas([pkg]))
+            except ModuleNotFoundError:
+                pass
+        with self._lock:
+            self._areas = (pkgs, sig, areas)
+        return areas
+
+    def add_comps_mods(self, sc, pkgs, sensors):
+        """Add composites and modifiers from pkgs to Scene.
+
+        Equivalent to :func:`sattools.ptc.add_all_pkg_comps_mods`, but the
+        configurations are read only for the first Scene; for later Scenes,
+        the compositors and modifiers collected then are added directly.
+        """
+        key = (tuple(pkgs), tuple(sensors))
+        sig = self._get_signature(pkgs)
+        with self._lock:
+            cached = self._comps_mods.get(key)
+        tree = sc._dependency_tree
+        if cached is not None and cached[0] == sig:
+            tree.update_compositors_and_modifiers(*cached[1:])
+            return
+        sattools.ptc.add_all_pkg_comps_mods(sc, list(pkgs),
+                                            sensors=list(sensors))
+        comps = {s: dict(tree.compositors[s])
+                 for s in sensors if s in tree.compositors}
+        mods = {s: dict(tree.modifiers[s])
+                for s in sensors if s in tree.modifiers}
+        with self._lock:
+            self._comps_mods[key] = (sig, comps, mods)
+
+    def clear(self):
+        with self._lock:
+            self._areas = None
+            self._comps_mods.clear()
+
+
+_config_registry = _ConfigRegistry()
+
+
+def get_resample_cache_dir():
+    """Get directory where resampling lookup tables are stored.
+    """
+    return pathlib.Path(appdirs.user_cache_dir("fogtools")) / "resample"
+
+
+def get_area(area):
+    """Get area definition by name
+
+    Areas are read once per process, see :class:`_ConfigRegistry`.
+
+    Args:
+        area (str): Name of area.  Must be an AreaDefinition defined in satpy
+            (or PPP_CONFIG_DIR), fcitools, or fogtools.
+
+    Returns:
+        AreaDefinition
+    """
+    return _config_registry.get_areas()[area]
+
 
 def get_fog(sensor_reader, sensor_files,
             cloud_reader, cloud_files,
-            area, blend_background):
+            area, blend_background, scene=None):
     """Get daytime fog blend for sensor
 
     Get daytime fog.
 
+    If ``scene`` is given, fog is calculated from this Scene rather than from
+    a new one.  It must have been created with the readers for the sensor and
+    cloud files, such as a Scene shared with other users of the same data.
+    Channels already loaded into it are not loaded again.
+
+    Resampling uses nearest neighbour.  If area is given by name, the
+    neighbour lookup tables are stored in :func:`get_resample_cache_dir`
+    and reused by all later calls for the same source and target areas, in
+    any process.  See :func:`prewarm_resample_cache` to create them in
+    advance.  Ad-hoc AreaDefinitions are resampled without storing lookup
+    tables.
+
     Args:
         sensor_reader (str): For which sensor/reader to derive the fog product.
             Must be a sensor/reader supported by fogpy.  Currently those are
@@ -24,20 +164,38 @@ def get_fog(sensor_reader, sensor_files,
             "nwcsaf-geo" or "cmsaf-claas2_l2_nc".
         cloud_files (List[str]): List of filenames corresponding to cloud
             microphysics data.
-        area (str): Area for which to calculate fog.  Must be an AreaDefinition
-            defined in satpy (or PPP_CONFIG_DIR), fcitools, or fogtools.
+        area (str or AreaDefinition): Area for which to calculate fog.  If a
+            string, must be the name of an AreaDefinition defined in satpy (or
+            PPP_CONFIG_DIR), fcitools, or fogtools, see :func:`get_area`.
         blend_background (str): Satpy composite to be used as the background
             onto which the fog mask will be blended using :func:`blend_fog`.
+        scene (Scene or None): Existing Scene to use.  If given,
+            ``sensor_files`` and ``cloud_files`` are ignored.
 
     Returns:
 
         Scene: Scene object reprojected onto area, containing the composite and
             all its dependencies.
     """
-    sc = satpy.Scene(
-        filenames={sensor_reader: sensor_files,
-                   cloud_reader: cloud_files})
+    if scene is None:
+        sc = satpy.Scene(
+            filenames={sensor_reader: sensor_files,
+                       cloud_reader: cloud_files})
+    else:
+        sc = scene
+    _load_fog_inputs(sc, sensor_reader, cloud_reader)
+    if isinstance(area, pyresample.geometry.AreaDefinition):
+        ls = sc.resample(area, unload=False, resampler="nearest")
+    else:
+        ls = _resample_cached(sc, get_area(area))
+    ls.load(["fls_day", "fls_day_extra"], unload=False)
+
+    return ls
 
+
+def _load_fog_inputs(sc, sensor_reader, cloud_reader):
+    """Load into Scene the inputs fogpy needs before resampling.
+    """
     chans = {"seviri_l1b_hrit": ["IR_108", "IR_087", "IR_016", "VIS006",
                                  "IR_120", "VIS008", "IR_039"],
              "abi_l1b": ["C02", "C03", "C05", "C07", "C11", "C14", "C15"]}
@@ -45,17 +203,55 @@ def get_fog(sensor_reader, sensor_files,
             "cmsaf-claas2_l2_nc": ["reff", "cwp", "cot"]}
 
     sensor = sensor_reader.split("_")[0]
-    sattools.ptc.add_all_pkg_comps_mods(sc, ["satpy", "fogpy"],
-                                        sensors=[sensor])
-    areas = {}
-    for pkg in ["satpy", "fcitools", "fogtools"]:
-        try:
-            areas.update(sattools.ptc.get_all_areas([pkg]))
-        except ModuleNotFoundError:
-            pass
+    _config_registry.add_comps_mods(sc, ["satpy", "fogpy"], [sensor])
     sc.load(chans[sensor_reader] + cmic[cloud_reader] + ["overview"],
             unload=False)
-    ls = sc.resample(areas[area], unload=False)
-    ls.load(["fls_day", "fls_day_extra"], unload=False)
 
-    return ls
+
+def _resample_cached(sc, area):
+    """Resample with nearest neighbour, storing lookup tables on disk.
+    """
+    d = get_resample_cache_dir()
+    d.mkdir(parents=True, exist_ok=True)
+    return sc.resample(area, unload=False, resampler="nearest",
+                       cache_dir=str(d))
+
+
+def prewarm_resample_cache(sensor_reader, sensor_files,
+                           cloud_reader, cloud_files, areas):
+    """Create resampling lookup tables for areas.
+
+    Resample the inputs of :func:`get_fog` to each area, such that the
+    nearest neighbour lookup tables for all source areas found in the files
+    are computed and stored, see :func:`get_resample_cache_dir`.  Lookup
+    tables that exist already are not computed again.  Fog is not
+    calculated.
+
+    Args:
+        sensor_reader (str): Reader for satellite data, see :func:`get_fog`.
+        sensor_files (List[str]): Satellite files for a representative time.
+        cloud_reader (str): Reader for cloud products, see :func:`get_fog`.
+        cloud_files (List[str]): Cloud microphysics files for a
+            representative time.
+        areas (Iterable[str]): Names of areas, see :func:`get_area`.
+    """
+    sc = satpy.Scene(
+        filenames={sensor_reader: sensor_files,
+                   cloud_reader: cloud_files})
+    _load_fog_inputs(sc, sensor_reader, cloud_reader)
+    for area in areas:
+        logger.info(f"Preparing resampling lookup tables for {area:s}")
+        _resample_cached(sc, get_area(area))
+
+
+def get_pkg_area_names():
+    """Get names of areas defined by fogtools.
+
+    Those are the areas in ``etc/areas.yaml`` in the fogtools package.
+
+    Returns:
+        List[str]
+    """
+    with open(pkg_resources.resource_filename(
+            "fogtools", "etc/areas.yaml"), encoding="utf-8") as fp:
+        return list(yaml.safe_load(fp))
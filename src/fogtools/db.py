@@ -8,6 +8,9 @@ and adding unitests, and to support ground data over the USA.
 """
 
 import os
+import sys
+import json
+import hashlib
 import time
 import logging
 import subprocess
@@ -15,20 +18,37 @@ import tempfile
 import pathlib
 import functools
 import collections
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
 import abc
 import pkg_resources
 import fogpy.utils
 
 import numpy
 import pandas
+import dask
+import dask.array
 import satpy
 import satpy.readers
 import satpy.readers.yaml_reader
+import pyresample.geometry
 import yaml
 import yaml.loader
 import appdirs
 
-from . import abi, sky, isd, core, log
+from . import abi, sky, isd, core, log, util
+
+try:
+    import inotify_simple
+except ModuleNotFoundError:
+    inotify_simple = None
+
+try:
+    import eccodes
+except ModuleNotFoundError:
+    eccodes = None
 
 logger = logging.getLogger(__name__)
 
@@ -67,13 +87,18 @@ class FogDB:
       - more model data (IFS, COSMO, ...)
       - more cloud microphysics data (NWCSAF, ABI-L2)
 
-    Data are written out as a parquet file.
+    Data are written out as a parquet file.  Alternately, if an output
+    directory is passed on initialisation, each case is written out as soon
+    as it is complete, as a separate file within a parquet dataset in this
+    directory, along with a manifest listing those files.  In this case, the
+    data are not kept in memory.  The manifest doubles as a checkpoint: it
+    records for each case whether it is done, has failed (and why), or was
+    skipped, such that an interrupted build can be resumed by calling
+    :meth:`extend_many` with the same timestamps again.
     """
 
-    # A lot of this could be done in parallel, perhaps they should all return
-    # awaitables?  Much of the data gathering is I/O bound *or* coming from a
-    # subprocess.  Only the fogpy fog calculation is CPU bound.  Consider using
-    # concurrent.futures:
+    # Much of the data gathering is I/O bound *or* coming from a subprocess.
+    # Only the fogpy fog calculation is CPU bound:
     #
     # - ICON stuff is slow (wait for sky tape)
     # - ABI stuff is slow (download from AWS)
@@ -81,19 +106,37 @@ class FogDB:
     # - loading synop and DEM is probably fast enough
     # - calculating fog is CPU bound and depends on other stuff being there
     #
-    # so the most sense to do synchronously is downloading ABI and ICON.  The
-    # NWCSAF software already monitors for files to appear and runs in the
-    # background "naturally", so the procedure should be to asynchronously
-    # download ICON and ABI data to the right place, then wait for NWCSAF
-    # files to appear.  Where does concurrent.futures come in exactly?
+    # The NWCSAF software already monitors for files to appear and runs in
+    # the background "naturally".  Therefore, when processing many cases,
+    # extend_many downloads ICON and ABI for upcoming cases in background
+    # threads and hands them to NWCSAF, while the current case is processed
+    # in the main thread.
 
     # TODO:
-    #   - use concurrent.futures (but try linear/serial first)
     #   - add other datasets
 
-    sat = nwp = cmic = ground = dem = fog = data = None
+    sat = nwp = cmic = ground = dem = fog = data = out = None
+    _manifest_lock = None
+    # component settings passed on to the workers of extend_parallel
+    _worker_settings = {
+        "sat": ("base",),
+        "nwp": ("base", "crop", "crop_margin", "extract_fields"),
+        "cmic": ("base", "max_staged"),
+        "dem": ("base",),
+        "fog": ("base", "area", "crop_to_stations", "crop_margin",
+                "write_geotiff", "max_pending_writes")}
 
-    def __init__(self):
+    def __init__(self, out=None):
+        """Initialise fog database.
+
+        Args:
+            out (pathlib.Path or str, optional):
+                Directory in which to write the database as a partitioned
+                parquet dataset, one partition per case.  If not given, the
+                database is kept in memory until :meth:`store` is called.
+        """
+        self.out = pathlib.Path(out) if out is not None else None
+        self._manifest_lock = threading.Lock()
         self.sat = _ABI()
         self.nwp = _ICON()
         self.cmic = _NWCSAF(dependencies={"sat": self.sat, "nwp": self.nwp})
@@ -106,7 +149,8 @@ class FogDB:
         getattr(self, k)  # will trigger AttributeError if not found
         super().__setattr__(k, v)
 
-    def extend(self, timestamp, onerror="raise"):
+    def extend(self, timestamp, onerror="raise", synop=None,
+               wait_writes=True):
         """Add data from <timestamp> to database.
 
         This module extends the database, creatig it if it doesn't exist yet,
@@ -118,6 +162,16 @@ class FogDB:
                 Time for which to add data to database
             onerror (str):
                 What to do on error: "raise" or "log"
+            synop (pandas.DataFrame or None):
+                Ground measurements already matched to this case, with at
+                most one measurement per station, such as prepared for many
+                cases at once by :meth:`extend_many`.  If not given, they
+                are loaded and matched here.
+            wait_writes (bool):
+                Wait until the fog GeoTIFF has been written before
+                returning, such that a failure to write it is logged.  If
+                False, the caller must call :meth:`_Fog.wait_for_writes`,
+                as :meth:`extend_many` does once for all cases.
         """
 
         with log.LogToTimeFile(timestamp):
@@ -125,18 +179,30 @@ class FogDB:
                 # first get the ground stations: these determine which points I
                 # want to # extract
                 logger.info(f"Loading data for {timestamp:%Y-%m-%d %H:%M:%S}")
-                synop = self.ground.load(timestamp)
-
-                # for each non-unique lat/lon, choose the time closest to
-                # /timestamp/
-                synop = self._select_closest_latlon(synop, timestamp)
+                if synop is None:
+                    synop = self.ground.load(timestamp)
+                    # for each non-unique lat/lon, choose the time closest to
+                    # /timestamp/
+                    if not synop.empty:
+                        synop = self._select_closest_latlon(synop, timestamp)
+                if synop.empty:
+                    logger.warning("No ground measurements for "
+                                   f"{timestamp:%Y-%m-%d %H:%M:%S}, "
+                                   "skipping")
+                    self._checkpoint(timestamp, "skipped",
+                                     reason="no ground measurements")
+                    return
 
                 lats = synop.index.get_level_values("LATITUDE")
                 lons = synop.index.get_level_values("LONGITUDE")
 
                 # FIXME: use concurrent.futures here
-                # extract will also call .load thus taking care of dependencies
-                satdata = self.sat.extract(timestamp, lats, lons)
+                # extract will also call .load thus taking care of
+                # dependencies; satellite extraction and fog calculation
+                # share one Scene, such that channels are read only once
+                satdata = self.sat.extract(
+                        timestamp, lats, lons,
+                        scene=self.fog.get_scene(timestamp))
                 nwpdata = self.nwp.extract(timestamp, lats, lons)
                 # FIXME: with concurrent.futures, wait for sat and nwp to be
                 # finished
@@ -147,40 +213,352 @@ class FogDB:
                 fogdata = self.fog.extract(timestamp, lats, lons)
                 logger.info("Collected all fogdb components, "
                             "putting it all together")
-                df = _concat_mi_df_with_date(
+                df = _assemble_columns(
                         satdata,
                         synop=synop,
                         nwp=nwpdata,
                         cmic=cmicdata,
                         dem=demdata,
                         fog=fogdata)
-                if self.data is None:
-                    self.data = df
-                else:
-                    self.data = pandas.concat([self.data, df], axis=0)
+                self._append(timestamp, df)
             except (FogDBError, OSError, EOFError):
-                if onerror == "raise":
-                    raise
-                elif onerror == "log":
-                    logger.exception("Failed to extend database with data "
-                                     f"from {timestamp:%Y-%m-%d %H:%M:%S}:")
-                else:
-                    raise ValueError("Unknown error handling option: "
-                                     f"{onerror!s}")
+                self._handle_error(timestamp, onerror)
+            finally:
+                self.fog.release_scene()
+                # inputs staged for NWCSAF when prefetching, in case the
+                # case was skipped or failed before waiting for NWCSAF
+                self.cmic.release(timestamp)
+                if wait_writes:
+                    self.fog.wait_for_writes()
+
+    def extend_many(self, timestamps, onerror="raise", lookahead=2,
+                    retry_failed=False):
+        """Add data from many timestamps to database.
+
+        Like calling :meth:`extend` for each timestamp, but pipelined: while
+        one case is being processed, the inputs for the next ``lookahead``
+        cases (ABI and ICON) are retrieved in background threads and handed
+        to NWCSAF, such that network, NWCSAF, and fogpy can all be busy at
+        the same time.  No more than ``lookahead`` cases are prefetched ahead
+        of the one being processed, which bounds the disk and memory used.
+
+        If the database has an output directory, cases that the manifest
+        records as done or skipped from an earlier run are not processed
+        again, and neither are failed cases unless ``retry_failed`` is True.
+
+        Ground measurements are matched to all cases at once before
+        processing starts, see :meth:`_load_ground_many`.  When prefetching,
+        ICON is likewise retrieved for all cases with a single request
+        before processing starts, see :meth:`_ICON.store_many`.  Since
+        prefetching threads ensure inputs concurrently, each component
+        serialises its :meth:`_DB.ensure`.
+
+        Fog GeoTIFFs still being written in the background are waited for
+        before returning, see :class:`_Fog`.
 
-    def store(self, f):
+        Args:
+            timestamps (Iterable[pandas.Timestamp]):
+                Times for which to add data to database, processed in order.
+            onerror (str):
+                What to do on error: "raise" or "log"
+            lookahead (int):
+                How many cases to prefetch ahead of the one being processed.
+                With 0, this is equivalent to calling :meth:`extend` in a
+                loop.
+            retry_failed (bool):
+                Process again cases that failed in an earlier run.
+        """
+        if lookahead < 0:
+            raise ValueError(f"lookahead must be >= 0, got {lookahead:d}")
+        timestamps = list(self._select_todo(timestamps, retry_failed))
+        try:
+            ground = self._load_ground_many(timestamps)
+        except (FogDBError, OSError, EOFError) as e:
+            logger.warning("Could not match ground measurements for all "
+                           f"cases at once ({e!s}), loading per case")
+            ground = {}
+        if timestamps and lookahead > 0:
+            try:
+                self.nwp.store_many(timestamps)
+            except (sky.SkyFailure, subprocess.CalledProcessError,
+                    OSError) as e:
+                logger.warning("Could not retrieve ICON for all cases at "
+                               f"once ({e!s}), retrieving per case")
+        timestamps = iter(timestamps)
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(lookahead, 1),
+                thread_name_prefix="fogdb-prefetch") as executor:
+            try:
+                while True:
+                    for ts in itertools.islice(
+                            timestamps, lookahead + 1 - len(pending)):
+                        logger.debug("Prefetching inputs for "
+                                     f"{ts:%Y-%m-%d %H:%M}")
+                        pending.append((ts, executor.submit(
+                            self._prefetch, ts)))
+                    if not pending:
+                        break
+                    (ts, fut) = pending.popleft()
+                    try:
+                        fut.result()
+                    except (FogDBError, OSError, EOFError):
+                        self.cmic.release(ts)
+                        self._handle_error(ts, onerror)
+                        continue
+                    self.extend(ts, onerror=onerror,
+                                synop=ground.pop(ts, None),
+                                wait_writes=False)
+            finally:
+                for (ts, fut) in pending:
+                    if not fut.cancel():
+                        fut.add_done_callback(
+                                lambda _, ts=ts: self.cmic.release(ts))
+                self.fog.wait_for_writes()
+
+    def extend_parallel(self, timestamps, workers, onerror="raise",
+                        lookahead=2, retry_failed=False):
+        """Add data from many timestamps to database using many processes.
+
+        Shard the timestamps over ``workers`` worker processes, each of which
+        builds its own database using :meth:`extend_many` and writes its own
+        per-timestamp logfiles.  The results are merged into this database;
+        if it has an output directory, workers write their cases there
+        directly.  The NWCSAF software and the manifest are shared by all
+        workers; access to those is serialised through locks held by a
+        coordinating manager process, which also keeps track of which
+        NWCSAF input links are still in use.  The ground measurements
+        database is read before starting the workers, such that forked
+        workers share it.
+
+        Each worker builds its database with the component settings of
+        this database, such as ``fog.crop_to_stations`` or ``nwp.crop``,
+        as listed in ``_worker_settings``.  A ``nwp.sky_runner`` cannot be
+        shared with worker processes and is not used by them.
+
+        Args:
+            timestamps (Iterable[pandas.Timestamp]):
+                Times for which to add data to database.
+            workers (int):
+                Number of worker processes.
+            onerror (str):
+                What to do on error: "raise" or "log"
+            lookahead (int):
+                How many cases each worker prefetches, see
+                :meth:`extend_many`.
+            retry_failed (bool):
+                Process again cases that failed in an earlier run, see
+                :meth:`extend_many`.
+        """
+        timestamps = list(self._select_todo(timestamps, retry_failed))
+        if self.nwp.sky_runner is not None:
+            logger.warning("SKY runner not shared with worker processes, "
+                           "each worker sends its own requests")
+        settings = {k: {a: getattr(getattr(self, k), a) for a in attrs}
+                    for (k, attrs) in self._worker_settings.items()}
+        loc = isd.get_db_location()
+        if loc.exists():
+            _ground_table.get(loc)
+        shards = [timestamps[i::workers] for i in range(workers)]
+        with multiprocessing.Manager() as manager, \
+                concurrent.futures.ProcessPoolExecutor(
+                        max_workers=workers,
+                        initializer=_init_worker,
+                        initargs=({"nwcsaf": manager.Lock(),
+                                   "nwcsaf_links": manager.dict(),
+                                   "manifest": manager.Lock()},)) as executor:
+            results = list(executor.map(
+                    functools.partial(
+                        _extend_shard, onerror=onerror, lookahead=lookahead,
+                        out=self.out, retry_failed=retry_failed,
+                        settings=settings),
+                    (shard for shard in shards if shard)))
+        frames = [df for df in [self.data] + results if df is not None]
+        if frames:
+            self.data = pandas.concat(frames, axis=0)
+
+    def _select_todo(self, timestamps, retry_failed=False):
+        """Yield those timestamps that still need to be processed.
+
+        Consult the checkpoint manifest and skip any timestamps that are
+        recorded as done or skipped, as well as those recorded as failed
+        unless ``retry_failed`` is True.  Without an output directory, all
+        timestamps are yielded.
+        """
+        if self.out is None:
+            yield from timestamps
+            return
+        with self._manifest_lock:
+            cases = self._read_manifest()["cases"]
+        for ts in timestamps:
+            status = cases.get(f"{ts:%Y-%m-%dT%H:%M:%S}", {}).get("status")
+            if status in {"done", "skipped"} or (
+                    status == "failed" and not retry_failed):
+                logger.info(f"Not processing {ts:%Y-%m-%d %H:%M:%S}, "
+                            f"already {status:s} according to manifest")
+                continue
+            yield ts
+
+    def _prefetch(self, timestamp):
+        """Retrieve inputs for timestamp ahead of processing it.
+
+        Make sure that satellite and NWP data are present and linked for
+        NWCSAF, and that NWCSAF is running, without waiting for its output.
+        If the NWCSAF output is already there, only the satellite data are
+        retrieved, such that the case does not occupy a staging slot.
+        """
+        if self.cmic.find(timestamp, complete=True):
+            self.sat.ensure(timestamp)
+        else:
+            self.cmic.store(timestamp)
+
+    def _handle_error(self, timestamp, onerror):
+        """Handle error while adding timestamp to database.
+
+        Must be called from within an ``except`` block.  Record the failure in
+        the checkpoint manifest, then, depending on ``onerror``, either
+        reraise the exception being handled ("raise") or log it ("log").
+        """
+        self._checkpoint(timestamp, "failed", reason=repr(sys.exc_info()[1]))
+        if onerror == "raise":
+            raise
+        elif onerror == "log":
+            logger.exception("Failed to extend database with data "
+                             f"from {timestamp:%Y-%m-%d %H:%M:%S}:")
+        else:
+            raise ValueError("Unknown error handling option: "
+                             f"{onerror!s}")
+
+    def _append(self, timestamp, df):
+        """Append data for a single case to the database.
+
+        If the database has an output directory, write the case to its own
+        partition and register it in the manifest.  Otherwise, add it to the
+        data kept in memory.
+        """
+        if self.out is None:
+            if self.data is None:
+                self.data = df
+            else:
+                self.data = pandas.concat([self.data, df], axis=0)
+            return
+        self.out.mkdir(parents=True, exist_ok=True)
+        part = self.out / f"fogdb-{timestamp:%Y%m%d-%H%M}.parquet"
+        # write to a hidden file first, such that an interrupted write never
+        # leaves a truncated partition that readers might pick up
+        logger.info(f"Writing case {timestamp:%Y-%m-%d %H:%M} to {part!s}")
+        with util.atomic_write(part) as tmp:
+            df.to_parquet(tmp)
+        self._checkpoint(timestamp, "done", file=part.name, rows=df.shape[0])
+
+    def _checkpoint(self, timestamp, status, **info):
+        """Record status of case in manifest.
+
+        Record in the manifest that the case for timestamp has the status
+        ``status`` ("done", "failed", or "skipped"), along with any
+        additional information passed as keyword arguments.  Does nothing if
+        the database has no output directory.
+        """
+        if self.out is None:
+            return
+        self.out.mkdir(parents=True, exist_ok=True)
+        with self._manifest_lock:
+            manifest = self._read_manifest()
+            manifest["cases"][f"{timestamp:%Y-%m-%dT%H:%M:%S}"] = {
+                    "status": status, **info}
+            manifest["complete"] = False
+            self._write_manifest(manifest)
+
+    def _get_manifest_location(self):
+        return self.out / "_manifest.json"
+
+    def _read_manifest(self):
+        """Read manifest for partitioned database.
+
+        Returns an empty manifest if none has been written yet.
+        """
+        try:
+            with self._get_manifest_location().open("r") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {"cases": {}, "complete": False}
+
+    def _write_manifest(self, manifest):
+        """Write manifest for partitioned database."""
+        with util.atomic_write(self._get_manifest_location()) as tmp, \
+                tmp.open("w") as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+
+    def store(self, f=None):
         """Store database to file.
 
-        Store database to a parquet file.
+        Store database to a parquet file.  If the database has an output
+        directory, all cases have already been written there, and this only
+        marks the manifest as complete.
 
         Args:
-            f (pathlib.Path or str): output file
+            f (pathlib.Path or str): output file.  Must be equal to the
+                output directory, or not given, if the database has one.
         """
+        if self.out is not None:
+            if f is not None and pathlib.Path(f) != self.out:
+                raise ValueError("Partitioned database can only be stored "
+                                 f"in its output directory {self.out!s}, "
+                                 f"not {f!s}")
+            with self._manifest_lock:
+                manifest = self._read_manifest()
+                done = [c for c in manifest["cases"].values()
+                        if c["status"] == "done"]
+                if not done:
+                    raise ValueError("No entries in database!")
+                nrows = sum(c["rows"] for c in done)
+                nfail = sum(c["status"] == "failed"
+                            for c in manifest["cases"].values())
+                logger.info(f"Finalising fog database in {self.out!s} with "
+                            f"{len(done):d} cases and {nrows:d} rows, "
+                            f"{nfail:d} cases failed")
+                manifest["complete"] = True
+                self._write_manifest(manifest)
+            return
         if self.data is None:
             raise ValueError("No entries in database!")
         logger.info(f"Storing fog database to {f!s}")
         self.data.to_parquet(f)
 
+    def _load_ground_many(self, timestamps, tol=pandas.Timedelta("30m"),
+                          direction="nearest"):
+        """Load and match ground measurements for many cases at once.
+
+        For each case, match each station's measurements to the start time
+        of the ABI scan for that case (see :meth:`_ABI.get_scan_time`), in a
+        single as-of join over all cases (see :meth:`_SYNOP.load_matched`).
+
+        Args:
+            timestamps (Sequence[pandas.Timestamp]): cases
+            tol (pandas.Timedelta): maximum time between measurement and
+                scan
+            direction (str): which measurements to consider, see
+                :func:`_match_synop_to_scans`
+
+        Returns:
+            dict mapping each timestamp to a DataFrame with at most one
+            measurement per station, like :meth:`_select_closest_latlon`.
+        """
+        if not timestamps:
+            return {}
+        scan_times = pandas.Series(
+                [self.sat.get_scan_time(ts) for ts in timestamps],
+                index=pandas.DatetimeIndex(timestamps),
+                dtype="datetime64[ns]")
+        matched = self.ground.load_matched(
+                scan_times, tol=tol, direction=direction)
+        logger.debug(f"Matched {matched.shape[0]:d} ground measurements to "
+                     f"{len(timestamps):d} cases")
+        per_case = {ts: df.droplevel("CASE")
+                    for (ts, df) in matched.groupby(level="CASE")}
+        empty = matched.iloc[:0].droplevel("CASE")
+        return {ts: per_case.get(ts, empty) for ts in timestamps}
+
     @staticmethod
     def _select_closest_latlon(synop, timestamp):
         """For repeated lat/lon, select row closest in time to timestamp.
@@ -189,37 +567,297 @@ class FogDB:
         different timestamps, such as may occur when there are multiple synop
         measurements within a certain time tolerance returned by Synop.load,
         return a new dataframe where for each such row the row is selected
-        where the time is closest to timestamp.
+        where the time is closest to timestamp.  This is
+        :func:`_match_synop_to_scans` for a single case.
         """
-        tdiff = abs(synop.index.get_level_values("DATE") - timestamp)
-        ids = synop.assign(delta=tdiff).delta.groupby(
-                level=["LATITUDE", "LONGITUDE"]).idxmin()
+        new = _match_synop_to_scans(
+                synop,
+                pandas.Series([timestamp], index=[timestamp],
+                              dtype="datetime64[ns]")).droplevel("CASE")
         logger.debug(f"Reducing from {synop.shape[0]:d} to "
-                     f"{ids.shape[0]:d} to avoid repeated lat/lons")
-        synop = synop.loc[ids]
-        return synop
+                     f"{new.shape[0]:d} to avoid repeated lat/lons")
+        return new
+
 
+_coordinator_state = {}
 
-def _concat_mi_df_with_date(df1, **dfs):
-    """Concatenate multiple multi-index dataframes setting date.
 
-    Having multiple dataframes with a [DATE, LATITUDE, LONGITUDE] MultiIndex,
-    concatenate them column-wise, but taking the dates from the very first
-    dataframe (lat/lon are still required to match).  The main dataframe
-    dictates the dates for the others and is passed first, the rest are passed
-    as keyword arguments (because we need their names to rename the dates).
+def _init_worker(state):
+    """Initialise worker process for :meth:`FogDB.extend_parallel`.
 
-    If lat and lon don't match, this will fail.
+    Args:
+        state (Mapping[str, object]): Objects shared by all workers: locks
+            serialising access to NWCSAF ("nwcsaf") and to the manifest
+            ("manifest"), and the reference counts of NWCSAF input links
+            ("nwcsaf_links").
     """
-    dfc = pandas.concat(
-            [df1.reset_index("DATE")] +
-            [df.reset_index("DATE").rename(columns={"DATE": f"date_{k:s}"})
-                for (k, df) in dfs.items()],
-            axis=1)
-    return dfc.reset_index(["LATITUDE", "LONGITUDE"]).set_index(
+    _coordinator_state.update(state)
+
+
+def _extend_shard(timestamps, onerror, lookahead, out=None,
+                  retry_failed=False, settings=None):
+    """Build database for a shard of timestamps in a worker process.
+
+    The settings map component names to attributes to set on them, see
+    :meth:`FogDB.extend_parallel`.  Returns the resulting data, or None if
+    no data were collected or if they were written to ``out``.
+    """
+    fogdb = FogDB(out=out)
+    for (k, attrs) in (settings or {}).items():
+        for (a, v) in attrs.items():
+            setattr(getattr(fogdb, k), a, v)
+    if "nwcsaf" in _coordinator_state:
+        fogdb.cmic._tm_lock = _coordinator_state["nwcsaf"]
+    if "nwcsaf_links" in _coordinator_state:
+        fogdb.cmic._link_refs = _coordinator_state["nwcsaf_links"]
+    if "manifest" in _coordinator_state:
+        fogdb._manifest_lock = _coordinator_state["manifest"]
+    fogdb.extend_many(timestamps, onerror=onerror, lookahead=lookahead,
+                      retry_failed=retry_failed)
+    return fogdb.data
+
+
+def _match_synop_to_scans(synop, scan_times, tolerance=None,
+                          direction="nearest"):
+    """Match ground measurements to satellite scan times for many cases.
+
+    For each case and each station, select the measurement closest in time
+    to the start of the satellite scan for that case.  This is done with a
+    single as-of join over all cases and stations.
+
+    Args:
+        synop (pandas.DataFrame):
+            Ground measurements with a [DATE, LATITUDE, LONGITUDE]
+            MultiIndex, covering any number of cases.
+        scan_times (pandas.Series):
+            Scan start time for each case, indexed by the case timestamp.
+        tolerance (pandas.Timedelta or None):
+            Maximum time between measurement and scan.  Stations without a
+            measurement within tolerance are omitted for that case.
+        direction (str):
+            "nearest" to consider all measurements, "backward" to consider
+            only those not after the scan, "forward" to consider only those
+            not before the scan.
+
+    Returns:
+        pandas.DataFrame with a [CASE, DATE, LATITUDE, LONGITUDE] MultiIndex,
+        with at most one measurement per station per case.
+    """
+    reports = synop.reset_index().sort_values("DATE", kind="stable")
+    stations = reports[["LATITUDE", "LONGITUDE"]].drop_duplicates()
+    cases = pandas.DataFrame({"CASE": scan_times.index,
+                              "SCAN": scan_times.values})
+    left = cases.merge(stations, how="cross").sort_values(
+            "SCAN", kind="stable")
+    matched = pandas.merge_asof(
+            left, reports, left_on="SCAN", right_on="DATE",
+            by=["LATITUDE", "LONGITUDE"], tolerance=tolerance,
+            direction=direction)
+    # unmatched rows from the cross join contain NaN, which upcasts integer
+    # columns to float and string columns to object; undo after dropping
+    matched = matched.dropna(subset=["DATE"]).drop(columns="SCAN").astype(
+            reports.dtypes.to_dict())
+    return matched.set_index(
+            ["CASE", "DATE", "LATITUDE", "LONGITUDE"]).sort_index()
+
+
+def _assemble_columns(df1, **dfs):
+    """Assemble dataframes for the same stations column-wise, setting date.
+
+    Having multiple dataframes with a [DATE, LATITUDE, LONGITUDE] MultiIndex
+    and one row per station, with the stations in the same order in each
+    (such as returned by :meth:`_DB.extract` for the same lats and lons),
+    combine them into a single table, taking the dates from the very first
+    dataframe.  The main dataframe dictates the dates for the others and is
+    passed first, the rest are passed as keyword arguments (because we need
+    their names to rename the dates).
+
+    Rows are matched by their position, i.e. the station number, rather
+    than by aligning the floating point coordinates, and the columns are
+    gathered into a single table before setting the index once.
+
+    Raises FogDBError if the stations don't match or if column names are
+    repeated.
+    """
+    lats = df1.index.get_level_values("LATITUDE").to_numpy()
+    lons = df1.index.get_level_values("LONGITUDE").to_numpy()
+    columns = {"DATE": df1.index.get_level_values("DATE").to_numpy(),
+               "LATITUDE": lats,
+               "LONGITUDE": lons}
+    for (k, df) in [(None, df1), *dfs.items()]:
+        if k is not None:
+            if not (numpy.array_equal(
+                        df.index.get_level_values("LATITUDE").to_numpy(),
+                        lats, equal_nan=True) and
+                    numpy.array_equal(
+                        df.index.get_level_values("LONGITUDE").to_numpy(),
+                        lons, equal_nan=True)):
+                raise FogDBError(f"Stations for {k:s} do not match")
+            columns[f"date_{k:s}"] = df.index.get_level_values(
+                    "DATE").to_numpy()
+        for (c, ser) in df.items():
+            if c in columns:
+                raise FogDBError(f"Repeated column: {c!s}")
+            columns[c] = ser.to_numpy()
+    return pandas.DataFrame(columns).set_index(
             ["DATE", "LATITUDE", "LONGITUDE"])
 
 
+class _PixelIndexCache:
+    """Cache for pixel indices of points in areas.
+
+    Projecting the station coordinates onto an area to find the
+    corresponding pixel indices is repeated for every dataset in every
+    scene, but the areas are fixed and the set of stations barely changes
+    between cases.  This class caches the indices (and the masks for
+    stations outside the area) keyed by the area and the set of
+    coordinates.  Results are kept in memory and stored on disk, such that
+    they are reused between datasets, components, and builds.
+
+    Only areas of type :class:`pyresample.geometry.AreaDefinition` are
+    cached, for others the indices are always calculated.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._cache = collections.OrderedDict()
+
+    @staticmethod
+    def get_cache_dir():
+        return (pathlib.Path(appdirs.user_cache_dir("fogtools")) / "fogdb" /
+                "pixidx")
+
+    @staticmethod
+    def _get_key(area, lons, lats):
+        """Get key uniquely identifying area and coordinates.
+
+        Unlike ``hash(area)``, this is stable between processes.
+        """
+        h = hashlib.sha256()
+        h.update(area.crs.to_wkt().encode("utf-8"))
+        h.update(repr((area.shape, area.area_extent)).encode("ascii"))
+        h.update(numpy.ascontiguousarray(lons, dtype="f8").tobytes())
+        h.update(numpy.ascontiguousarray(lats, dtype="f8").tobytes())
+        return h.hexdigest()
+
+    def get_xy_from_lonlat(self, area, lons, lats):
+        """Get pixel indices for coordinates, using cache if possible.
+
+        Returns the same as
+        :meth:`pyresample.geometry.AreaDefinition.get_xy_from_lonlat`, but
+        looks up the results in the cache first.
+
+        Args:
+            area (AreaDefinition): area in which to find the pixels
+            lons (numpy.ndarray): longitudes
+            lats (numpy.ndarray): latitudes
+
+        Returns:
+            (x, y), both numpy.ma.MaskedArray
+        """
+        if not isinstance(area, pyresample.geometry.AreaDefinition):
+            return area.get_xy_from_lonlat(lons, lats)
+        key = self._get_key(area, lons, lats)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        f = self.get_cache_dir() / f"{key:s}.npz"
+        try:
+            with numpy.load(f) as npz:
+                xy = (numpy.ma.masked_array(npz["x"], npz["xmask"]),
+                      numpy.ma.masked_array(npz["y"], npz["ymask"]))
+        except (OSError, KeyError, ValueError):
+            xy = area.get_xy_from_lonlat(lons, lats)
+            self._store(f, xy)
+        self._cache[key] = xy
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return xy
+
+    @staticmethod
+    def _store(f, xy):
+        """Store pixel indices to disk."""
+        (x, y) = xy
+        f.parent.mkdir(parents=True, exist_ok=True)
+        with util.atomic_write(f) as tmp, tmp.open("wb") as fp:
+            numpy.savez(
+                    fp,
+                    x=numpy.ma.getdata(x), xmask=numpy.ma.getmaskarray(x),
+                    y=numpy.ma.getdata(y), ymask=numpy.ma.getmaskarray(y))
+
+
+_pixel_index_cache = _PixelIndexCache()
+
+
+class _GroundTable:
+    """Process-wide cache of the ground measurements database.
+
+    Reading and sorting the full ISD selection is expensive, but it only
+    changes when the database is recreated.  This class keeps the sorted
+    table in memory, keyed by its location and modification time, such that
+    it is read once per process rather than once per :class:`FogDB`.  The
+    times are kept as a contiguous array, such that the measurements for a
+    time window are found with a binary search rather than by slicing the
+    index.
+
+    When the table is loaded before starting worker processes, forked
+    workers share it without reading it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._key = None
+        self._db = None
+        self._dates = None
+
+    def get(self, f):
+        """Get sorted ground measurements database.
+
+        Args:
+            f (pathlib.Path): location of the database
+
+        Returns:
+            (pandas.DataFrame, numpy.ndarray), the database sorted by date,
+            latitude, and longitude, and the corresponding dates
+        """
+        key = (str(f), f.stat().st_mtime_ns)
+        with self._lock:
+            if self._key != key:
+                logger.debug("Reading ground measurements database from "
+                             "locally stored selection of ISD")
+                db = isd.read_db(f)
+                if db.index.names != ["DATE", "LATITUDE", "LONGITUDE"]:
+                    db = db.set_index(["DATE", "LATITUDE", "LONGITUDE"])
+                db = db.sort_index()
+                self._dates = numpy.ascontiguousarray(
+                        db.index.get_level_values("DATE").values)
+                self._db = db
+                self._key = key
+            return (self._db, self._dates)
+
+    def select(self, f, start, end):
+        """Select ground measurements between start and end, inclusive.
+
+        Args:
+            f (pathlib.Path): location of the database
+            start (pandas.Timestamp): start of window
+            end (pandas.Timestamp): end of window
+
+        Returns:
+            pandas.DataFrame with measurements
+        """
+        (db, dates) = self.get(f)
+        i0 = dates.searchsorted(numpy.datetime64(start), side="left")
+        i1 = dates.searchsorted(numpy.datetime64(end), side="right")
+        return db.iloc[i0:i1]
+
+
+_ground_table = _GroundTable()
+
+
 class _DB(abc.ABC):
     """Get/cache/store/... DB content for quantity.
 
@@ -253,6 +891,8 @@ class _DB(abc.ABC):
         self.dependencies = dependencies if dependencies else {}
         self.base = pathlib.Path(appdirs.user_cache_dir("fogtools")) / "fogdb"
         self._data = {}
+        # prefetching threads may ensure the same data simultaneously
+        self._ensure_lock = threading.RLock()
 
     @abc.abstractmethod
     def find(self, timestamp, complete=False):
@@ -270,17 +910,19 @@ class _DB(abc.ABC):
 
     def ensure(self, timestamp):
         logger.debug(f"Ensuring {self!s} is available")
-        if not self.find(timestamp, complete=True):
-            logger.debug("Input data unavailable or incomplete for "
-                         f"{self!s} for {timestamp:%Y-%m-%d %H:%M}, "
-                         "downloading / generating")
-            self.store(timestamp)
-        if not self.find(timestamp, complete=True):
-            raise FogDBError("I tried to download or generate data for "
-                             f"{self!s} covering {timestamp:%Y-%m-%d %H:%M}, "
-                             "but it's still not there.  Something may have "
-                             "gone wrong trying to download or generate the "
-                             "data.")
+        with self._ensure_lock:
+            if not self.find(timestamp, complete=True):
+                logger.debug("Input data unavailable or incomplete for "
+                             f"{self!s} for {timestamp:%Y-%m-%d %H:%M}, "
+                             "downloading / generating")
+                self.store(timestamp)
+            if not self.find(timestamp, complete=True):
+                raise FogDBError(
+                        "I tried to download or generate data for "
+                        f"{self!s} covering {timestamp:%Y-%m-%d %H:%M}, "
+                        "but it's still not there.  Something may have "
+                        "gone wrong trying to download or generate the "
+                        "data.")
 
     def ensure_deps(self, timestamp):
         for (k, dep) in self.dependencies.items():
@@ -317,7 +959,7 @@ class _DB(abc.ABC):
         """
         pass
 
-    def extract(self, timestamp, lats, lons):
+    def extract(self, timestamp, lats, lons, scene=None):
         """Extract data points
 
         Given a time and a series of lats and lons, extract data points from
@@ -327,20 +969,25 @@ class _DB(abc.ABC):
         self.load differently then it must also override extract.
 
         Note: this will compute any dask arrays from which points are to be
-        extracted (such as in the scene from ABI_.load).
+        extracted (such as in the scene from ABI_.load).  Only the pixels
+        corresponding to the requested points are computed, and all datasets
+        are computed together, such that only the chunks containing the
+        points are read and any shared dependencies are evaluated once.
 
         Args:
             timestamp (pandas.Timestamp): time for which to extract
             lats (array_like): latitudes for which to extract
             lons (array_like): longitudes for which to extract
+            scene (Scene or None): extract from all datasets in this Scene
+                instead of from ``self.load(timestamp)``
 
         Returns:
             pandas.DataFrame with the desired data
         """
-        sc = self.load(timestamp)
+        sc = self.load(timestamp) if scene is None else scene
         logger.debug(f"Extracting data for {self!s} "
                      f"{timestamp:%Y-%m-%d %H:%M}")
-        vals = {}
+        extracted = []
         # pyproj 2.6 does not support other arrays than ndarrays, this may
         # change with https://github.com/pyproj4/pyproj/issues/573 such that I
         # can pass any array_like; but with pyproj 2.6, passing a
@@ -364,18 +1011,19 @@ class _DB(abc.ABC):
                 continue
             for d in set(da.dims) - {"x", "y"}:
                 da = da.squeeze(d)
-            (x, y) = da.attrs["area"].get_xy_from_lonlat(
+            (x, y) = _pixel_index_cache.get_xy_from_lonlat(
+                    da.attrs["area"],
                     numpy.array(lons),
                     numpy.array(lats))
             # x, y may contain masked values --- index where unmasked, and get
             # nan where masked
-            try:
-                src = da.data.compute()
-            except AttributeError:
-                src = da.data
-            extr = src[
-                numpy.where(x.mask, 0, y),
-                numpy.where(y.mask, 0, x)]
+            idx = (numpy.where(x.mask, 0, y), numpy.where(y.mask, 0, x))
+            if isinstance(da.data, dask.array.Array):
+                # point-wise indexing, lazily selecting only those chunks that
+                # contain any points
+                extr = da.data.vindex[idx]
+            else:
+                extr = da.data[idx]
             ths_sttime = da.attrs["start_time"] or pandas.Timestamp("NaT")
             if st_time is None:
                 st_time = ths_sttime
@@ -387,8 +1035,15 @@ class _DB(abc.ABC):
                                f"{st_time:%Y-%m-%d %H:%M:%S.%f}, "
                                f"got {ths_sttime:%Y-%m-%d %H:%M:%S.%f}")
                 ths_sttime = st_time
-            vals[da.attrs["name"]] = pandas.Series(
-                    numpy.where(x.mask | y.mask, numpy.nan, extr),
+            extracted.append((da.attrs["name"], extr, x.mask | y.mask,
+                              ths_sttime))
+        # compute all in a single pass, so that shared parts of the graph are
+        # evaluated only once
+        computed = dask.compute(*(extr for (_, extr, _, _) in extracted))
+        vals = {}
+        for ((nm, _, mask, ths_sttime), extr) in zip(extracted, computed):
+            vals[nm] = pandas.Series(
+                    numpy.where(mask, numpy.nan, extr),
                     index=pandas.MultiIndex.from_arrays(
                         [pandas.Series(ths_sttime).repeat(
                             lats.size),
@@ -539,6 +1194,19 @@ class _ABI(_Sat):
             return found
         raise RuntimeError("This code is unreachable")  # pragma: no cover
 
+    def get_scan_time(self, timestamp):
+        """Get start time of scan for timestamp.
+
+        Taken from the filename of the locally stored ABI file covering
+        timestamp for the first channel used by fogpy.  If there is no such
+        file (yet), return timestamp itself.
+        """
+        files = self._chan_ts_exists(
+                timestamp, min(abi.fogpy_abi_channels))
+        if not files:
+            return timestamp
+        return abi.get_time_from_fn(files.pop().name)
+
     def store(self, timestamp):
         """Store ABI for timestamp
 
@@ -579,10 +1247,29 @@ class _ABI(_Sat):
         sc = satpy.Scene(
                 filenames={str(x) for x in selection},
                 reader="abi_l1b")
-        sc.load([f"C{ch:>02d}" for ch in
-                 abi.nwcsaf_abi_channels | abi.fogpy_abi_channels])
+        sc.load(self._get_channels())
         return sc
 
+    def extract(self, timestamp, lats, lons, scene=None):
+        """Extract ABI at stations.
+
+        If ``scene`` is given, it must have an ``abi_l1b`` reader for the files
+        covering timestamp, such as the Scene shared between components by
+        :meth:`_Fog.get_scene`.  The ABI channels are then loaded into that
+        Scene, such that they are read and calibrated only once for both
+        extraction and fog calculation.  Only the ABI channels are extracted.
+        """
+        if scene is not None:
+            chans = self._get_channels()
+            scene.load(chans, unload=False)
+            scene = scene.copy(datasets=chans)
+        return super().extract(timestamp, lats, lons, scene=scene)
+
+    @staticmethod
+    def _get_channels():
+        return [f"C{ch:>02d}" for ch in
+                abi.nwcsaf_abi_channels | abi.fogpy_abi_channels]
+
 
 class _NWP(_DB):
     pass
@@ -591,36 +1278,36 @@ class _NWP(_DB):
 class _ICON(_NWP):
     reader = "grib"
     name = "ICON"
+    # optionally crop retrieved files to (lon0, lat0, lon1, lat1)
+    crop = None
+    crop_margin = 1.0
+    # optionally send requests through a shared sky.SkyRunner
+    sky_runner = None
+    # GRIB shortNames to extract, or None for all
+    extract_fields = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._present = set()
+        self._weights = collections.OrderedDict()
 
     def find(self, timestamp, complete=False):
         """Get best ICON path for timestamp.
 
         Given a timestamp, get the most suitable ICON path to read.  That's
         either the analysis file (if nearest hour correspond to one) or a
-        forecast for up to five hours.
-        """
-
-        rb = sky.RequestBuilder(self.base)
-        timestamp = timestamp.round("H")  # get forecast for nearest whole hour
-        # get six-hour forecast period corresponding to timestamp, up to next
-        # analysis
-        period = sky.timestamp2period(timestamp)
-        rb.get_request_ba(sky.period2daterange(period))
-        # all expected output files according to the sky query builder
-        exp = rb.expected_output_files
-        fn = sky.make_icon_nwcsaf_filename(
-                self.base,
-                period.start_time,
-                timestamp.hour - period.start_time.hour)
-        if fn not in exp:
-            raise RuntimeError("Impossible")  # pragma: no cover
-            # "I would expect filename {fn!s}, but I'm told "
-            # "to expect only {','.join([str(f) for f in exp])!s}")
-        if complete and not fn.exists():
-            return set()
-        else:
-            # I don't care about the logfiles "ihits" and "info"
-            return {fn}
+        forecast for up to five hours, see :func:`sky.icon_analysis_step`.
+        Files once found to exist are remembered, such that repeated calls
+        don't touch the filesystem.
+        """
+
+        fn = sky.get_icon_nwcsaf_filename(self.base, timestamp)
+        if complete and fn not in self._present:
+            if not fn.exists():
+                return set()
+            self._present.add(fn)
+        # I don't care about the logfiles "ihits" and "info"
+        return {fn}
 
     def store(self, timestamp):
         """Get model analysis and forecast for input to NWCSAF
@@ -630,8 +1317,381 @@ class _ICON(_NWP):
         """
 
         logger.info(f"Retrieving ICON from SKY for {timestamp:%Y-%m-%d %H:%M}")
-        period = sky.timestamp2period(timestamp)
-        sky.get_and_send(self.base, period)
+        sky.get_and_send_many(self.base, [timestamp], crop=self.crop,
+                              margin=self.crop_margin,
+                              runner=self.sky_runner)
+
+    def store_many(self, timestamps):
+        """Get model analysis and forecast for many timestamps at once
+
+        Retrieve all ICON files missing for any of the timestamps with a
+        single request to SKY, see :func:`sky.get_and_send_many`.
+        """
+
+        timestamps = list(timestamps)
+        logger.info(f"Retrieving ICON from SKY for {len(timestamps):d} "
+                    "cases")
+        return sky.get_and_send_many(self.base, timestamps, crop=self.crop,
+                                     margin=self.crop_margin,
+                                     runner=self.sky_runner)
+
+    def extract(self, timestamp, lats, lons):
+        """Extract ICON at stations.
+
+        Read the GRIB messages for the fields listed in ``extract_fields``
+        (or all fields) directly with eccodes and interpolate them
+        bilinearly to the stations, using weights that are cached for each
+        grid and set of stations.  Each field is interpolated as soon as it
+        is decoded, such that only one global field is held in memory at a
+        time.  Fields on pressure levels get one column per level,
+        named ``{shortName}_{level}``, such that each row contains the
+        vertical profile at a station.  The date is the validity time.
+
+        Without eccodes, falls back to :meth:`_DB.extract`.
+        """
+        if eccodes is None:
+            return super().extract(timestamp, lats, lons)
+        self.ensure(timestamp)
+        (f,) = self.find(timestamp, complete=True)
+        logger.debug(f"Extracting data for {self!s} "
+                     f"{timestamp:%Y-%m-%d %H:%M}")
+        lats = numpy.asarray(lats, dtype="f8")
+        lons = numpy.asarray(lons, dtype="f8")
+        (names, profiles, valid) = _read_grib_fields(
+                f, lambda grid: self._get_weights(grid, lats, lons),
+                self.extract_fields)
+        return pandas.DataFrame(
+                profiles.T,
+                columns=names,
+                index=pandas.MultiIndex.from_arrays(
+                    [pandas.DatetimeIndex([valid]*lats.size),
+                     lats, lons],
+                    names=["DATE", "LATITUDE", "LONGITUDE"]))
+
+    def _get_weights(self, grid, lats, lons):
+        """Get cached bilinear interpolation weights, see
+        :func:`_get_bilinear_weights`.
+        """
+        h = hashlib.sha256()
+        h.update(lats.tobytes())
+        h.update(lons.tobytes())
+        key = (grid, h.hexdigest())
+        if key in self._weights:
+            self._weights.move_to_end(key)
+        else:
+            self._weights[key] = _get_bilinear_weights(grid, lats, lons)
+            if len(self._weights) > 16:
+                self._weights.popitem(last=False)
+        return self._weights[key]
+
+
+def _read_grib_fields(f, get_weights, short_names=None):
+    """Read fields from GRIB file and interpolate them to points.
+
+    Read all messages in a GRIB file on a regular lat/lon grid with a
+    shortName in short_names (or all, if None).  Only those messages are
+    decoded.  Fields on pressure levels are named ``{shortName}_{level}``,
+    other fields are named by their shortName.  When a name occurs more than
+    once, only the first message is read.
+
+    The interpolation weights are obtained once, by calling get_weights
+    with the grid of the first message (see :func:`_get_grib_grid`), which
+    must return ``(idx, weights)`` as :func:`_get_bilinear_weights` does.
+    Each field is interpolated directly after decoding and then discarded.
+
+    Returns:
+        (names, values, valid), where names is a list of field names,
+        values an array (fields, points), and valid the validity time.
+    """
+    grid = None
+    valid = pandas.NaT
+    names = []
+    values = []
+    with open(f, "rb") as fp:
+        while (h := eccodes.codes_grib_new_from_file(fp)) is not None:
+            try:
+                sn = eccodes.codes_get(h, "shortName")
+                if short_names is not None and sn not in short_names:
+                    continue
+                if eccodes.codes_get(h, "typeOfLevel").startswith(
+                        "isobaric"):
+                    sn = f"{sn:s}_{eccodes.codes_get(h, 'level'):d}"
+                if sn in names:
+                    continue
+                this_grid = _get_grib_grid(h)
+                if grid is None:
+                    grid = this_grid
+                    (idx, weights) = get_weights(grid)
+                    valid = pandas.to_datetime(
+                        f"{eccodes.codes_get(h, 'validityDate'):08d}"
+                        f"{eccodes.codes_get(h, 'validityTime'):04d}",
+                        format="%Y%m%d%H%M")
+                elif this_grid != grid:
+                    raise FogDBError(f"Different grids in {f!s}")
+                names.append(sn)
+                # (gridpoints,) → (points, 4) → (points,)
+                values.append(
+                    (eccodes.codes_get_values(h)[idx] * weights).sum(
+                        axis=-1))
+            finally:
+                eccodes.codes_release(h)
+    if grid is None:
+        raise FogDBError(f"No fields to extract in {f!s}")
+    return (names, numpy.stack(values), valid)
+
+
+def _get_grib_grid(h):
+    """Get grid for GRIB message.
+
+    Returns a tuple (lat0, lon0, dlat, dlon, nlat, nlon) with the
+    coordinates of the first gridpoint, the signed increments, and the
+    number of gridpoints, in the order in which values are stored.
+    """
+    if (eccodes.codes_get(h, "gridType") != "regular_ll"
+            or eccodes.codes_get(h, "iScansNegatively")
+            or eccodes.codes_get(h, "jPointsAreConsecutive")):
+        raise FogDBError("Can only extract from regular lat/lon grids "
+                         "scanning eastward and along rows")
+    dj = eccodes.codes_get(h, "jDirectionIncrementInDegrees")
+    if not eccodes.codes_get(h, "jScansPositively"):
+        dj = -dj
+    return (eccodes.codes_get(h, "latitudeOfFirstGridPointInDegrees"),
+            eccodes.codes_get(h, "longitudeOfFirstGridPointInDegrees"),
+            dj,
+            eccodes.codes_get(h, "iDirectionIncrementInDegrees"),
+            eccodes.codes_get(h, "Nj"),
+            eccodes.codes_get(h, "Ni"))
+
+
+def _get_bilinear_weights(grid, lats, lons):
+    """Get weights for bilinear interpolation from grid to points.
+
+    Args:
+        grid (tuple): grid as returned by :func:`_get_grib_grid`
+        lats (numpy.ndarray): latitudes of points
+        lons (numpy.ndarray): longitudes of points
+
+    Returns:
+        (idx, weights), both arrays (points, 4), with the indices of the
+        four surrounding gridpoints in the flattened grid and their
+        weights.  Weights are NaN for points outside the grid.
+    """
+    (lat0, lon0, dlat, dlon, nlat, nlon) = grid
+    fj = (lats - lat0) / dlat
+    fi = ((lons - lon0) % 360) / dlon
+    periodic = numpy.isclose(nlon * dlon, 360)
+    valid = (fj >= 0) & (fj <= nlat-1)
+    if not periodic:
+        valid &= (fi <= nlon-1)
+    # points on the last row or column use the cell before
+    j0 = numpy.clip(numpy.floor(fj), 0, nlat-2).astype("i8")
+    i0 = numpy.floor(fi).astype("i8")
+    if not periodic:
+        i0 = numpy.clip(i0, 0, nlon-2)
+    wj = fj - j0
+    wi = fi - i0
+    j1 = j0 + 1
+    i1 = (i0 + 1) % nlon
+    idx = numpy.stack([j0*nlon + i0, j0*nlon + i1,
+                       j1*nlon + i0, j1*nlon + i1], axis=-1)
+    weights = numpy.stack([(1-wj)*(1-wi), (1-wj)*wi,
+                           wj*(1-wi), wj*wi], axis=-1)
+    idx[~valid] = 0
+    weights[~valid] = numpy.nan
+    return (idx, weights)
+
+
+class _NWCSAFWatcher:
+    """Watch for NWCSAF output for many timestamps.
+
+    A single background thread watches the NWCSAF CMIC output and logfile
+    directories, and resolves a future for each timestamp that is waited
+    for as soon as the corresponding output appears, or when the logfile
+    reports an error.  If the ``inotify_simple`` package is available, the
+    thread wakes up as soon as files in either directory change, otherwise
+    it polls every ``interval`` seconds.  In either case, the filename of
+    each file is parsed only once.  The thread stops when no timestamps are
+    waited for anymore.
+
+    Output files are only considered complete once NWCSAF has finished
+    writing them.  With inotify, that is when the file is closed after
+    writing or moved into place.  Files that cannot be tracked this way,
+    because polling is used or because they appeared while the thread was
+    not running, are considered complete once their size has not changed
+    for ``interval`` seconds.
+    """
+
+    cmic_pattern = ("S_NWC_CMIC_{platform_name:s}_{region:s}_"
+                    "{start_time:%Y%m%dT%H%M%S}Z.nc")
+    log_pattern = ("S_NWC_LOG_{platform_name:s}_{region:s}_"
+                   "{start_time:%Y%m%dT%H%M%S}Z.log")
+
+    def __init__(self, base, interval=10):
+        self.base = base
+        self.interval = interval
+        self._dirs = {"cmic": base / "export" / "CMIC",
+                      "log": base / "export" / "LOG"}
+        self._patterns = {"cmic": self.cmic_pattern,
+                          "log": self.log_pattern}
+        self._files = {"cmic": {}, "log": {}}
+        # CMIC files known to be fully written, and for others whose
+        # completeness is judged by their size, the last size and since when
+        self._complete = set()
+        self._sizes = {}
+        self._wds = {}
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, timestamp, timeout=600):
+        """Get a future for the NWCSAF output covering timestamp.
+
+        The future resolves to the set of CMIC files covering timestamp,
+        or raises FogDBError if NWCSAF reported an error or if there is no
+        output after timeout seconds.
+        """
+        fut = concurrent.futures.Future()
+        with self._lock:
+            self._waiters.append(
+                    (timestamp, fut, time.monotonic() + timeout, timeout))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                        target=self._run, name="nwcsaf-watcher", daemon=True)
+                self._thread.start()
+        return fut
+
+    def _run(self):
+        notifier = self._get_notifier()
+        # files appearing while not watching may be incomplete
+        for p in self._files["cmic"].keys() - self._complete:
+            self._sizes.setdefault(p, (None, None))
+        events = None
+        try:
+            while True:
+                self._scan(events)
+                with self._lock:
+                    self._resolve()
+                    if not self._waiters:
+                        self._thread = None
+                        return
+                if notifier is None:
+                    time.sleep(self.interval)
+                else:
+                    events = notifier.read(timeout=int(self.interval*1000))
+        except Exception as e:
+            with self._lock:
+                for (_, fut, _, _) in self._waiters:
+                    fut.set_exception(e)
+                self._waiters.clear()
+                self._thread = None
+        finally:
+            if notifier is not None:
+                notifier.close()
+
+    def _get_notifier(self):
+        """Get inotify instance watching output directories, if possible.
+        """
+        if inotify_simple is None:
+            logger.debug("inotify_simple not available, polling NWCSAF "
+                         f"output every {self.interval!s} s")
+            return None
+        notifier = inotify_simple.INotify()
+        flags = (inotify_simple.flags.CREATE | inotify_simple.flags.MODIFY |
+                 inotify_simple.flags.CLOSE_WRITE |
+                 inotify_simple.flags.MOVED_TO)
+        self._wds = {}
+        for (k, d) in self._dirs.items():
+            d.mkdir(parents=True, exist_ok=True)
+            self._wds[notifier.add_watch(d, flags)] = k
+        return notifier
+
+    def _scan(self, events=None):
+        """Parse the names of new files in the output directories.
+
+        Mark CMIC files as complete when events (from inotify) report that
+        writing them finished.  If events is None, either because inotify
+        is not used or because this is the first scan, new CMIC files are
+        checked for completeness by their size instead, see
+        :meth:`_check_sizes`, until an event for them arrives.
+        """
+        done = 0
+        if inotify_simple is not None:
+            done = (inotify_simple.flags.CLOSE_WRITE |
+                    inotify_simple.flags.MOVED_TO)
+        for ev in events or ():
+            if self._wds.get(ev.wd) != "cmic":
+                continue
+            # any event means inotify tracks the file from now on
+            p = self._dirs["cmic"] / ev.name
+            self._sizes.pop(p, None)
+            if ev.mask & done:
+                self._complete.add(p)
+        for (k, d) in self._dirs.items():
+            try:
+                names = os.listdir(d)
+            except FileNotFoundError:
+                continue
+            known = self._files[k]
+            new = [d / nm for nm in names if d / nm not in known]
+            known.update(dict.fromkeys(new))
+            if k == "cmic" and events is None:
+                for p in new:
+                    if p not in self._complete:
+                        self._sizes.setdefault(p, (None, None))
+            for (nm, info) in satpy.readers.yaml_reader.FileYAMLReader.\
+                    filename_items_for_filetype(
+                        new, {"file_patterns": [self._patterns[k]]}):
+                known[nm] = info["start_time"]
+        self._check_sizes()
+
+    def _check_sizes(self):
+        """Mark CMIC files complete if their size stopped changing.
+        """
+        now = time.monotonic()
+        for (p, (size, since)) in list(self._sizes.items()):
+            try:
+                cur = p.stat().st_size
+            except FileNotFoundError:
+                del self._sizes[p]
+                continue
+            if cur != size:
+                self._sizes[p] = (cur, now)
+            elif now - since >= self.interval:
+                self._complete.add(p)
+                del self._sizes[p]
+
+    def _find(self, k, timestamp):
+        before = timestamp - pandas.Timedelta(15, "minutes")
+        return {p for (p, st) in self._files[k].items()
+                if st is not None and before <= st <= timestamp
+                and (k != "cmic" or p in self._complete)}
+
+    def _resolve(self):
+        """Resolve futures for which output or errors are available.
+        """
+        now = time.monotonic()
+        waiting = []
+        for (timestamp, fut, deadline, timeout) in self._waiters:
+            if fut.cancelled():
+                continue
+            if (found := self._find("cmic", timestamp)):
+                fut.set_result(found)
+                continue
+            for logfile in self._find("log", timestamp):
+                with open(logfile, "r") as fp:
+                    if "Error opening" in fp.read():
+                        fut.set_exception(FogDBError(
+                            "NWCSAF apparently had an error opening or "
+                            "reading satellite input files.  Please check "
+                            f"{logfile!s} for details."))
+                        break
+            else:
+                if now > deadline:
+                    fut.set_exception(FogDBError(
+                        f"No SAFNWC result after {timeout!s} s"))
+                else:
+                    waiting.append((timestamp, fut, deadline, timeout))
+        self._waiters[:] = waiting
 
 
 class _CMIC(_DB):
@@ -648,9 +1708,16 @@ class _NWCSAF(_CMIC):
 
     Expects that the SAFNWC environment variable is set for correct
     functioning.  See NWCSAF software documentation.
+
+    Inputs are symlinked into the NWCSAF import directories when a case is
+    staged and removed again when it is released, which happens as soon as
+    its output is there (see :meth:`release`).  At most ``max_staged`` cases
+    are staged at the same time; staging more waits until another case is
+    released.
     """
     reader = "nwcsaf-geo"
     name = "NWCSAF-GEO"
+    max_staged = 16
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -658,6 +1725,14 @@ class _NWCSAF(_CMIC):
         if not base:
             raise FogDBError("Environment variable SAFNWC not set")
         self.base = pathlib.Path(base)
+        # prefetching threads may try to start the software simultaneously,
+        # and share input links
+        self._tm_lock = threading.Lock()
+        self._watcher = None
+        # links per staged case, and number of staged cases using each link
+        self._staged = {}
+        self._staging = threading.Condition()
+        self._link_refs = {}
 
     def find(self, timestamp, complete=False):
         before = timestamp - pandas.Timedelta(15, "minutes")
@@ -719,12 +1794,62 @@ class _NWCSAF(_CMIC):
         # changes and # start processing automatically when satellite files
         # are added.
 
+        self._stage(timestamp)
+        try:
+            self._start_if_needed()
+        except BaseException:
+            self.release(timestamp)
+            raise
+
+    def _stage(self, timestamp):
+        """Put dependencies for timestamp where NWCSAF expects them.
+
+        Waits until fewer than ``max_staged`` cases are staged.
+        """
         if timestamp > pandas.Timestamp("2019-04-23"):
             raise FogDBError("ABI-NWCSAF newer than 2019-04-23 not "
                              "supported, see fogtools#19")
-        self.ensure_deps(timestamp)
-        if not self.is_running():
-            self.start_running()
+        with self._staging:
+            while (self.max_staged is not None
+                   and timestamp not in self._staged
+                   and len(self._staged) >= self.max_staged):
+                logger.debug(f"{len(self._staged):d} cases staged for "
+                             "NWCSAF, waiting for one to finish")
+                self._staging.wait()
+            self._staged.setdefault(timestamp, set())
+        try:
+            self.ensure_deps(timestamp)
+        except BaseException:
+            self.release(timestamp)
+            raise
+
+    def release(self, timestamp):
+        """Remove NWCSAF input links for timestamp.
+
+        Remove the links staged for timestamp, except those still used by
+        other staged cases, making room to stage another case.
+        """
+        with self._staging:
+            links = self._staged.pop(timestamp, set())
+            with self._tm_lock:
+                for src in links:
+                    n = self._link_refs.get(str(src), 1) - 1
+                    if n > 0:
+                        self._link_refs[str(src)] = n
+                        continue
+                    self._link_refs.pop(str(src), None)
+                    try:
+                        src.unlink()
+                    except FileNotFoundError:
+                        pass
+            self._staging.notify_all()
+        logger.debug(f"Released {len(links):d} NWCSAF input links for "
+                     f"{timestamp:%Y-%m-%d %H:%M}")
+
+    def _start_if_needed(self):
+        with self._tm_lock:
+            if not self.is_running():
+                self.start_running()
 
     @staticmethod
     def is_running():
@@ -788,18 +1913,42 @@ class _NWCSAF(_CMIC):
         """Link NWCSAF dependency.
 
         Data generated for a dependency is probably not where NWCSAF wants it.
-        Add symlinks so that NWCSAF can find it.
+        Add symlinks so that NWCSAF can find it.  The links are recorded as
+        belonging to timestamp, such that :meth:`release` can remove them
+        again.  A link that already exists and points to the right file is
+        shared with the cases already using it.
         """
         logger.debug("Linking NWCSAF dependenices")
         link_dsts = dep.find(timestamp, complete=True)
         link_src_dir = self._get_dep_loc(dep)
         link_src_dir.mkdir(exist_ok=True, parents=True)
-        for p in link_dsts:
-            src = (link_src_dir / p.name)
-            try:
-                src.symlink_to(p)
-            except FileExistsError:
-                logger.warning(f"Src already exists: {src!s}")
+        with self._staging, self._tm_lock:
+            staged = self._staged.setdefault(timestamp, set())
+            for p in link_dsts:
+                src = (link_src_dir / p.name)
+                try:
+                    src.symlink_to(p)
+                except FileExistsError:
+                    if not (src.is_symlink() and
+                            os.readlink(src) == os.fspath(p)):
+                        logger.warning(f"Src already exists: {src!s}")
+                        continue
+                if src not in staged:
+                    staged.add(src)
+                    self._link_refs[str(src)] = self._link_refs.get(
+                            str(src), 0) + 1
+
+    def watch_output(self, timestamp, timeout=600):
+        """Get future for SAFNWC output.
+
+        Returns a :class:`concurrent.futures.Future` that resolves to the
+        set of CMIC files for timestamp as soon as they appear.  Any number
+        of timestamps may be watched at the same time, see
+        :class:`_NWCSAFWatcher`.
+        """
+        if self._watcher is None or self._watcher.base != self.base:
+            self._watcher = _NWCSAFWatcher(self.base)
+        return self._watcher.watch(timestamp, timeout)
 
     def wait_for_output(self, timestamp, timeout=600):
         """Wait for SAFNWC outputs.
@@ -808,37 +1957,84 @@ class _NWCSAF(_CMIC):
         """
         if not self.is_running():
             raise FogDBError("SAFNWC is not running")
-        t = 0
         logger.info("Waiting for SAFNWC results in "
                     f"{self.base / 'export' / 'CMIC'!s}")
-        while t < timeout:
-            if self.find(timestamp, complete=True):
-                return
-            try:
-                logfile = self.find_log(timestamp)
-            except FileNotFoundError:
-                pass  # no logfile yet
-            else:
-                with open(logfile, "r") as fp:
-                    text = fp.read()
-                    if "Error opening" in text:
-                        raise FogDBError("NWCSAF apparently had an error "
-                                         "opening or reading satellite input "
-                                         f"files.  Please check {logfile!s} "
-                                         "for details.")
-            time.sleep(10)
-            t += 10
-        else:
-            raise FogDBError(f"No SAFNWC result after {timeout:d} s")
+        return self.watch_output(timestamp, timeout).result()
 
     def ensure(self, timestamp):
         """Ensure that NWCSAF output for timestamp exists.
 
         Generate NWCSAF output (using self.store) and wait for results.
-        To generate without waiting, call self.store.
+        To generate without waiting, call self.store.  The inputs are
+        released once the output is there or waiting fails, including
+        inputs staged earlier by self.store for output that has since
+        appeared.
         """
+        if self.find(timestamp, complete=True):
+            self.release(timestamp)
+            return
         self.store(timestamp)
-        self.wait_for_output(timestamp)
+        try:
+            self.wait_for_output(timestamp)
+        finally:
+            self.release(timestamp)
+
+    def ensure_many(self, timestamps, timeout=600):
+        """Ensure that NWCSAF output for many timestamps exists.
+
+        Put the dependencies for all timestamps in place, starting the
+        SAFNWC software as soon as the first case is ready, such that it
+        works through the cases back to back while the others are still
+        being prepared.  The inputs for each case are released as soon as
+        its output is there, such that no more than ``max_staged`` cases
+        are staged at any time.  Cases for which output already exists are
+        not staged again.  Yields pairs of timestamp and
+        :class:`concurrent.futures.Future` in the order in which the results
+        become available.  The future resolves to the set of CMIC files for
+        the timestamp, or raises the exception that occurred while preparing
+        or processing this case.
+
+        Args:
+            timestamps (Iterable[pandas.Timestamp]): Times for which to
+                ensure NWCSAF output.
+            timeout (float): Seconds to allow for processing each case.
+                Since SAFNWC processes cases one by one, the n-th case to
+                be processed is given n times this.
+        """
+        futures = {}
+        running = False
+        i = 0
+        for timestamp in timestamps:
+            if (found := self.find(timestamp, complete=True)):
+                fut = concurrent.futures.Future()
+                fut.set_result({pathlib.Path(p) for p in found})
+                futures[fut] = timestamp
+                continue
+            i += 1
+            try:
+                self._stage(timestamp)
+                if not running:
+                    self._start_if_needed()
+                    running = True
+            except (FogDBError, OSError, EOFError) as e:
+                logger.error("Could not prepare NWCSAF inputs for "
+                             f"{timestamp:%Y-%m-%d %H:%M}: {e!s}")
+                fut = concurrent.futures.Future()
+                fut.set_exception(e)
+            else:
+                fut = self.watch_output(timestamp, timeout*i)
+                fut.add_done_callback(functools.partial(
+                    self._release_done, timestamp))
+            futures[fut] = timestamp
+        logger.info(f"Waiting for SAFNWC results for {len(futures):d} cases "
+                    f"in {self.base / 'export' / 'CMIC'!s}")
+        for fut in concurrent.futures.as_completed(futures):
+            # the callback may not have run yet
+            self.release(futures[fut])
+            yield (futures[fut], fut)
+
+    def _release_done(self, timestamp, fut):
+        self.release(timestamp)
 
 
 class _Ground(_DB):
@@ -862,13 +2058,13 @@ class _SYNOP(_Ground):
         else:
             return {loc}
 
-    _db = None
-
     def load(self, timestamp, tol=pandas.Timedelta("30m")):
         """Get ground based measurements from Integrated Surface Dataset.
 
         Return ground based measurements from the Integrated Surface Dataset
-        (ISD) for timestamp within tolerance.
+        (ISD) for timestamp within tolerance.  The database is read only
+        once per process and shared between all instances, see
+        :class:`_GroundTable`.
 
         Args:
             timestamp (pandas.Timestamp): Time for which to locate
@@ -881,14 +2077,34 @@ class _SYNOP(_Ground):
             pandas.Dataframe with measurements
         """
         self.ensure(timestamp)
-        if self._db is None:
-            logger.debug("Reading ground measurements database from locally "
-                         "stored selection of ISD")
-            db = isd.read_db()
-            if db.index.names != ["DATE", "LATITUDE", "LONGITUDE"]:
-                db = db.set_index(["DATE", "LATITUDE", "LONGITUDE"])
-            self._db = db.sort_index()
-        return self._db.loc[timestamp-tol:timestamp+tol]
+        return _ground_table.select(
+                isd.get_db_location(), timestamp-tol, timestamp+tol)
+
+    def load_matched(self, scan_times, tol=pandas.Timedelta("30m"),
+                     direction="nearest"):
+        """Get ground based measurements matched to many scan times.
+
+        Select for each case the measurement from each station closest to
+        the scan start time for that case, see :func:`_match_synop_to_scans`.
+
+        Args:
+            scan_times (pandas.Series): Scan start time for each case,
+                indexed by the case timestamp.
+            tol (Optional[pandas.Timedelta]): Tolerance, measurements how long
+                before or after the scan time to consider a match.
+                Defaults to 30m.
+            direction (Optional[str]): "nearest", "backward", or "forward".
+
+        Returns:
+            pandas.DataFrame with a [CASE, DATE, LATITUDE, LONGITUDE]
+            MultiIndex
+        """
+        self.ensure(scan_times.index.min())
+        synop = _ground_table.select(
+                isd.get_db_location(),
+                scan_times.min()-tol, scan_times.max()+tol)
+        return _match_synop_to_scans(
+                synop, scan_times, tolerance=tol, direction=direction)
 
     def store(self, _):
         """Create ISD database locally.  See isd module.
@@ -904,6 +2120,7 @@ class _DEM(_DB):
 
     _regions = {"new-england": "abi", "europe": "seviri"}
     location = None
+    _points = None
 
     def __init__(self, region):
         """Initialise DEM class.
@@ -914,6 +2131,7 @@ class _DEM(_DB):
             region (str): Either "new-england" or "europe"
         """
 
+        super().__init__()
         D = yaml.load(
                 open(
                     pkg_resources.resource_filename(
@@ -953,16 +2171,100 @@ class _DEM(_DB):
         del sc["image"]
         return sc
 
+    def _get_points_location(self):
+        return self.base / f"dem-{self.region:s}-points.parquet"
+
+    def _get_points(self):
+        """Get cached DEM values for stations.
+
+        Returns a DataFrame indexed by latitude and longitude with the DEM
+        values for all stations extracted so far, reading it from disk if
+        needed.  Values stored on disk are discarded if the DEM has been
+        changed since.
+        """
+        if self._points is None:
+            f = self._get_points_location()
+            try:
+                if f.stat().st_mtime < self.location.stat().st_mtime:
+                    logger.debug("DEM changed since caching station values, "
+                                 "discarding cache")
+                    raise FileNotFoundError(f)
+                self._points = pandas.read_parquet(f)
+            except OSError:
+                self._points = pandas.DataFrame(
+                        index=pandas.MultiIndex.from_arrays(
+                            [[], []], names=["LATITUDE", "LONGITUDE"]))
+        return self._points
+
+    def extract(self, timestamp, lats, lons):
+        """Extract DEM values for stations.
+
+        The DEM is static, so it is loaded only for stations for which no
+        values have been extracted before.  Values for all stations are cached
+        in memory and on disk.  See :meth:`_DB.extract` for the arguments and
+        return value.
+        """
+        points = self._get_points()
+        req = pandas.MultiIndex.from_arrays(
+                [numpy.asarray(lats), numpy.asarray(lons)],
+                names=["LATITUDE", "LONGITUDE"])
+        missing = req.unique().difference(points.index)
+        if len(missing) > 0:
+            logger.debug(f"Extracting DEM for {len(missing):d} new stations")
+            new = super().extract(
+                    timestamp,
+                    missing.get_level_values("LATITUDE"),
+                    missing.get_level_values("LONGITUDE"))
+            points = pandas.concat(
+                    [points, new.reset_index("DATE", drop=True)], axis=0)
+            f = self._get_points_location()
+            f.parent.mkdir(parents=True, exist_ok=True)
+            with util.atomic_write(f) as tmp:
+                points.to_parquet(tmp)
+            self._points = points
+        df = points.reindex(req)
+        # the DEM has no time
+        return df.set_index(
+                pandas.DatetimeIndex(
+                    [pandas.NaT]*df.shape[0], name="DATE"),
+                append=True).reorder_levels(
+                        ["DATE", "LATITUDE", "LONGITUDE"])
+
 
 class _Fog(_DB):
     """Gather fog outputs.
 
     Run fogpy to collect fog products.
     So far implemented for ABI / NWCSAF-GEO.
+
+    Fog is extracted directly from the fogpy result in memory.  If
+    ``write_geotiff`` is True, the result is also written to a tiled,
+    compressed GeoTIFF in a background thread.  GeoTIFFs from earlier runs
+    are used instead of calculating fog again.
+
+    If ``crop_to_stations`` is True, fog is calculated for stations only in
+    the part of ``area`` covering them plus ``crop_margin`` metres on each
+    side, see :func:`_crop_area_to_points`.  The margin should be at least
+    as large as the neighbourhood used by the fogpy spatial filters to get
+    the same results as for the full area.  Such partial results are not
+    written to GeoTIFF.
     """
 
     reader = "generic_image"  # stored as geotiff
     name = "Fogpy"
+    area = "new-england-500"
+    crop_to_stations = False
+    crop_margin = 25000
+    write_geotiff = True
+    # bound on GeoTIFFs waiting to be written, each holding a fogpy result
+    max_pending_writes = 2
+    # (timestamp, Scene) for the case being processed, see get_scene
+    _scene = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writes = collections.OrderedDict()
+        self._writer = None
 
     def find(self, timestamp, complete=False, sensorreader="nwcsaf-geo"):
         b = self.base / f"fog-{timestamp:%Y%m%d-%H%M}.tif"
@@ -971,16 +2273,122 @@ class _Fog(_DB):
         else:
             return {b}
 
+    def get_scene(self, timestamp):
+        """Get Scene with all inputs for timestamp.
+
+        Get a Scene with readers for both ABI and NWCSAF, making sure that
+        both are available first.  The Scene is kept until
+        :meth:`release_scene` is called or a Scene for another timestamp is
+        requested, such that the satellite extraction and the fog calculation
+        for a case can share it.  Datasets are read and calibrated once, when
+        first loaded into the Scene.
+
+        Args:
+            timestamp (pandas.Timestamp): Time for which to get Scene
+
+        Returns:
+            satpy.Scene
+        """
+        if self._scene is not None and self._scene[0] == timestamp:
+            return self._scene[1]
+        self.release_scene()
+        (sat, cmic) = (self.dependencies["sat"], self.dependencies["cmic"])
+        cmic.ensure(timestamp)
+        sat.ensure(timestamp)
+        logger.debug("Creating shared Scene for "
+                     f"{timestamp:%Y-%m-%d %H:%M}")
+        sc = satpy.Scene(
+                filenames={
+                    sat.reader: {str(x) for x in
+                                 sat.find(timestamp, complete=True)},
+                    cmic.reader: {str(x) for x in
+                                  cmic.find(timestamp, complete=True)}})
+        self._scene = (timestamp, sc)
+        return sc
+
+    def release_scene(self):
+        """Forget the Scene kept by :meth:`get_scene`.
+        """
+        self._scene = None
+
     def store(self, timestamp):
+        self._save(timestamp, self._calc(timestamp))
+
+    def _calc(self, timestamp, area=None):
         logger.info("Calculating fog")
-        sc = core.get_fog(
+        return core.get_fog(
                 "abi_l1b",
-                self.dependencies["sat"].find(timestamp),
+                None,
                 "nwcsaf-geo",
-                self.dependencies["cmic"].find(timestamp),
-                "new-england-500",
-                "overview")
-        sc.save_dataset("fls_day", str(self.find(timestamp).pop()))
+                None,
+                self.area if area is None else area,
+                "overview",
+                scene=self.get_scene(timestamp))
+
+    def _save(self, timestamp, sc):
+        """Write fog to GeoTIFF.
+
+        Write tiled and DEFLATE-compressed, with internal overviews, to a
+        temporary file that is renamed when complete, such that :meth:`find`
+        never sees a partial file.
+        """
+        f = self.find(timestamp).pop()
+        logger.debug(f"Writing fog to {f!s}")
+        with util.atomic_write(f, suffix=f.suffix) as tmp:
+            sc.save_dataset("fls_day", str(tmp), writer="geotiff",
+                            tiled=True, blockxsize=256, blockysize=256,
+                            compress="DEFLATE", overviews=[])
+
+    def _save_async(self, timestamp, sc):
+        """Write fog to GeoTIFF in a background thread, see :meth:`_save`.
+        """
+        while len(self._writes) >= self.max_pending_writes:
+            self._wait_write(*self._writes.popitem(last=False))
+        if self._writer is None:
+            self._writer = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="fogdb-geotiff")
+        self._writes[timestamp] = self._writer.submit(
+                self._save, timestamp, sc)
+
+    @staticmethod
+    def _wait_write(timestamp, fut):
+        try:
+            fut.result()
+        except Exception:
+            logger.exception("Failed to write fog GeoTIFF for "
+                             f"{timestamp:%Y-%m-%d %H:%M}")
+
+    def wait_for_writes(self):
+        """Wait until all GeoTIFFs being written in the background are done.
+
+        Failures are logged; fog was already extracted from memory.
+        """
+        while self._writes:
+            self._wait_write(*self._writes.popitem(last=False))
+
+    def extract(self, timestamp, lats, lons):
+        """Extract fog at stations.
+
+        If a GeoTIFF for timestamp exists, extract from that.  Otherwise,
+        calculate fog and extract from the result in memory, optionally
+        writing it to GeoTIFF in the background.  See :meth:`_DB.extract`
+        for the arguments and return value.
+        """
+        if self.find(timestamp, complete=True):
+            return super().extract(timestamp, lats, lons)
+        if self.crop_to_stations:
+            area = _crop_area_to_points(
+                    core.get_area(self.area), lats, lons, self.crop_margin)
+            logger.debug(f"Calculating fog for {area.width:d}x"
+                         f"{area.height:d} pixels around stations")
+            ls = self._calc(timestamp, area)
+        else:
+            ls = self._calc(timestamp)
+            if self.write_geotiff:
+                self._save_async(timestamp, ls)
+        sc = satpy.Scene()
+        sc["fog"] = ls["fls_day"].copy(deep=False)
+        return super().extract(timestamp, lats, lons, scene=sc)
 
     def load(self, timestamp):
         sc = super().load(timestamp)
@@ -989,4 +2397,29 @@ class _Fog(_DB):
         return sc
 
 
+def _crop_area_to_points(area, lats, lons, margin):
+    """Crop area to the rectangle covering points plus a margin.
+
+    Args:
+        area (AreaDefinition): area to crop
+        lats (array_like): latitudes of points
+        lons (array_like): longitudes of points
+        margin (float): margin to add on each side in area units (usually
+            metres)
+
+    Returns:
+        AreaDefinition on the same grid as area, covering all points in area
+    """
+    (x, y) = _pixel_index_cache.get_xy_from_lonlat(
+            area, numpy.asarray(lons), numpy.asarray(lats))
+    valid = ~(numpy.ma.getmaskarray(x) | numpy.ma.getmaskarray(y))
+    if not valid.any():
+        raise FogDBError(f"No stations within area {area.area_id!s}")
+    (x, y) = (numpy.ma.getdata(x)[valid], numpy.ma.getdata(y)[valid])
+    mx = int(numpy.ceil(margin / area.pixel_size_x))
+    my = int(numpy.ceil(margin / area.pixel_size_y))
+    return area[max(y.min()-my, 0):min(y.max()+my+1, area.height),
+                max(x.min()-mx, 0):min(x.max()+mx+1, area.width)]
+
+
 # TODO: _IFS, _COSMO, _METAR, _SWIS, _SEVIRI
@@ -20,7 +20,9 @@ def get_parser():
     parser.add_argument(
             "out",
             action="store", type=pathlib.Path,
-            help="Where to store fog database.")
+            help="Directory where to store fog database.  Each case is "
+                 "written to this directory as soon as it is complete, as "
+                 "a partition of a parquet dataset.")
 
     parser.add_argument(
             "--date", action="store", type=pandas.Timestamp,
@@ -37,6 +39,25 @@ def get_parser():
             help="Max. vis to consider fog (when searching with top-n)",
             default=1000)
 
+    parser.add_argument(
+            "--lookahead", action="store", type=int,
+            help="When processing multiple cases (with top-n), how many "
+                 "cases to prefetch input data for while processing the "
+                 "current one.",
+            default=2)
+
+    parser.add_argument(
+            "--workers", action="store", type=int,
+            help="When processing multiple cases (with top-n), how many "
+                 "worker processes to distribute the cases over.",
+            default=1)
+
+    parser.add_argument(
+            "--retry-failed", action="store_true",
+            help="Retry cases that failed in an earlier run writing to the "
+                 "same output directory.  Cases that succeeded earlier are "
+                 "never processed again.")
+
     return parser
 
 
@@ -47,11 +68,17 @@ def parse_cmdline():
 def main():
     p = parse_cmdline()
     log.setup_main_handler()
-    fogdb = db.FogDB()
+    fogdb = db.FogDB(out=p.out)
     if p.top_n is not None:
         top = isd.top_n("H", "D", 1000, 70, p.top_n)
-        for dt in top.index:
-            fogdb.extend(dt, onerror="log")
+        if p.workers > 1:
+            fogdb.extend_parallel(top.index, p.workers, onerror="log",
+                                  lookahead=p.lookahead,
+                                  retry_failed=p.retry_failed)
+        else:
+            fogdb.extend_many(top.index, onerror="log",
+                              lookahead=p.lookahead,
+                              retry_failed=p.retry_failed)
     else:
         fogdb.extend(p.date)
     fogdb.store(p.out)
@@ -16,21 +16,41 @@ def get_parser():
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument(
-            "date", action="store", type=pandas.Period,
-            help="Date to download, ISO 8601 format")
+            "dates", action="store", type=pandas.Period, nargs="+",
+            help="Dates to download, ISO 8601 format")
+
+    parser.add_argument(
+            "--crop", action="store", type=float, nargs=4,
+            metavar=("LON0", "LAT0", "LON1", "LAT1"),
+            help="Crop downloaded files to this region (requires eccodes)")
+
+    parser.add_argument(
+            "--margin", action="store", type=float, default=1.0,
+            help="Margin in degrees to add around region when cropping")
+
+    parser.add_argument(
+            "--jobs", action="store", type=int, default=2,
+            help="Maximum number of requests to sky at the same time")
+
+    parser.add_argument(
+            "--timeout", action="store", type=float, default=None,
+            help="Time in seconds after which a request to sky is killed")
 
     return parser
 
 
-def getnwp(dt):
-    sky.verify_period(dt)
+def getnwp(dts, crop=None, margin=1.0, jobs=2, timeout=None):
+    for dt in dts:
+        sky.verify_period(dt)
     safnwc = os.getenv("SAFNWC")
     if not safnwc:
         sys.exit("Environment variable SAFNWC not set, exiting")
-    sky.get_and_send(safnwc, dt)
+    sky.get_and_send_periods(safnwc, dts, crop=crop, margin=margin,
+                             max_concurrent=jobs, timeout=timeout)
 
 
 def main():
     p = get_parser().parse_args()
     log.setup_main_handler()
-    getnwp(p.date)
+    getnwp(p.dates, crop=p.crop, margin=p.margin, jobs=p.jobs,
+           timeout=p.timeout)
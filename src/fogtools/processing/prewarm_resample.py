@@ -0,0 +1,53 @@
+"""Prepare resampling lookup tables for fog calculation
+
+Resample the inputs for fogpy from representative files to each area, such
+that later fog calculations for the same sector can reuse the stored
+nearest neighbour lookup tables.
+"""
+
+import argparse
+
+from .. import core
+from sattools import log
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+            "--sensor-files", action="store", type=str, nargs="+",
+            required=True,
+            help="Satellite files for a representative time")
+
+    parser.add_argument(
+            "--cloud-files", action="store", type=str, nargs="+",
+            required=True,
+            help="Cloud microphysics files for the same time")
+
+    parser.add_argument(
+            "--sensor-reader", action="store", type=str,
+            default="abi_l1b",
+            help="Satpy reader for satellite files")
+
+    parser.add_argument(
+            "--cloud-reader", action="store", type=str,
+            default="nwcsaf-geo",
+            help="Satpy reader for cloud microphysics files")
+
+    parser.add_argument(
+            "--areas", action="store", type=str, nargs="+",
+            help="Areas for which to prepare lookup tables.  Defaults to "
+                 "all areas defined by fogtools.")
+
+    return parser
+
+
+def main():
+    p = get_parser().parse_args()
+    log.setup_main_handler()
+    core.prewarm_resample_cache(
+            p.sensor_reader, p.sensor_files,
+            p.cloud_reader, p.cloud_files,
+            p.areas or core.get_pkg_area_names())
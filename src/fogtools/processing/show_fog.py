@@ -9,13 +9,30 @@ For example:
             --seviri /path/to/seviri/files/*
             --nwcsaf /path/to/cmsaf/files/*
             -a germ
+
+With -t, inputs may cover many time slots and may be given as directories
+or (quoted) glob patterns.  Files are grouped by scan time and one output
+per slot is written to the output directory, for example:
+
+    show-fog -t -j 4 $(plotdir)/day/
+            --abi '/path/to/abi/20200101/*'
+            --nwcsaf /path/to/cmic/20200101/
+            -a new-england-1000
 """
 
+import sys
+import glob
+import logging
 import xarray
 import pathlib
 import argparse
+import concurrent.futures
 from .. import vis
-import fogpy.composites
+import satpy
+import satpy.readers
+import satpy.writers
+
+logger = logging.getLogger(__name__)
 
 
 def get_parser():
@@ -32,7 +49,9 @@ def get_parser():
                  "and that will contain all output files.  Storing multiple "
                  "files happens when passing -i or -d.  In this case, each "
                  "dataset will be stored as `dataset.tif` within the output "
-                 "directory.")
+                 "directory.  With -t, this is always a directory, "
+                 "containing `YYYYmmdd-HHMM.tif` for each time slot, or "
+                 "a subdirectory `YYYYmmdd-HHMM` with -i or -d.")
 
     sat = parser.add_mutually_exclusive_group(required=True)
     sat.add_argument(
@@ -70,6 +89,20 @@ def get_parser():
             help="Also write all dependencies, that means all products used "
                  "directly by fogpy to generate the fog products")
 
+    parser.add_argument(
+            "-t", "--time-series", action="store_true",
+            help="Process many time slots.  Expand directories and glob "
+                 "patterns in the inputs and group files by scan time.")
+
+    parser.add_argument(
+            "-j", "--jobs", action="store", type=int, default=1,
+            help="With -t, how many time slots to process at the same time")
+
+    parser.add_argument(
+            "--time-threshold", action="store", type=float, default=60,
+            help="With -t, maximum difference in seconds between start "
+                 "times of files belonging to the same slot")
+
     return parser
 
 
@@ -77,27 +110,169 @@ def parse_cmdline():
     return get_parser().parse_args()
 
 
-def main():
-    from satpy.utils import debug_on
-    debug_on()
-    p = parse_cmdline()
+def expand_paths(paths):
+    """Expand directories and glob patterns into files.
+
+    Args:
+        paths (Iterable[pathlib.Path]): Files, directories, or glob patterns
+
+    Returns:
+        List[str], sorted
+    """
+    files = set()
+    for p in paths:
+        for m in glob.glob(str(p)):
+            m = pathlib.Path(m)
+            if m.is_dir():
+                files.update(str(x) for x in m.iterdir() if x.is_file())
+            else:
+                files.add(str(m))
+    return sorted(files)
+
+
+def group_slots(sensor_reader, sensor_files, cloud_reader, cloud_files,
+                time_threshold=60):
+    """Group satellite and cloud files by scan time.
+
+    Slots for which files from either reader are missing are skipped.
+
+    Returns:
+        List[Dict[str, List[str]]], with files per reader for each slot, in
+        temporal order
+    """
+    return satpy.readers.group_files(
+            sensor_files + cloud_files,
+            reader=[sensor_reader, cloud_reader],
+            time_threshold=time_threshold,
+            group_keys=("start_time",),
+            missing="skip")
+
+
+def show_fog(p, sensor_reader, sensor_files, cloud_reader, cloud_files,
+             out=None):
+    """Calculate fog and write outputs for a single slot.
+
+    All outputs are collected as delayed writes and computed together, such
+    that anything they have in common, such as the fogpy intermediates, is
+    computed only once.
+
+    Args:
+        p (argparse.Namespace): Command-line arguments
+        sensor_reader (str): Reader for satellite files
+        sensor_files (List[str]): Satellite files
+        cloud_reader (str): Reader for cloud microphysics files
+        cloud_files (List[str]): Cloud microphysics files
+        out (pathlib.Path or None): Where to store output, see
+            :func:`get_parser`.  If not given, use a name in ``p.out`` based
+            on the start time of the slot.
+    """
     (im, sc) = vis.get_fog_blend_for_sat(
-            "seviri_l1b_hrit" if p.seviri else "abi_l1b",
-            [str(x) for x in (p.seviri or p.abi)],
-            "nwcsaf-geo" if p.nwcsaf else "cmsaf-claas2_l2_nc",
-            [str(x) for x in (p.nwcsaf or p.cmsaf)],
+            sensor_reader,
+            sensor_files,
+            cloud_reader,
+            cloud_files,
             p.area,
             "overview")
+    if out is None:
+        out = p.out / f"{sc.start_time:%Y%m%d-%H%M}"
+        if not (p.store_intermediates or p.store_dependencies):
+            out = out.with_suffix(".tif")
+    results = []
     if p.store_intermediates or p.store_dependencies:
-        p.out.mkdir(exist_ok=True, parents=True)
-        im.save(str(p.out / "fog_blend.tif"))
+        out.mkdir(exist_ok=True, parents=True)
+        results.append(im.save(str(out / "fog_blend.tif"), compute=False))
     else:
-        im.save(str(p.out))
+        results.append(im.save(str(out), compute=False))
 
     if p.store_dependencies:
-        sc.save_datasets(filename=str(p.out / "{name:s}.tif"),
-                         datasets={d["name"] for d in sc.keys() if
-                                   isinstance(sc[d], xarray.DataArray)})
+        results.append(sc.save_datasets(
+            filename=str(out / "{name:s}.tif"),
+            datasets={d["name"] for d in sc.keys() if
+                      isinstance(sc[d], xarray.DataArray)},
+            compute=False))
 
     if p.store_intermediates:
-        fogpy.composites.save_extras(sc, p.out / "intermediates.nc")
+        results.append(save_extras(sc, out / "intermediates.nc"))
+
+    satpy.writers.compute_writer_results(results)
+
+
+def save_extras(sc, fn):
+    """Prepare writing fogpy intermediates to NetCDF.
+
+    Like :func:`fogpy.composites.save_extras`, but returns the delayed write
+    rather than computing it, such that it can be computed together with
+    other outputs, see :func:`satpy.writers.compute_writer_results`.
+
+    Args:
+        sc (Scene): Scene containing ``fls_day_extra``
+        fn (pathlib.Path or str): Where to write
+
+    Returns:
+        Delayed writes
+    """
+    ds = sc["fls_day_extra"]
+    nsc = satpy.Scene()
+    for k in ds.data_vars.keys():
+        nsc[k] = ds[k]
+    return nsc.save_datasets(
+            writer="cf",
+            datasets={str(k) for k in ds.data_vars.keys()},
+            filename=str(fn),
+            compute=False)
+
+
+def show_fog_series(p, sensor_reader, sensor_paths, cloud_reader,
+                    cloud_paths):
+    """Calculate fog and write outputs for many slots.
+
+    The first slot is processed on its own, such that the area and composite
+    configurations and the resampling lookup tables are prepared once.  The
+    other slots reuse those and are processed ``p.jobs`` at a time.  A
+    failure for one slot does not stop the others.
+
+    Returns:
+        (int, int), number of slots failed and total
+    """
+    p.out.mkdir(exist_ok=True, parents=True)
+    groups = group_slots(sensor_reader, expand_paths(sensor_paths),
+                         cloud_reader, expand_paths(cloud_paths),
+                         p.time_threshold)
+    logger.info(f"Found {len(groups):d} time slots")
+
+    def process(group):
+        try:
+            show_fog(p, sensor_reader, group[sensor_reader],
+                     cloud_reader, group[cloud_reader])
+        except Exception:
+            logger.exception("Failed to process slot with files " +
+                             ", ".join(group[sensor_reader]))
+            return False
+        return True
+
+    if not groups:
+        return (0, 0)
+    failed = not process(groups[0])
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(p.jobs, 1),
+            thread_name_prefix="show-fog") as executor:
+        failed += sum(not ok for ok in executor.map(process, groups[1:]))
+    return (failed, len(groups))
+
+
+def main():
+    from satpy.utils import debug_on
+    debug_on()
+    p = parse_cmdline()
+    sensor_reader = "seviri_l1b_hrit" if p.seviri else "abi_l1b"
+    cloud_reader = "nwcsaf-geo" if p.nwcsaf else "cmsaf-claas2_l2_nc"
+    if p.time_series:
+        (failed, total) = show_fog_series(
+                p, sensor_reader, p.seviri or p.abi,
+                cloud_reader, p.nwcsaf or p.cmsaf)
+        if failed:
+            sys.exit(f"Failed for {failed:d} out of {total:d} time slots")
+    else:
+        show_fog(p, sensor_reader, [str(x) for x in (p.seviri or p.abi)],
+                 cloud_reader, [str(x) for x in (p.nwcsaf or p.cmsaf)],
+                 p.out)
@@ -1,16 +1,25 @@
 """Routines to interact with sky
 """
 
+import asyncio
 import pathlib
+import threading
 import subprocess
 import logging
-import itertools
 
+import numpy
 import pandas
 import lxml.etree
 import lxml.builder
 import appdirs
 
+from . import util
+
+try:
+    import eccodes
+except ModuleNotFoundError:
+    eccodes = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -40,6 +49,41 @@ def make_icon_nwcsaf_filename(base, t, fs):
     return pathlib.Path(base) / "import" / "NWP_data" / fn
 
 
+def icon_analysis_step(timestamp):
+    """Get ICON analysis and forecast step best covering timestamp
+
+    That's the forecast for the nearest whole hour from the most recent
+    analysis, which is either the analysis itself or a forecast for up to five
+    hours.
+
+    Args:
+        timestamp (pandas.Timestamp)
+
+    Returns:
+        (pandas.Timestamp, int), analysis time and forecast step in hours
+    """
+    t = timestamp.round("H")
+    start_time = timestamp2period(t).start_time
+    return (start_time, t.hour - start_time.hour)
+
+
+def get_icon_nwcsaf_filename(base, timestamp):
+    """Get filename of ICON data for NWCSAF best covering timestamp
+
+    Unlike :class:`RequestBuilder`, this has no side effects.
+
+    Args:
+        base (str or Pathlib.Path):
+            Path relative to which the files are generated
+        timestamp (pandas.Timestamp):
+            Time for which to get filename
+
+    Returns:
+        pathlib.Path
+    """
+    return make_icon_nwcsaf_filename(base, *icon_analysis_step(timestamp))
+
+
 def ensure_parents_exist(*args):
     """For all paths, ensure parent dirs exist
     """
@@ -268,13 +312,26 @@ class RequestBuilder:
         Returns: lxml.etree.Element
         """
 
+        return self.get_request_et_for_steps(
+                (start_time, i) for start_time in start_times
+                for i in range(6))
+
+    def get_request_et_for_steps(self, steps):
+        """Get request for particular forecast steps as an XML Tree
+
+        Args:
+            steps (Iterable[Tuple[pandas.Timestamp, int]])
+                Pairs of analysis time and forecast step in hours
+
+        Returns: lxml.etree.Element
+        """
+
         reqs = []
-        for start_time in start_times:
-            reqs.extend(itertools.chain(*((
-                    self.select_read_store_forc(start_time, i, "surf_anal"),
-                    self.select_read_store_forc(start_time, i, "surf_forc"),
-                    self.select_read_store_forc(start_time, i, "level"))
-                        for i in range(6))))
+        for (start_time, i) in steps:
+            reqs.extend((
+                self.select_read_store_forc(start_time, i, "surf_anal"),
+                self.select_read_store_forc(start_time, i, "surf_forc"),
+                self.select_read_store_forc(start_time, i, "level")))
         return self.E.requestCollection(
                 *reqs,
                 processing="sequential",
@@ -293,7 +350,22 @@ class RequestBuilder:
         Returns: bytes
         """
 
-        et = self.get_request_et(start_times)
+        return self._tostring(self.get_request_et(start_times))
+
+    def get_request_ba_for_steps(self, steps):
+        """Get request for particular forecast steps as a bytes array
+
+        Args:
+            steps (Iterable[Tuple[pandas.Timestamp, int]])
+                Pairs of analysis time and forecast step in hours
+
+        Returns: bytes
+        """
+
+        return self._tostring(self.get_request_et_for_steps(steps))
+
+    @staticmethod
+    def _tostring(et):
         return lxml.etree.tostring(
                 et, standalone=True,
                 pretty_print=True).replace(b"'", b'"', 6)
@@ -349,21 +421,181 @@ def send_to_sky(b):
         cp = subprocess.run(
                 ["sky", "-v"], input=b, check=True, capture_output=True)
     except subprocess.CalledProcessError as e:
-        logger.error(
-                f"sky call failed with code {e.returncode:d}\n"
-                "stdout\n"
-                "------\n" +
-                (e.stdout.decode("ascii") or "(empty)\n") +
-                "stderr\n"
-                "------\n" +
-                (e.stderr.decode("ascii") or "(empty)\n") +
-                "sky-command\n"
-                "-----------\n" +
-                b.decode("ascii"))
+        _log_sky_failure(e, b)
         raise
     return cp
 
 
+def _log_sky_failure(e, b):
+    logger.error(
+            f"sky call failed with code {e.returncode:d}\n"
+            "stdout\n"
+            "------\n" +
+            (e.stdout.decode("ascii", errors="replace") or "(empty)\n") +
+            "stderr\n"
+            "------\n" +
+            (e.stderr.decode("ascii", errors="replace") or "(empty)\n") +
+            "sky-command\n"
+            "-----------\n" +
+            b.decode("ascii"))
+
+
+async def send_to_sky_async(b, timeout=None):
+    """Send request to sky asynchronously.
+
+    Like :func:`send_to_sky`, but as a coroutine, such that several
+    requests can be waiting for sky at the same time.  Output on stdout and
+    stderr is passed on to the log line by line while sky is running.
+
+    Args:
+        b (bytes):
+            Request to send to sky.
+        timeout (float or None):
+            Time in seconds after which sky is killed.
+
+    Returns:
+        CompletedProcess object from subprocess module
+    """
+
+    proc = await asyncio.create_subprocess_exec(
+            "sky", "-v", stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    logger.debug(f"Started sky with pid {proc.pid:d}")
+
+    async def write():
+        proc.stdin.write(b)
+        try:
+            await proc.stdin.drain()
+        finally:
+            proc.stdin.close()
+
+    async def read(stream, name):
+        lines = []
+        async for line in stream:
+            lines.append(line)
+            logger.debug(f"sky {proc.pid:d} {name:s}: " +
+                         line.decode("ascii", errors="replace").rstrip())
+        return b"".join(lines)
+
+    try:
+        (_, out, err) = await asyncio.wait_for(
+                asyncio.gather(write(), read(proc.stdout, "stdout"),
+                               read(proc.stderr, "stderr")),
+                timeout)
+        await proc.wait()
+    except BaseException as e:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            raise SkyFailure(f"sky did not finish within {timeout!s} s, "
+                             "killed") from e
+        raise
+    cp = subprocess.CompletedProcess(
+            ["sky", "-v"], proc.returncode, out, err)
+    try:
+        cp.check_returncode()
+    except subprocess.CalledProcessError as e:
+        _log_sky_failure(e, b)
+        raise
+    return cp
+
+
+class SkyRunner:
+    """Run sky requests concurrently.
+
+    Requests submitted from any thread are run by an event loop in a
+    background thread, such that waiting for sky does not block the caller.
+    At most ``max_concurrent`` requests are sent to sky at the same time;
+    others wait their turn.
+    """
+
+    def __init__(self, max_concurrent=2, timeout=None):
+        """Initialise runner.
+
+        Args:
+            max_concurrent (int):
+                Maximum number of sky processes running at the same time.
+            timeout (float or None):
+                Time in seconds after which a sky request is killed, see
+                :func:`send_to_sky_async`.
+        """
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be >= 1, got "
+                             f"{max_concurrent:d}")
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = None
+                self._thread = threading.Thread(
+                        target=self._loop.run_forever, daemon=True,
+                        name="sky-runner")
+                self._thread.start()
+            return self._loop
+
+    async def _send(self, b):
+        # created here, such that it belongs to the runner's loop (before
+        # Python 3.10, it binds to the loop of the creating thread)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self._semaphore:
+            return await send_to_sky_async(b, self.timeout)
+
+    def submit(self, b):
+        """Submit request to sky.
+
+        Args:
+            b (bytes):
+                Request to send to sky.
+
+        Returns:
+            concurrent.futures.Future with the CompletedProcess
+        """
+        loop = self._get_loop()
+        return asyncio.run_coroutine_threadsafe(self._send(b), loop)
+
+    def send(self, b):
+        """Send request to sky and wait for the result.
+        """
+        return self.submit(b).result()
+
+    def close(self):
+        """Stop the background event loop.
+
+        Requests still running are killed.
+        """
+        with self._lock:
+            (loop, thread) = (self._loop, self._thread)
+            (self._loop, self._thread) = (None, None)
+        if loop is None:
+            return
+
+        async def cancel_all():
+            tasks = [t for t in asyncio.all_tasks()
+                     if t is not asyncio.current_task()]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(cancel_all(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def verify_period(p):
     """Verify that a period is OK for sky
 
@@ -400,29 +632,182 @@ def period2daterange(p):
             freq="6H")
 
 
-def get_and_send(base, period):
+def _icon_file_present(base, start_time, fs):
+    f = make_icon_nwcsaf_filename(base, start_time, fs)
+    return f.exists() and f.stat().st_size > 0
+
+
+def plan_icon_retrieval(base, timestamps):
+    """Plan which ICON files to retrieve for timestamps
+
+    For each timestamp, all forecast steps are needed for the analysis
+    covering it, both for the timestamp itself and for the timestamp rounded
+    to the nearest hour (the latter is what the fog database looks for).
+    Files that are already present are skipped.
+
+    Args:
+        base (pathlib.Path or str)
+            Directory where NWCSAF software are
+        timestamps (Iterable[pandas.Timestamp])
+            Times for which ICON data are needed
+
+    Returns:
+        List[Tuple[pandas.Timestamp, int]], sorted pairs of analysis time
+        and forecast step for which files are missing
+    """
+
+    analyses = {a
+                for ts in timestamps
+                for a in (timestamp2period(ts).start_time,
+                          icon_analysis_step(ts)[0])}
+    return [(a, i) for a in sorted(analyses) for i in range(6)
+            if not _icon_file_present(base, a, i)]
+
+
+def get_and_send_many(base, timestamps, crop=None, margin=1.0,
+                      runner=None):
+    """Build a single request for many timestamps and send it to sky
+
+    Determine which ICON files are missing for any of the timestamps (see
+    :func:`plan_icon_retrieval`) and get all of them with a single request
+    from the sky "roma" database.  If no files are missing, sky is not
+    called.
+
+    Args:
+        base (pathlib.Path or str)
+            Directory where NWCSAF software are
+        timestamps (Iterable[pandas.Timestamp])
+            Times for which ICON data are needed
+        crop (Tuple[float, float, float, float] or None)
+            If given, crop retrieved files to this box, see
+            :func:`crop_grib`.
+        margin (float)
+            Margin to add to crop box in degrees.
+        runner (SkyRunner or None)
+            If given, send the request through this runner, see
+            :class:`SkyRunner`.
+
+    Returns:
+        Set[pathlib.Path] with generated files
+    """
+
+    steps = plan_icon_retrieval(base, timestamps)
+    if not steps:
+        logger.debug("All ICON files already present")
+        return set()
+    rb = RequestBuilder(base)
+    ba = rb.get_request_ba_for_steps(steps)
+    return _send_and_check(rb, ba, crop, margin, runner)
+
+
+def get_and_send(base, period, crop=None, margin=1.0, runner=None):
     """Build a request and send it to sky
 
     Get ICON files for period and request them from the sky "roma" database.
     The files will be written to the subdirectory import/NWP_data within
-    ``basedir``, where the NWCSAF software can find them.
+    ``basedir``, where the NWCSAF software can find them.  Files that are
+    already present are not requested again.
 
     Args:
         base (pathlib.Path or str)
             Directory where NWCSAF software are
         p (pandas.Period)
             Analysis date
+        crop (Tuple[float, float, float, float] or None)
+            If given, crop retrieved files to this box, see
+            :func:`crop_grib`.
+        margin (float)
+            Margin to add to crop box in degrees.
+        runner (SkyRunner or None)
+            If given, send the request through this runner, see
+            :class:`SkyRunner`.
 
     Returns:
-        List[pathlib.Path] with generated files
+        Set[pathlib.Path] with generated files
     """
 
+    steps = [(a, i) for a in period2daterange(period) for i in range(6)
+             if not _icon_file_present(base, a, i)]
+    if not steps:
+        logger.debug("All ICON files already present")
+        return set()
     rb = RequestBuilder(base)
-    ba = rb.get_request_ba(period2daterange(period))
+    ba = rb.get_request_ba_for_steps(steps)
+    return _send_and_check(rb, ba, crop, margin, runner)
+
+
+def get_and_send_periods(base, periods, crop=None, margin=1.0,
+                         max_concurrent=2, timeout=None):
+    """Build requests for many periods and send them to sky concurrently
+
+    Like calling :func:`get_and_send` for each period, but with one request
+    per period that are all sent to sky at once, such that up to
+    ``max_concurrent`` of them are being answered at the same time.
+
+    Args:
+        base (pathlib.Path or str)
+            Directory where NWCSAF software are
+        periods (Iterable[pandas.Period])
+            Analysis dates
+        crop (Tuple[float, float, float, float] or None)
+            If given, crop retrieved files to this box, see
+            :func:`crop_grib`.
+        margin (float)
+            Margin to add to crop box in degrees.
+        max_concurrent (int)
+            Maximum number of requests being answered at the same time.
+        timeout (float or None)
+            Time in seconds after which a request is killed.
+
+    Returns:
+        Set[pathlib.Path] with generated files
+    """
+
+    pending = []
+    with SkyRunner(max_concurrent, timeout) as runner:
+        for period in periods:
+            steps = [(a, i) for a in period2daterange(period)
+                     for i in range(6)
+                     if not _icon_file_present(base, a, i)]
+            if not steps:
+                logger.debug(f"All ICON files for {period!s} already "
+                             "present")
+                continue
+            rb = RequestBuilder(base)
+            ba = rb.get_request_ba_for_steps(steps)
+            _log_request(rb, ba)
+            pending.append((rb, runner.submit(ba)))
+        files = set()
+        for (rb, fut) in pending:
+            fut.result()
+            files |= _check_sent(rb, crop, margin)
+    return files
+
+
+def _log_request(rb, ba):
     logger.info("Sending request to sky, expecting output files: " +
                 ", ".join(sorted(str(x) for x in rb.expected_output_files)))
     logger.debug("Full request:\n" + ba.decode("ascii"))
-    send_to_sky(ba)
+
+
+def _send_and_check(rb, ba, crop=None, margin=1.0, runner=None):
+    """Send request to sky and check that expected files were written
+
+    Optionally crop the files afterwards.
+    """
+
+    _log_request(rb, ba)
+    if runner is None:
+        send_to_sky(ba)
+    else:
+        runner.send(ba)
+    return _check_sent(rb, crop, margin)
+
+
+def _check_sent(rb, crop=None, margin=1.0):
+    """Check that files expected from request were written and crop them
+    """
+
     for eof in rb.expected_output_files:
         peof = pathlib.Path(eof)
         if peof.suffix != ".grib":
@@ -430,4 +815,91 @@ def get_and_send(base, period):
         if not (peof.exists() and peof.stat().st_size > 0):
             raise SkyFailure(f"File absent or empty: {eof!s}, sky "
                              "apparently failed to find data.")
+    if crop is not None:
+        for eof in rb.expected_output_files:
+            if pathlib.Path(eof).suffix == ".grib":
+                crop_grib(eof, crop, margin)
     return rb.expected_output_files
+
+
+def crop_grib(f, box, margin=1.0):
+    """Crop GRIB file to region
+
+    Cut each message in a GRIB file on a regular latitude/longitude grid to
+    the part covering a box plus a margin, and re-encode it.  The file is
+    replaced by the cropped version.  Messages on other grids are copied
+    unchanged.  Requires eccodes.
+
+    Args:
+        f (pathlib.Path or str)
+            GRIB file to crop
+        box (Tuple[float, float, float, float])
+            Region to keep: minimum longitude, minimum latitude, maximum
+            longitude, maximum latitude, in degrees.
+        margin (float)
+            Margin to add on each side of the box, in degrees.
+    """
+
+    if eccodes is None:
+        raise ModuleNotFoundError("Cropping GRIB files requires eccodes")
+    f = pathlib.Path(f)
+    (lon0, lat0, lon1, lat1) = box
+    box = (lon0-margin, lat0-margin, lon1+margin, lat1+margin)
+    logger.debug(f"Cropping {f!s} to {box!s}")
+    with util.atomic_write(f) as tmp, f.open("rb") as fpi, \
+            tmp.open("wb") as fpo:
+        while (h := eccodes.codes_grib_new_from_file(fpi)) is not None:
+            try:
+                out = _crop_grib_message(h, box)
+                try:
+                    eccodes.codes_write(out, fpo)
+                finally:
+                    eccodes.codes_release(out)
+            finally:
+                eccodes.codes_release(h)
+
+
+def _crop_grib_message(h, box):
+    """Return cropped copy of GRIB message, see :func:`crop_grib`
+    """
+
+    out = eccodes.codes_clone(h)
+    if (eccodes.codes_get(h, "gridType") != "regular_ll"
+            or eccodes.codes_get(h, "iScansNegatively")
+            or eccodes.codes_get(h, "jPointsAreConsecutive")):
+        logger.warning("Can only crop regular lat/lon grids scanning "
+                       "eastward and along rows, not cropping message "
+                       f"for {eccodes.codes_get(h, 'shortName')!s}")
+        return out
+    (lon0, lat0, lon1, lat1) = box
+    ni = eccodes.codes_get(h, "Ni")
+    nj = eccodes.codes_get(h, "Nj")
+    di = eccodes.codes_get(h, "iDirectionIncrementInDegrees")
+    dj = eccodes.codes_get(h, "jDirectionIncrementInDegrees")
+    if not eccodes.codes_get(h, "jScansPositively"):
+        dj = -dj
+    lats = (eccodes.codes_get(h, "latitudeOfFirstGridPointInDegrees")
+            + numpy.arange(nj)*dj)
+    lons = (eccodes.codes_get(h, "longitudeOfFirstGridPointInDegrees")
+            + numpy.arange(ni)*di)
+    rows = numpy.nonzero((lats >= lat0) & (lats <= lat1))[0]
+    # longitudes may wrap around
+    offset = (lons - lon0) % 360
+    cols = numpy.nonzero(offset <= lon1 - lon0)[0]
+    cols = cols[numpy.argsort(offset[cols], kind="stable")]
+    if rows.size == 0 or cols.size == 0:
+        eccodes.codes_release(out)
+        raise ValueError(f"Box {box!s} does not overlap GRIB grid")
+    values = eccodes.codes_get_values(h).reshape(nj, ni)
+    eccodes.codes_set(out, "Ni", int(cols.size))
+    eccodes.codes_set(out, "Nj", int(rows.size))
+    eccodes.codes_set(out, "latitudeOfFirstGridPointInDegrees",
+                      float(lats[rows[0]]))
+    eccodes.codes_set(out, "latitudeOfLastGridPointInDegrees",
+                      float(lats[rows[-1]]))
+    eccodes.codes_set(out, "longitudeOfFirstGridPointInDegrees",
+                      float(lons[cols[0]] % 360))
+    eccodes.codes_set(out, "longitudeOfLastGridPointInDegrees",
+                      float(lons[cols[-1]] % 360))
+    eccodes.codes_set_values(out, values[numpy.ix_(rows, cols)].ravel())
+    return out
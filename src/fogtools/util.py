@@ -0,0 +1,35 @@
+"""Miscellaneous utilities."""
+
+import os
+import pathlib
+import threading
+import contextlib
+
+
+@contextlib.contextmanager
+def atomic_write(f, suffix=".tmp"):
+    """Context manager to write a file atomically.
+
+    Yields the path of a hidden temporary file in the same directory as f,
+    to which the caller should write.  When the block completes, the
+    temporary file is renamed to f, such that readers never see a partially
+    written file.  If the block raises an exception, the temporary file is
+    removed instead.  The temporary filename contains the process and
+    thread ID, such that concurrent writers do not interfere; the last one
+    to finish wins.
+
+    Args:
+        f (pathlib.Path or str): File to write.
+        suffix (str): Suffix for the temporary file, for writers that
+            determine the file format from the extension.
+    """
+    f = pathlib.Path(f)
+    tmp = f.with_name(
+            f".{f.name:s}.{os.getpid():d}-{threading.get_ident():d}"
+            f"{suffix:s}")
+    try:
+        yield tmp
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, f)
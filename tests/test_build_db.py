@@ -11,7 +11,7 @@ import pandas
 def test_get_parser(ap):
     import fogtools.processing.build_db
     fogtools.processing.build_db.get_parser()
-    assert ap.return_value.add_argument.call_count == 4
+    assert ap.return_value.add_argument.call_count == 7
 
 
 @patch("fogtools.processing.build_db.parse_cmdline", autospec=True)
@@ -22,6 +22,7 @@ def test_main(fdF, fpbp, station, tmp_path):
             ["/no/out/file",
              "--date", "198508131515"])
     fogtools.processing.build_db.main()
+    fdF.assert_called_with(out=pathlib.Path("/no/out/file"))
     fdF.return_value.extend.assert_called_with(
             pandas.Timestamp("198508131515"))
     fdF.return_value.store.assert_called_with(
@@ -32,7 +33,18 @@ def test_main(fdF, fpbp, station, tmp_path):
     with patch("fogtools.isd.read_db") as fir:
         fir.return_value = station
         fogtools.processing.build_db.main()
-    fdF.return_value.extend.assert_called_with(
-            pandas.Timestamp("201901052200"), onerror="log")
+    (args, kwargs) = fdF.return_value.extend_many.call_args
+    assert list(args[0]) == [pandas.Timestamp("201901052200")]
+    assert kwargs == {"onerror": "log", "lookahead": 2,
+                      "retry_failed": False}
     fdF.return_value.store.assert_called_with(
             pathlib.Path("/no/out/file"))
+    fpbp.return_value = fogtools.processing.build_db.get_parser().parse_args(
+            ["/no/out/file",
+             "--top-n", "1", "--workers", "3"])
+    with patch("fogtools.isd.read_db") as fir:
+        fir.return_value = station
+        fogtools.processing.build_db.main()
+    (args, kwargs) = fdF.return_value.extend_parallel.call_args
+    assert list(args[0]) == [pandas.Timestamp("201901052200")]
+    assert args[1] == 3
@@ -0,0 +1,116 @@
+"""Test the core module
+"""
+
+import os
+import unittest.mock
+
+import pytest
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    import fogtools.core
+    reg = fogtools.core._ConfigRegistry()
+    monkeypatch.setattr(fogtools.core, "_config_registry", reg)
+    return reg
+
+
+@unittest.mock.patch("sattools.ptc.get_all_areas", autospec=True)
+def test_get_area(sga, registry, tmp_path):
+    import satpy
+    from fogtools.core import get_area
+
+    def fake_areas(pkgs):
+        if pkgs == ["fcitools"]:
+            raise ModuleNotFoundError
+        return {f"{pkgs[0]:s}-area": pkgs[0]}
+    sga.side_effect = fake_areas
+    with satpy.config.set(config_path=[str(tmp_path)]):
+        assert get_area("satpy-area") == "satpy"
+        assert get_area("fogtools-area") == "fogtools"
+        with pytest.raises(KeyError):
+            get_area("fcitools-area")
+        assert sga.call_count == 3
+        # changed configuration is read again
+        (tmp_path / "areas.yaml").touch()
+        assert get_area("satpy-area") == "satpy"
+        assert sga.call_count == 6
+        os.utime(tmp_path / "areas.yaml", ns=(0, 0))
+        get_area("satpy-area")
+        assert sga.call_count == 9
+        get_area("satpy-area")
+        assert sga.call_count == 9
+
+
+@unittest.mock.patch("sattools.ptc.add_all_pkg_comps_mods", autospec=True)
+def test_add_comps_mods(saapcm, registry):
+    import satpy
+
+    def fake_add(sc, pkgs, sensors):
+        sc._dependency_tree.update_compositors_and_modifiers(
+                {"abi": {"fls_day": "fogpy compositor"}},
+                {"abi": {"fogpy_modifier": ("fogpy", {})}})
+    saapcm.side_effect = fake_add
+    for _ in range(3):
+        sc = satpy.Scene()
+        registry.add_comps_mods(sc, ["satpy", "fogpy"], ["abi"])
+        tree = sc._dependency_tree
+        assert tree.compositors["abi"]["fls_day"] == "fogpy compositor"
+        assert tree.modifiers["abi"]["fogpy_modifier"] == ("fogpy", {})
+    saapcm.assert_called_once()
+    registry.add_comps_mods(satpy.Scene(), ["satpy"], ["abi"])
+    assert saapcm.call_count == 2
+    registry.clear()
+    registry.add_comps_mods(satpy.Scene(), ["satpy"], ["abi"])
+    assert saapcm.call_count == 3
+
+
+def test_get_pkg_area_names():
+    from fogtools.core import get_pkg_area_names
+    names = get_pkg_area_names()
+    assert "new-england-500" in names
+    assert len(names) == len(set(names))
+
+
+@unittest.mock.patch("fogtools.core.get_area", autospec=True)
+@unittest.mock.patch("fogtools.core._config_registry", autospec=True)
+def test_get_fog_resample_cache(fcr, fcg):
+    import pyresample.geometry
+    from fogtools.core import get_fog, get_resample_cache_dir
+    sc = unittest.mock.MagicMock()
+    ls = get_fog("abi_l1b", None, "nwcsaf-geo", None, "fribbulus",
+                 "overview", scene=sc)
+    assert ls is sc.resample.return_value
+    fcg.assert_called_once_with("fribbulus")
+    sc.resample.assert_called_once_with(
+            fcg.return_value, unload=False, resampler="nearest",
+            cache_dir=str(get_resample_cache_dir()))
+    assert get_resample_cache_dir().is_dir()
+    ls.load.assert_called_once_with(["fls_day", "fls_day_extra"],
+                                    unload=False)
+    # ad-hoc areas are not cached
+    sc.reset_mock()
+    ar = unittest.mock.MagicMock(spec=pyresample.geometry.AreaDefinition)
+    get_fog("abi_l1b", None, "nwcsaf-geo", None, ar, "overview", scene=sc)
+    sc.resample.assert_called_once_with(ar, unload=False,
+                                        resampler="nearest")
+
+
+@unittest.mock.patch("fogtools.core.get_area", autospec=True)
+@unittest.mock.patch("fogtools.core._config_registry", autospec=True)
+@unittest.mock.patch("satpy.Scene", autospec=True)
+def test_prewarm_resample_cache(sS, fcr, fcg):
+    from fogtools.core import prewarm_resample_cache, get_resample_cache_dir
+    prewarm_resample_cache("abi_l1b", ["a"], "nwcsaf-geo", ["b"],
+                           ["fribbulus", "xax"])
+    sS.assert_called_once_with(
+            filenames={"abi_l1b": ["a"], "nwcsaf-geo": ["b"]})
+    sc = sS.return_value
+    fcr.add_comps_mods.assert_called_once_with(
+            sc, ["satpy", "fogpy"], ["abi"])
+    assert sc.resample.call_count == 2
+    sc.resample.assert_called_with(
+            fcg.return_value, unload=False, resampler="nearest",
+            cache_dir=str(get_resample_cache_dir()))
+    assert fcg.call_args_list == [unittest.mock.call("fribbulus"),
+                                  unittest.mock.call("xax")]
@@ -1,3 +1,4 @@
+import os
 import pathlib
 import functools
 import subprocess
@@ -231,19 +232,25 @@ def test_init(db):
 
 
 @pytest.mark.xfail(pandas.__version__ < "1.1.3", reason="See pandas#36541")
-def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea):
+def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea,
+                monkeypatch):
     # TODO: rewrite test with less mocking
     #
     # function is probably mocking too much, the test passes but it fails in
     # the real world because the preconditions before calling .extract are not
     # met
     import fogtools.isd
+    import fogtools.db
+    # test the generic extraction through .load for all components
+    monkeypatch.setattr(fogtools.db, "eccodes", None)
     db.sat = abi
-    db.sat.load = unittest.mock.MagicMock()
-    db.sat.load.return_value = _mk_fakescene_realarea(
+    # satellite extraction uses the Scene shared with fog calculation
+    shared = unittest.mock.MagicMock()
+    shared.copy.return_value = _mk_fakescene_realarea(
             fakearea,
             datetime.datetime(1899, 12, 31, 23, 55),
             "raspberry", "banana")
+    db.fog.get_scene = unittest.mock.MagicMock(return_value=shared)
     db.nwp = icon
     db.nwp.load = unittest.mock.MagicMock()
     db.nwp.load.return_value = _mk_fakescene_realarea(
@@ -260,15 +267,19 @@ def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea):
             fakearea,
             None,
             "damson", "prune")
-    db.fog.load = unittest.mock.MagicMock()
-    db.fog.load.return_value = _mk_fakescene_realarea(
+    # fog is extracted from the fogpy result in memory
+    db.fog.write_geotiff = False
+    db.fog._calc = unittest.mock.MagicMock()
+    db.fog._calc.return_value = _mk_fakescene_realarea(
             fakearea,
             datetime.datetime(1899, 12, 31, 23, 55),
-            "aubergine", "shallot")
+            "fls_day", "shallot")
     loc = fogtools.isd.get_db_location()
     loc.parent.mkdir(parents=True)
     fake_df.to_parquet(fogtools.isd.get_db_location())
     db.ground.load(ts)
+    db.fog.wait_for_writes = unittest.mock.MagicMock(
+            wraps=db.fog.wait_for_writes)
     with caplog.at_level(logging.DEBUG):
         db.extend(ts)
         assert "Loading data for 1900-01-01 00:00:00" in caplog.text
@@ -278,13 +289,17 @@ def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea):
         # assert "Extracting data for [fogdb component ABI]
         # 1900-01-01 00:00:00" in caplog.text
     assert sorted(db.data.columns) == [
-            "apricot", "aubergine", "banana", "damson", "date_cmic",
-            "date_dem", "date_fog", "date_nwp", "date_synop", "peach",
-            "pineapple", "prune", "raspberry", "redcurrant", "shallot",
+            "apricot", "banana", "damson", "date_cmic",
+            "date_dem", "date_fog", "date_nwp", "date_synop", "fog",
+            "peach", "pineapple", "prune", "raspberry", "redcurrant",
             "values"]
-    assert db.data.shape == (5, 16)
+    assert db.data.shape == (5, 15)
+    db.fog.get_scene.assert_called_once_with(ts)
+    shared.load.assert_called_once_with(unittest.mock.ANY, unload=False)
+    # failures writing the GeoTIFF are reported
+    db.fog.wait_for_writes.assert_called_once_with()
     db.extend(ts)
-    assert db.data.shape == (10, 16)
+    assert db.data.shape == (10, 15)
     # check that messages were logged where we expect them
     f = (pathlib.Path(appdirs.user_log_dir("fogtools")) /
          f"{datetime.datetime.now():%Y-%m-%d}" / "fogdb-19000101-0000.log")
@@ -292,7 +307,7 @@ def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea):
         text = fp.read()
         assert text.split("\n")[0].endswith(f"Opening logfile at {f!s}")
         assert "Loading data for" in text
-    db.sat.load.side_effect = fogtools.db.FogDBError
+    db.fog.get_scene.side_effect = fogtools.db.FogDBError
     with pytest.raises(fogtools.db.FogDBError):
         db.extend(ts, onerror="raise")
     with caplog.at_level(logging.ERROR):
@@ -302,10 +317,272 @@ def test_extend(db, abi, icon, nwcsaf, fake_df, ts, caplog, fakearea):
         db.extend(ts, onerror="semprini")
 
 
+def test_extend_many(db, ts, caplog):
+    import fogtools.db
+    import fogtools.sky
+    db.extend = unittest.mock.MagicMock()
+    db.cmic.store = unittest.mock.MagicMock()
+    db.nwp.store_many = unittest.mock.MagicMock()
+    tss = [ts + pandas.Timedelta(i, "hours") for i in range(5)]
+    db._load_ground_many = unittest.mock.MagicMock()
+    db._load_ground_many.side_effect = lambda tss: {t: str(t) for t in tss}
+    db.extend_many(tss, lookahead=2)
+    db.nwp.store_many.assert_called_once_with(tss)
+    assert db.cmic.store.call_count == 5
+    assert [c.args[0] for c in db.extend.call_args_list] == tss
+    assert [c.kwargs["synop"] for c in db.extend.call_args_list] == [
+            str(t) for t in tss]
+    # GeoTIFFs are waited for once at the end
+    assert not any(c.kwargs["wait_writes"]
+                   for c in db.extend.call_args_list)
+    db._load_ground_many.side_effect = OSError("No ground today")
+    db.extend.reset_mock()
+    with caplog.at_level(logging.WARNING):
+        db.extend_many(tss, lookahead=2)
+        assert "loading per case" in caplog.text
+    assert [c.kwargs["synop"] for c in db.extend.call_args_list] == [
+            None]*5
+    db._load_ground_many.side_effect = None
+    db._load_ground_many.return_value = {}
+    db.extend.reset_mock()
+    db.nwp.store_many.reset_mock()
+    db.extend_many(tss, lookahead=0)
+    assert [c.args[0] for c in db.extend.call_args_list] == tss
+    db.nwp.store_many.assert_not_called()
+    db.extend.reset_mock()
+    db.nwp.store_many.side_effect = fogtools.sky.SkyFailure("No sky today")
+    with caplog.at_level(logging.WARNING):
+        db.extend_many(tss, lookahead=2)
+        assert "retrieving per case" in caplog.text
+    assert [c.args[0] for c in db.extend.call_args_list] == tss
+    db.extend.reset_mock()
+
+    def fake_store(t):
+        if t == tss[1]:
+            raise fogtools.db.FogDBError("No ABI today")
+    db.cmic.store.side_effect = fake_store
+    with caplog.at_level(logging.ERROR):
+        db.extend_many(tss, onerror="log")
+        assert ("Failed to extend database with data from "
+                "1900-01-01 01:00:00") in caplog.text
+    assert [c.args[0] for c in db.extend.call_args_list] == (
+            tss[:1] + tss[2:])
+    with pytest.raises(fogtools.db.FogDBError):
+        db.extend_many(tss, onerror="raise")
+    with pytest.raises(ValueError):
+        db.extend_many(tss, lookahead=-1)
+
+
+def test_extend_many_releases(db, ts):
+    import threading
+    tss = [ts + pandas.Timedelta(i, "hours") for i in range(5)]
+    done = {tss[4]}
+    store = db.cmic.store
+
+    def fake_store(t):
+        store(t)
+        done.add(t)  # NWCSAF produces output before the case is processed
+    db.cmic.max_staged = 2
+    db.cmic.store = unittest.mock.MagicMock(side_effect=fake_store)
+    db.cmic.find = unittest.mock.MagicMock(
+            side_effect=lambda t, complete=False: {t} if t in done else set())
+    db.cmic.ensure_deps = unittest.mock.MagicMock()
+    db.cmic._start_if_needed = unittest.mock.MagicMock()
+    db.sat.ensure = unittest.mock.MagicMock()
+    db.nwp.store_many = unittest.mock.MagicMock()
+    db.extend = unittest.mock.MagicMock(
+            side_effect=lambda t, **kwargs: db.cmic.ensure(t))
+    db._load_ground_many = unittest.mock.MagicMock(return_value={})
+    thread = threading.Thread(target=db.extend_many, args=(tss,),
+                              kwargs={"lookahead": 2}, daemon=True)
+    thread.start()
+    try:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    finally:
+        # unblock staging, such that a hanging prefetch cannot hang pytest
+        with db.cmic._staging:
+            db.cmic.max_staged = None
+            db.cmic._staging.notify_all()
+        thread.join()
+    assert [c.args[0] for c in db.extend.call_args_list] == tss
+    assert [c.args[0] for c in db.cmic.store.call_args_list] == tss[:4]
+    db.sat.ensure.assert_called_once_with(tss[4])
+    assert not db.cmic._staged
+
+
+def test_extend_many_releases_failed(db, ts, fake_df):
+    import threading
+    import fogtools.db
+    tss = [ts + pandas.Timedelta(i, "hours") for i in range(6)]
+    local = threading.local()
+    stage = db.cmic._stage
+
+    def fake_stage(t):
+        local.t = t
+        stage(t)
+
+    def fake_start():
+        if local.t == tss[2]:
+            raise fogtools.db.FogDBError("No NWCSAF today")
+    db.cmic.max_staged = 2
+    db.cmic._stage = unittest.mock.MagicMock(side_effect=fake_stage)
+    db.cmic._start_if_needed = unittest.mock.MagicMock(side_effect=fake_start)
+    db.cmic.find = unittest.mock.MagicMock(return_value=set())
+    db.cmic.ensure_deps = unittest.mock.MagicMock()
+    db.nwp.store_many = unittest.mock.MagicMock()
+    # fails before waiting for NWCSAF
+    db.fog.get_scene = unittest.mock.MagicMock(
+            side_effect=fogtools.db.FogDBError("No fog today"))
+    # no ground measurements for the first cases
+    db._load_ground_many = unittest.mock.MagicMock(return_value={
+        **{t: fake_df.iloc[:0] for t in tss[:2]},
+        **{t: fake_df for t in tss[3:]}})
+    thread = threading.Thread(target=db.extend_many, args=(tss,),
+                              kwargs={"lookahead": 2, "onerror": "log"},
+                              daemon=True)
+    thread.start()
+    try:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    finally:
+        # unblock staging, such that a hanging prefetch cannot hang pytest
+        with db.cmic._staging:
+            db.cmic.max_staged = None
+            db.cmic._staging.notify_all()
+        thread.join()
+    assert [c.args[0] for c in db.cmic._stage.call_args_list] == tss
+    assert db.fog.get_scene.call_count == 3
+    assert not db.cmic._staged
+
+
+def test_extend_parallel(db, ts, monkeypatch, caplog):
+    import fogtools.db
+
+    def fake_extend_many(self, timestamps, onerror, lookahead,
+                         retry_failed):
+        assert self.cmic._tm_lock is fogtools.db._coordinator_state["nwcsaf"]
+        assert self._manifest_lock is \
+            fogtools.db._coordinator_state["manifest"]
+        # settings of calling database are used in workers
+        assert self.fog.crop_to_stations
+        assert not self.fog.write_geotiff
+        assert self.nwp.crop == (-75, 40, -70, 45)
+        assert self.nwp.extract_fields == {"t"}
+        assert self.fog.base == base
+        self.data = pandas.DataFrame(
+                {"pid": os.getpid()},
+                index=pandas.DatetimeIndex(timestamps, name="DATE"))
+    monkeypatch.setattr(fogtools.db.FogDB, "extend_many", fake_extend_many)
+    tss = [ts + pandas.Timedelta(i, "hours") for i in range(5)]
+    base = db.fog.base / "elsewhere"
+    db.fog.crop_to_stations = True
+    db.fog.write_geotiff = False
+    db.fog.base = base
+    db.nwp.crop = (-75, 40, -70, 45)
+    db.nwp.extract_fields = {"t"}
+    db.extend_parallel(tss, 2)
+    assert db.data.shape == (5, 1)
+    assert sorted(db.data.index) == tss
+    assert os.getpid() not in db.data["pid"].values
+    db.nwp.sky_runner = unittest.mock.MagicMock()
+    with caplog.at_level(logging.WARNING):
+        db.extend_parallel(tss[:1], 3)
+        assert "SKY runner not shared" in caplog.text
+    assert db.data.shape == (6, 1)
+
+
+def test_extend_many_resume(fake_df, ts, tmp_path, caplog):
+    import json
+    import fogtools.db
+    db = fogtools.db.FogDB(out=tmp_path / "fogdb")
+    tss = [ts + pandas.Timedelta(i, "hours") for i in range(4)]
+
+    def fake_extend(t, onerror, synop, wait_writes):
+        db._append(t, fake_df.iloc[:3])
+
+    def fake_store(t):
+        if t == tss[1]:
+            raise fogtools.db.FogDBError("No ABI today")
+    db.extend = unittest.mock.MagicMock(side_effect=fake_extend)
+    db.cmic.store = unittest.mock.MagicMock(side_effect=fake_store)
+    db.nwp.store_many = unittest.mock.MagicMock()
+    db._load_ground_many = unittest.mock.MagicMock(return_value={})
+    db.extend_many(tss[:3], onerror="log")
+    with (tmp_path / "fogdb" / "_manifest.json").open("r") as fp:
+        cases = json.load(fp)["cases"]
+    assert cases["1900-01-01T00:00:00"]["status"] == "done"
+    assert cases["1900-01-01T01:00:00"]["status"] == "failed"
+    assert "No ABI today" in cases["1900-01-01T01:00:00"]["reason"]
+    assert "1900-01-01T03:00:00" not in cases
+    db.extend.reset_mock()
+    with caplog.at_level(logging.INFO):
+        db.extend_many(tss, onerror="log")
+        assert ("Not processing 1900-01-01 02:00:00, already done"
+                in caplog.text)
+    assert [c.args[0] for c in db.extend.call_args_list] == tss[3:]
+    db.extend.reset_mock()
+    db.cmic.store.side_effect = None
+    db.extend_many(tss, onerror="log", retry_failed=True)
+    assert [c.args[0] for c in db.extend.call_args_list] == tss[1:2]
+    with (tmp_path / "fogdb" / "_manifest.json").open("r") as fp:
+        cases = json.load(fp)["cases"]
+    assert all(c["status"] == "done" for c in cases.values())
+
+
 def test_closest_latlon(fake_df, ts, caplog):
     import fogtools.db
     new_df = fogtools.db.FogDB._select_closest_latlon(fake_df, ts)
     assert new_df.shape[0] == fake_df.shape[0]//2
+    assert new_df.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
+
+
+def test_match_synop_to_scans(fake_df, ts):
+    import fogtools.db
+    tss = [ts, ts + pandas.Timedelta(1, "hours")]
+    scans = pandas.Series(tss, index=tss, dtype="datetime64[ns]")
+    sel = fake_df.sort_index().loc[
+            tss[0]-pandas.Timedelta("1h"):tss[1]+pandas.Timedelta("1h")]
+    sel = sel.assign(vis=numpy.arange(sel.shape[0], dtype="u4"),
+                     name=pandas.Series("x", index=sel.index, dtype="string"))
+    m = fogtools.db._match_synop_to_scans(
+            sel, scans, tolerance=pandas.Timedelta("30m"))
+    assert m.index.names == ["CASE", "DATE", "LATITUDE", "LONGITUDE"]
+    assert m["vis"].dtype == numpy.dtype("u4")
+    assert m["name"].dtype == "string"
+    for t in tss:
+        mt = m.xs(t, level="CASE")
+        ref = fogtools.db.FogDB._select_closest_latlon(
+                sel.loc[t-pandas.Timedelta("30m"):
+                        t+pandas.Timedelta("30m")],
+                t)
+        assert mt.equals(ref)
+    scans += pandas.Timedelta(40, "s")
+    mb = fogtools.db._match_synop_to_scans(
+            sel, scans, tolerance=pandas.Timedelta("30m"),
+            direction="backward")
+    assert (mb.index.get_level_values("DATE") <=
+            mb.index.get_level_values("CASE") +
+            pandas.Timedelta(40, "s")).all()
+    assert mb.shape[0] < m.shape[0]
+
+
+def test_load_ground_many(db, fake_df, ts):
+    import fogtools.isd
+    loc = fogtools.isd.get_db_location()
+    loc.parent.mkdir(parents=True)
+    fake_df.to_parquet(loc)
+    db.sat.get_scan_time = unittest.mock.MagicMock()
+    db.sat.get_scan_time.side_effect = lambda t: t
+    tss = [ts, ts + pandas.Timedelta(1, "hours"),
+           ts + pandas.Timedelta(1, "days")]
+    g = db._load_ground_many(tss)
+    assert list(g.keys()) == tss
+    for t in tss[:2]:
+        ref = db._select_closest_latlon(db.ground.load(t), t)
+        assert g[t].equals(ref)
+    assert g[tss[2]].empty
+    assert db._load_ground_many([]) == {}
 
 
 def test_store(db, fake_df, tmp_path):
@@ -316,6 +593,33 @@ def test_store(db, fake_df, tmp_path):
     assert (tmp_path / "yes.parquet").exists()
 
 
+def test_store_partitioned(fake_df, ts, tmp_path):
+    import json
+    import fogtools.db
+    db = fogtools.db.FogDB(out=tmp_path / "fogdb")
+    with pytest.raises(ValueError):
+        db.store()
+    db._append(ts, fake_df.iloc[:5])
+    db._append(ts + pandas.Timedelta(1, "hour"), fake_df.iloc[5:12])
+    assert db.data is None
+    assert (tmp_path / "fogdb" / "fogdb-19000101-0000.parquet").exists()
+    assert (tmp_path / "fogdb" / "fogdb-19000101-0100.parquet").exists()
+    with (tmp_path / "fogdb" / "_manifest.json").open("r") as fp:
+        manifest = json.load(fp)
+    assert not manifest["complete"]
+    assert manifest["cases"]["1900-01-01T01:00:00"] == {
+            "status": "done", "file": "fogdb-19000101-0100.parquet",
+            "rows": 7}
+    with pytest.raises(ValueError):
+        db.store(tmp_path / "elsewhere")
+    db.store(tmp_path / "fogdb")
+    with (tmp_path / "fogdb" / "_manifest.json").open("r") as fp:
+        assert json.load(fp)["complete"]
+    df = pandas.read_parquet(tmp_path / "fogdb")
+    assert df.shape == (12, 1)
+    assert df.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
+
+
 class TestABI:
     @staticmethod
     def _get_fake_paths(abi, old=False, bad=False, tp="local"):
@@ -483,18 +787,85 @@ class TestABI:
                 df.index.get_level_values("DATE"),
                 pandas.DatetimeIndex([pt, pt]))
 
+    def test_extract_lazy(self, abi, ts, fakearea):
+        import dask
+        sc = _mk_fakescene_realarea(
+            fakearea,
+            datetime.datetime(1899, 12, 31, 23, 55),
+            "raspberry", "banana")
+        sc["banana"] = sc["banana"].copy(data=sc["banana"].data.rechunk(2))
+        abi.load = unittest.mock.MagicMock()
+        abi.load.return_value = sc
+        (lons, lats) = fakearea.get_lonlats()
+        lats = numpy.array([lats[1, 2], lats[3, 3], 0])
+        lons = numpy.array([lons[1, 2], lons[3, 3], 0])
+        with unittest.mock.patch("dask.compute",
+                                 wraps=dask.compute) as dc:
+            df = abi.extract(ts, lats, lons)
+            dc.assert_called_once()
+        numpy.testing.assert_array_equal(df["raspberry"], [7, 18, numpy.nan])
+        numpy.testing.assert_array_equal(df["banana"], [7, 18, numpy.nan])
+
+    def test_get_scan_time(self, abi, ts):
+        assert abi.get_scan_time(ts) == ts
+        st = ts - pandas.Timedelta(20, "s")
+        for f in _gen_abi_dst(abi, range(1, 17), st, st):
+            p = pathlib.Path(f)
+            p.parent.mkdir(exist_ok=True, parents=True)
+            p.touch()
+        assert abi.get_scan_time(ts) == st
+
     def test_str(self, abi):
         assert str(abi) == "[fogdb component ABI]"
 
+    def test_extract_shared(self, abi, ts, fakearea):
+        chans = abi._get_channels()
+        sc = _mk_fakescene_realarea(
+                fakearea,
+                datetime.datetime(1899, 12, 31, 23, 55),
+                *chans, "cmic_reff")
+        sc.load = unittest.mock.MagicMock()
+        abi.load = unittest.mock.MagicMock()
+        df = abi.extract(ts, numpy.array([10, 10]), numpy.array([-85, -84]),
+                         scene=sc)
+        abi.load.assert_not_called()
+        sc.load.assert_called_once_with(chans, unload=False)
+        assert sorted(df.columns) == sorted(chans)
+        assert "cmic_reff" in sc
+
 
 class TestICON:
-    @unittest.mock.patch("fogtools.sky.get_and_send", autospec=True)
+    @unittest.mock.patch("fogtools.sky.get_and_send_many", autospec=True)
     def test_store(self, fsg, icon, ts, tmp_path, caplog):
         fsg.return_value = [tmp_path / "pear"]
         with caplog.at_level(logging.INFO):
             icon.store(ts)
             assert ("Retrieving ICON from SKY for 1900-01-01 00:00"
                     in caplog.text)
+        fsg.assert_called_once_with(icon.base, [ts], crop=None, margin=1.0,
+                                    runner=None)
+        fsg.reset_mock()
+        tss = [ts, ts + pandas.Timedelta(1, "days")]
+        with caplog.at_level(logging.INFO):
+            icon.store_many(iter(tss))
+            assert "Retrieving ICON from SKY for 2 cases" in caplog.text
+        fsg.assert_called_once_with(icon.base, tss, crop=None, margin=1.0,
+                                    runner=None)
+
+    def test_ensure_concurrent(self, icon, ts):
+        import concurrent.futures
+        import time
+        f = icon.find(ts).pop()
+
+        def fake_store(t):
+            time.sleep(0.1)
+            f.parent.mkdir(parents=True, exist_ok=True)
+            f.touch()
+        icon.store = unittest.mock.MagicMock(side_effect=fake_store)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as ex:
+            for fut in [ex.submit(icon.ensure, ts) for _ in range(3)]:
+                fut.result()
+        icon.store.assert_called_once_with(ts)
 
     # concrete methods from parent class
     def test_find(self, icon, ts):
@@ -514,6 +885,14 @@ class TestICON:
         assert icon.find(t1, complete=True)
         assert icon.find(t1, complete=True) == {p2}
         assert icon.find(t2, complete=True) == {p2}
+        # existence is remembered
+        with unittest.mock.patch("pathlib.Path.exists") as pe:
+            assert icon.find(t1, complete=True) == {p2}
+            pe.assert_not_called()
+        assert icon.find(pandas.Timestamp("1900-01-01T07:00:00"),
+                         complete=False) == {
+                icon.base / "import" / "NWP_data" /
+                "S_NWC_NWP_1900-01-01T06:00:00Z_001.grib"}
 
     @unittest.mock.patch("satpy.Scene", autospec=True)
     @unittest.mock.patch("fogtools.sky.send_to_sky", autospec=True)
@@ -536,6 +915,79 @@ class TestICON:
                 reader="grib")
         assert icon.find(t, complete=True)
 
+    def test_extract(self, icon, monkeypatch):
+        import fogtools.db
+        eccodes = pytest.importorskip("eccodes")
+        t = pandas.Timestamp("1900-01-01T01:23:45")
+        f = icon.find(t)
+        f = f.pop()
+        f.parent.mkdir(parents=True)
+        # 1° grid covering 30-60°N, 90-60°W, fields linear in lat and lon
+        (lat, lon) = numpy.meshgrid(numpy.linspace(60, 30, 31),
+                                    numpy.linspace(270, 300, 31),
+                                    indexing="ij")
+        h = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+        for (k, v) in [("Ni", 31), ("Nj", 31),
+                       ("latitudeOfFirstGridPointInDegrees", 60.),
+                       ("longitudeOfFirstGridPointInDegrees", 270.),
+                       ("latitudeOfLastGridPointInDegrees", 30.),
+                       ("longitudeOfLastGridPointInDegrees", 300.),
+                       ("iDirectionIncrementInDegrees", 1.),
+                       ("jDirectionIncrementInDegrees", 1.),
+                       ("jScansPositively", 0)]:
+            eccodes.codes_set(h, k, v)
+        with f.open("wb") as fp:
+            for (sn, tol, lev) in [("2t", "heightAboveGround", 2),
+                                   ("t", "isobaricInhPa", 500),
+                                   ("t", "isobaricInhPa", 850),
+                                   ("t", "isobaricInhPa", 850),
+                                   ("u", "isobaricInhPa", 500)]:
+                eccodes.codes_set(h, "shortName", sn)
+                eccodes.codes_set(h, "typeOfLevel", tol)
+                eccodes.codes_set(h, "level", lev)
+                eccodes.codes_set_values(
+                        h, (lat*100 + lon + lev/1000).ravel())
+                eccodes.codes_write(h, fp)
+        eccodes.codes_release(h)
+        icon.ensure = unittest.mock.MagicMock()
+        icon.extract_fields = {"2t", "t"}
+        lats = numpy.array([42.5, 45.25, 30, 10])
+        lons = numpy.array([-71.5, -80.75, -60, -70])
+        with unittest.mock.patch("fogtools.db._get_bilinear_weights",
+                                 wraps=fogtools.db._get_bilinear_weights) \
+                as gbw:
+            df = icon.extract(t, lats, lons)
+            icon.extract(t, lats, lons)
+            gbw.assert_called_once()
+        assert list(df.columns) == ["2t", "t_500", "t_850"]
+        assert df.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
+        numpy.testing.assert_array_equal(df.index.get_level_values(
+            "LATITUDE"), lats)
+        assert (df.index.get_level_values("DATE") ==
+                pandas.Timestamp("2007-03-23T12:00")).all()
+        for (c, lev) in [("2t", 2), ("t_500", 500), ("t_850", 850)]:
+            numpy.testing.assert_allclose(
+                    df[c], [*(lats[:3]*100 + lons[:3] % 360 + lev/1000),
+                            numpy.nan])
+        monkeypatch.setattr(fogtools.db, "eccodes", None)
+        with unittest.mock.patch("fogtools.db._DB.extract") as fdDe:
+            icon.extract(t, lats, lons)
+            fdDe.assert_called_once_with(t, lats, lons)
+
+
+def test_bilinear_weights():
+    from fogtools.db import _get_bilinear_weights
+    # global grid, 90°N to 90°S, 0 to 359°E
+    grid = (90., 0., -1., 1., 181, 360)
+    (idx, w) = _get_bilinear_weights(
+            grid, numpy.array([89.5, -90, 0]), numpy.array([359.5, 0, -0.25]))
+    numpy.testing.assert_array_equal(idx[0], [359, 0, 719, 360])
+    numpy.testing.assert_allclose(w[0], [.25, .25, .25, .25])
+    numpy.testing.assert_allclose(w[1], [0, 0, 1, 0])
+    numpy.testing.assert_array_equal(idx[2] // 360, [90, 90, 91, 91])
+    numpy.testing.assert_array_equal(idx[2] % 360, [359, 0, 359, 0])
+    numpy.testing.assert_allclose(w[2], [.25, .75, 0, 0])
+
 
 class TestNWCSAF:
     def test_init(self, nwcsaf):
@@ -613,11 +1065,22 @@ class TestNWCSAF:
                                  / "OR_ABI-L1b-RadF-M3C03_G16_"
                                    "s18993652355000_e19000010010000_"
                                    "c19000010020000.nc")
-        exp.unlink()
+        # existing link to same file is shared silently
+        with caplog.at_level(logging.WARNING):
+            nwcsaf.link(abi, pandas.Timestamp("1900-01-01T00:05:00"))
+            assert "Src already exists" not in caplog.text
+        nwcsaf.release(ts)
+        assert exp.is_symlink()
+        nwcsaf.release(pandas.Timestamp("1900-01-01T00:05:00"))
+        assert not exp.exists()
+        assert not exp.is_symlink()
         exp.touch()
         with caplog.at_level(logging.WARNING):
             nwcsaf.link(abi, ts)
             assert "Src already exists" in caplog.text
+        # files that are not our links are left alone
+        nwcsaf.release(ts)
+        assert exp.exists()
         t2 = pandas.Timestamp("1900-01-01T01:23:45")
         out = (icon.base / "import" / "NWP_data" /
                "S_NWC_NWP_1900-01-01T00:00:00Z_001.grib")
@@ -629,10 +1092,16 @@ class TestNWCSAF:
         assert exp.is_symlink()
         assert (exp.resolve() == out)
 
-    @unittest.mock.patch("time.sleep", autospec=True)
-    def test_wait_for_output(self, tisl, nwcsaf, monkeypatch, tmp_path):
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_wait_for_output(self, nwcsaf, monkeypatch, tmp_path,
+                             use_inotify):
         import fogtools.db
-        monkeypatch.setenv("SAFNWC", str(tmp_path))
+        if not use_inotify:
+            monkeypatch.setattr(fogtools.db, "inotify_simple", None)
+        elif fogtools.db.inotify_simple is None:
+            pytest.skip("inotify_simple not available")
+        nwcsaf._watcher = fogtools.db._NWCSAFWatcher(
+                nwcsaf.base, interval=0.05)
         nwcsaf.is_running = unittest.mock.MagicMock()
         nwcsaf.is_running.return_value = False
         with pytest.raises(fogtools.db.FogDBError):
@@ -643,34 +1112,77 @@ class TestNWCSAF:
         p.parent.mkdir(exist_ok=True, parents=True)
         p.touch()
         nwcsaf.is_running.return_value = True
-        nwcsaf.wait_for_output(t, timeout=20)
-        assert tisl.call_count == 0
+        assert nwcsaf.wait_for_output(t, timeout=20) == {p}
+        t = pandas.Timestamp("1900-01-01T01:00:00")
         log = (nwcsaf.base / "export" / "LOG" / "S_NWC_LOG_GOES16_NEW_ENGLAND"
-               "_18991231T235110Z.log")
+               "_19000101T005110Z.log")
         log.parent.mkdir(exist_ok=True)
-        p.unlink()
         # test case where logfile not found
-        with pytest.raises(fogtools.db.FogDBError):
-            nwcsaf.wait_for_output(t, timeout=20)
-            # reached time.sleep
-            assert tisl.call_count == 2
-        tisl.reset_mock()
+        with pytest.raises(fogtools.db.FogDBError, match="No SAFNWC result"):
+            nwcsaf.wait_for_output(t, timeout=0.2)
         fp = log.open(mode="wt", encoding="ascii")
         fp.write("Grand opening\n")
         fp.flush()
-        with pytest.raises(fogtools.db.FogDBError):
+        with pytest.raises(fogtools.db.FogDBError, match="No SAFNWC result"):
             # test case where logfile found, but without error text
-            nwcsaf.wait_for_output(t, timeout=20)
-            # reached time.sleep
-            assert tisl.call_count == 2
+            nwcsaf.wait_for_output(t, timeout=0.2)
         fp.write("Error opening\n")
         fp.flush()
-        tisl.reset_mock()
-        with pytest.raises(fogtools.db.FogDBError):
+        with pytest.raises(fogtools.db.FogDBError, match="error opening"):
             # test case where logfile contains error text
             nwcsaf.wait_for_output(t, timeout=20)
-            # did not reach time.sleep
-            assert tisl.call_count == 0
+        fp.close()
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_watch_output_incomplete(self, nwcsaf, monkeypatch,
+                                     use_inotify):
+        import time
+        import fogtools.db
+        if not use_inotify:
+            monkeypatch.setattr(fogtools.db, "inotify_simple", None)
+        elif fogtools.db.inotify_simple is None:
+            pytest.skip("inotify_simple not available")
+        nwcsaf._watcher = fogtools.db._NWCSAFWatcher(
+                nwcsaf.base, interval=0.2)
+        t = pandas.Timestamp("1900-01-01T00:00:00")
+        fut = nwcsaf.watch_output(t, timeout=20)
+        p = (nwcsaf.base / "export" / "CMIC" / "S_NWC_CMIC_GOES16_NEW-ENGLAND-"
+             "NR_18991231T235110Z.nc")
+        p.parent.mkdir(exist_ok=True, parents=True)
+        with p.open(mode="wb") as fp:
+            # still being written
+            for _ in range(25):
+                fp.write(b"x")
+                fp.flush()
+                time.sleep(0.02)
+                assert not fut.done()
+            if use_inotify:
+                # not closed yet
+                time.sleep(0.5)
+                assert not fut.done()
+        assert fut.result(timeout=5) == {p}
+
+    def test_watch_output_many(self, nwcsaf):
+        import fogtools.db
+        nwcsaf._watcher = fogtools.db._NWCSAFWatcher(
+                nwcsaf.base, interval=0.05)
+        tss = [pandas.Timestamp("1900-01-01T00:00:00") +
+               pandas.Timedelta(i, "hours") for i in range(3)]
+        futs = [nwcsaf.watch_output(t, timeout=20) for t in tss]
+        assert not any(f.done() for f in futs)
+        d = nwcsaf.base / "export" / "CMIC"
+        d.mkdir(exist_ok=True, parents=True)
+        ps = [d / ("S_NWC_CMIC_GOES16_NEW-ENGLAND-NR_"
+                   f"{t - pandas.Timedelta(9, 'minutes'):%Y%m%dT%H%M%S}Z.nc")
+              for t in tss]
+        for p in ps[::-1]:
+            p.touch()
+        assert [f.result(timeout=5) for f in futs] == [{p} for p in ps]
+        # watcher thread stops when there is nothing left to wait for
+        thread = nwcsaf._watcher._thread
+        if thread is not None:
+            thread.join(timeout=5)
+        assert nwcsaf._watcher._thread is None
 
     def test_ensure(self, nwcsaf, ts, fake_process):
         nwcsaf.wait_for_output = unittest.mock.MagicMock()
@@ -685,6 +1197,67 @@ class TestNWCSAF:
         nwcsaf.ensure(ts)
         nwcsaf.start_running.assert_called_once_with()
 
+    def test_ensure_many(self, nwcsaf, caplog):
+        import fogtools.db
+        tss = [pandas.Timestamp("1900-01-01T00:00:00") +
+               pandas.Timedelta(i, "hours") for i in range(4)]
+        nwcsaf._watcher = fogtools.db._NWCSAFWatcher(
+                nwcsaf.base, interval=0.05)
+        nwcsaf.is_running = unittest.mock.MagicMock(return_value=False)
+        nwcsaf.start_running = unittest.mock.MagicMock()
+
+        def mkout(t):
+            p = (nwcsaf.base / "export" / "CMIC" /
+                 "S_NWC_CMIC_GOES16_NEW-ENGLAND-NR_"
+                 f"{t - pandas.Timedelta(9, 'minutes'):%Y%m%dT%H%M%S}Z.nc")
+            p.parent.mkdir(exist_ok=True, parents=True)
+            p.touch()
+            return p
+
+        def fake_ensure_deps(t):
+            if t == tss[1]:
+                raise fogtools.db.FogDBError("No ABI today")
+            mkout(t)
+        nwcsaf.ensure_deps = unittest.mock.MagicMock(
+                side_effect=fake_ensure_deps)
+        # output already there, not processed again
+        p = mkout(tss[3])
+        with caplog.at_level(logging.ERROR):
+            res = dict(nwcsaf.ensure_many(tss, timeout=20))
+            assert ("Could not prepare NWCSAF inputs for 1900-01-01 01:00"
+                    in caplog.text)
+        assert res.keys() == set(tss)
+        assert nwcsaf.ensure_deps.call_count == 3
+        nwcsaf.is_running.assert_called_once_with()
+        nwcsaf.start_running.assert_called_once_with()
+        assert len(res[tss[0]].result()) == 1
+        assert len(res[tss[2]].result()) == 1
+        assert res[tss[3]].result() == {p}
+        assert not nwcsaf._staged
+        with pytest.raises(fogtools.db.FogDBError, match="No ABI today"):
+            res[tss[1]].result()
+
+    def test_stage_bounded(self, nwcsaf, ts):
+        import concurrent.futures
+        nwcsaf.max_staged = 2
+        nwcsaf.ensure_deps = unittest.mock.MagicMock()
+        tss = [ts + pandas.Timedelta(i, "hours") for i in range(3)]
+        nwcsaf._stage(tss[0])
+        nwcsaf._stage(tss[1])
+        nwcsaf._stage(tss[1])  # already staged, does not wait
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            fut = executor.submit(nwcsaf._stage, tss[2])
+            with pytest.raises(concurrent.futures.TimeoutError):
+                fut.result(timeout=0.2)
+            nwcsaf.release(tss[0])
+            fut.result(timeout=5)
+        assert nwcsaf._staged.keys() == {tss[1], tss[2]}
+        nwcsaf.ensure_deps.side_effect = OSError
+        nwcsaf.release(tss[1])
+        with pytest.raises(OSError):
+            nwcsaf._stage(tss[0])
+        assert nwcsaf._staged.keys() == {tss[2]}
+
     def test_find_log(self, nwcsaf, ts, tmp_path):
         nwcsaf.base = tmp_path
         logdir = tmp_path / "export" / "LOG"
@@ -719,6 +1292,7 @@ class TestSYNOP:
     @unittest.mock.patch("fogtools.isd.read_db", autospec=True)
     @unittest.mock.patch("fogtools.isd.create_db", autospec=True)
     def test_load(self, fic, fir, synop, ts, fake_df, tmp_path, monkeypatch):
+        import fogtools.db
         monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
         fir.return_value = fake_df
 
@@ -736,11 +1310,30 @@ class TestSYNOP:
         assert sel.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
         sel2 = synop.load(ts, tol=pandas.Timedelta("31min"))
         assert sel.equals(sel2)
-        synop._db = None
+        # shared between instances
+        synop2 = _dbprep(tmp_path, "_SYNOP")
+        sel2 = synop2.load(ts, tol=pandas.Timedelta("31min"))
+        assert sel.equals(sel2)
+        fir.assert_called_once()
+        fogtools.db._ground_table.clear()
         fir.return_value = fake_df.reset_index()
         sel3 = synop.load(ts, tol=pandas.Timedelta("31min"))
         assert sel.equals(sel3)
+        assert fir.call_count == 2
         fic.assert_called_once_with()  # should not have been called twice
+        # edges of the window are inclusive
+        sel4 = synop.load(ts, tol=pandas.Timedelta("30min"))
+        assert sel4.shape == (9, 1)
+        assert sel4.index.get_level_values("DATE")[0] == pandas.Timestamp(
+                "18991231T2330")
+        assert sel4.index.get_level_values("DATE")[-1] == pandas.Timestamp(
+                "19000101T0030")
+        # re-read when database changes
+        st = (tmp_path / "fogtools" / "store.parquet").stat()
+        os.utime(tmp_path / "fogtools" / "store.parquet",
+                 ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        synop.load(ts)
+        assert fir.call_count == 3
 
     @unittest.mock.patch("fogtools.isd.create_db", autospec=True)
     def test_store(self, fic, synop):
@@ -780,6 +1373,52 @@ class TestDEM:
         sc2 = dem.load(ts)
         assert {did["name"] for did in sc2.keys()} == {"dem"}
 
+    def test_extract(self, dem, ts, tmp_path, fakearea):
+        from fogtools.db import _DEM
+        dem.base = tmp_path
+        dem.location = tmp_path / "fakedem.tif"
+        dem.location.touch()
+        sc = _mk_fakescene_realarea(
+            fakearea,
+            datetime.datetime(1899, 12, 31, 23, 55),
+            "dem")
+        dem.load = unittest.mock.MagicMock()
+        dem.load.return_value = sc
+        (lons, lats) = fakearea.get_lonlats()
+        lats = numpy.array([lats[1, 2], lats[3, 3]])
+        lons = numpy.array([lons[1, 2], lons[3, 3]])
+        df = dem.extract(ts, lats, lons)
+        numpy.testing.assert_array_equal(df["dem"], [7, 18])
+        assert df.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
+        assert df.index.get_level_values("DATE").isna().all()
+        dem.load.assert_called_once()
+        # known stations in different order, no reload
+        df = dem.extract(ts, lats[::-1], lons[::-1])
+        numpy.testing.assert_array_equal(df["dem"], [18, 7])
+        dem.load.assert_called_once()
+        # new station triggers a load for that station only
+        df = dem.extract(ts, numpy.append(lats, 0), numpy.append(lons, 0))
+        numpy.testing.assert_array_equal(df["dem"], [7, 18, numpy.nan])
+        assert dem.load.call_count == 2
+        # a new instance uses the cache on disk
+        dem2 = _DEM("new-england")
+        dem2.base = dem.base
+        dem2.location = dem.location
+        dem2.load = unittest.mock.MagicMock()
+        df = dem2.extract(ts, lats, lons)
+        numpy.testing.assert_array_equal(df["dem"], [7, 18])
+        dem2.load.assert_not_called()
+        # unless the DEM changed
+        os.utime(dem.location, (os.stat(dem.location).st_atime,
+                                os.stat(dem.location).st_mtime + 60))
+        dem3 = _DEM("new-england")
+        dem3.base = dem.base
+        dem3.location = dem.location
+        dem3.load = unittest.mock.MagicMock()
+        dem3.load.return_value = sc
+        dem3.extract(ts, lats, lons)
+        dem3.load.assert_called_once()
+
 
 class TestFog:
     def test_find(self, fog, ts):
@@ -787,12 +1426,117 @@ class TestFog:
         assert p == {fog.base / "fog-19000101-0000.tif"}
         assert fog.find(pandas.Timestamp("2050-03-04"), complete=True) == set()
 
+    @staticmethod
+    def _fake_save(name, filename, **kwargs):
+        pathlib.Path(filename).write_bytes(b"II*\0")
+
     @unittest.mock.patch("fogtools.core.get_fog")
     def test_store(self, cg, fog, abi, ts):
+        fog.get_scene = unittest.mock.MagicMock()
+        fog.base.mkdir(parents=True, exist_ok=True)
+        cg.return_value.save_dataset.side_effect = self._fake_save
         fog.store(ts)
-        cg.return_value.save_dataset\
-          .assert_called_once_with(
-                   "fls_day", str(fog.base / "fog-19000101-0000.tif"))
+        assert cg.call_args.kwargs["scene"] is fog.get_scene.return_value
+        fog.get_scene.assert_called_once_with(ts)
+        cg.return_value.save_dataset.assert_called_once_with(
+                "fls_day", unittest.mock.ANY,
+                writer="geotiff", tiled=True, blockxsize=256,
+                blockysize=256, compress="DEFLATE", overviews=[])
+        tmp = pathlib.Path(cg.return_value.save_dataset.call_args.args[1])
+        assert tmp.parent == fog.base
+        assert tmp.name.startswith(".fog-19000101-0000.tif.")
+        assert tmp.suffix == ".tif"
+        assert fog.find(ts, complete=True)
+        assert [p.name for p in fog.base.iterdir()] == [
+                "fog-19000101-0000.tif"]
+        cg.return_value.save_dataset.side_effect = OSError
+        with pytest.raises(OSError):
+            fog.store(ts + pandas.Timedelta(10, "minutes"))
+        assert not fog.find(ts + pandas.Timedelta(10, "minutes"),
+                            complete=True)
+
+    def test_extract(self, fog, ts, fakearea, caplog):
+        fog.base.mkdir(parents=True, exist_ok=True)
+        fog._calc = unittest.mock.MagicMock()
+        fog._calc.return_value = _mk_fakescene_realarea(
+            fakearea,
+            datetime.datetime(1899, 12, 31, 23, 55),
+            "fls_day", "fls_day_extra")
+        fog._calc.return_value.save_dataset = unittest.mock.MagicMock(
+                side_effect=self._fake_save)
+        fog.load = unittest.mock.MagicMock()
+        lats = numpy.array([10, 10])
+        lons = numpy.array([-85, -84])
+        df = fog.extract(ts, lats, lons)
+        fog.load.assert_not_called()
+        assert list(df.columns) == ["fog"]
+        assert df.shape == (2, 1)
+        fog.wait_for_writes()
+        assert fog.find(ts, complete=True)
+        # existing GeoTIFF is used rather than calculating again
+        fog.load.return_value = _mk_fakescene_realarea(
+            fakearea,
+            datetime.datetime(1899, 12, 31, 23, 55),
+            "fog")
+        df2 = fog.extract(ts, lats, lons)
+        fog._calc.assert_called_once_with(ts)
+        fog.load.assert_called_once_with(ts)
+        assert list(df2.columns) == ["fog"]
+        # writing is optional and failures are logged, not raised
+        t2 = ts + pandas.Timedelta(10, "minutes")
+        fog._save = unittest.mock.MagicMock(side_effect=OSError("disk full"))
+        fog.extract(t2, lats, lons)
+        with caplog.at_level(logging.ERROR):
+            fog.wait_for_writes()
+        assert "Failed to write fog GeoTIFF for 1900-01-01 00:10" in \
+            caplog.text
+        fog.write_geotiff = False
+        fog._save.reset_mock()
+        fog.extract(t2, lats, lons)
+        fog.wait_for_writes()
+        fog._save.assert_not_called()
+
+    @unittest.mock.patch("fogtools.core.get_area")
+    def test_extract_cropped(self, cga, fog, ts, fakearea):
+        cga.return_value = fakearea
+        fog.crop_to_stations = True
+        fog.crop_margin = 0
+        fog._save = unittest.mock.MagicMock()
+        fog._calc = unittest.mock.MagicMock()
+        fog._calc.return_value = _mk_fakescene_realarea(
+            fakearea,
+            datetime.datetime(1899, 12, 31, 23, 55),
+            "fls_day")
+        fog.extract(ts, numpy.array([10, 10]), numpy.array([-85, -84]))
+        cga.assert_called_once_with("new-england-500")
+        area = fog._calc.call_args.args[1]
+        (x, y) = fakearea.get_xy_from_lonlat([-85, -84], [10, 10])
+        assert area.shape == (y.ptp()+1, x.ptp()+1)
+        assert area.shape != fakearea.shape
+        fog.wait_for_writes()
+        fog._save.assert_not_called()
+
+    @unittest.mock.patch("satpy.Scene")
+    def test_get_scene(self, sS, fog, ts):
+        (sat, cmic) = (fog.dependencies["sat"], fog.dependencies["cmic"])
+        for dep in (sat, cmic):
+            dep.ensure = unittest.mock.MagicMock()
+            dep.find = unittest.mock.MagicMock()
+        sat.find.return_value = {fog.base / "abi.nc"}
+        cmic.find.return_value = {fog.base / "cmic.nc"}
+        sc = fog.get_scene(ts)
+        assert sc is sS.return_value
+        sS.assert_called_once_with(filenames={
+            "abi_l1b": {str(fog.base / "abi.nc")},
+            "nwcsaf-geo": {str(fog.base / "cmic.nc")}})
+        cmic.ensure.assert_called_once_with(ts)
+        assert fog.get_scene(ts) is sc
+        assert sS.call_count == 1
+        fog.get_scene(ts + pandas.Timedelta(10, "minutes"))
+        assert sS.call_count == 2
+        fog.release_scene()
+        fog.get_scene(ts + pandas.Timedelta(10, "minutes"))
+        assert sS.call_count == 3
 
     def test_load(self, fog, ts, fakearea):
         fs = _mk_fakescene_realarea(
@@ -805,8 +1549,60 @@ class TestFog:
         assert {did["name"] for did in sc.keys()} == {"fog"}
 
 
-def test_contact_mi_dfs():
-    from fogtools.db import _concat_mi_df_with_date
+def test_crop_area_to_points(fakearea):
+    from fogtools.db import _crop_area_to_points, FogDBError
+    lats = numpy.array([10, 10, 30, 89.9])
+    lons = numpy.array([-85, -84, -70, 0])
+    (x, y) = fakearea.get_xy_from_lonlat(lons[:3], lats[:3])
+    ar = _crop_area_to_points(fakearea, lats, lons, 0)
+    assert ar.shape == (y.max()-y.min()+1, x.max()-x.min()+1)
+    (x2, y2) = ar.get_xy_from_lonlat(lons[:3], lats[:3])
+    numpy.testing.assert_array_equal(x2, x - x.min())
+    numpy.testing.assert_array_equal(y2, y - y.min())
+    # margin of one pixel, clipped at area edges
+    ar = _crop_area_to_points(fakearea, lats, lons, 1)
+    assert ar.shape == (min(y.max()+2, 5) - max(y.min()-1, 0),
+                        min(x.max()+2, 5) - max(x.min()-1, 0))
+    ar = _crop_area_to_points(fakearea, lats, lons, 1e8)
+    assert ar.shape == fakearea.shape
+    with pytest.raises(FogDBError):
+        _crop_area_to_points(fakearea, lats[3:], lons[3:], 0)
+
+
+def test_pixel_index_cache(fakearea):
+    from fogtools.db import _PixelIndexCache
+    pic = _PixelIndexCache(max_entries=2)
+    lons = numpy.array([-89.5, -70, 0])
+    lats = numpy.array([0, 40, 0])
+    (x_exp, y_exp) = fakearea.get_xy_from_lonlat(lons, lats)
+    with unittest.mock.patch.object(
+            fakearea, "get_xy_from_lonlat",
+            wraps=fakearea.get_xy_from_lonlat) as fag:
+        (x, y) = pic.get_xy_from_lonlat(fakearea, lons, lats)
+        (x2, y2) = pic.get_xy_from_lonlat(fakearea, lons, lats)
+        fag.assert_called_once()
+        assert x2 is x
+        # a new cache object should get it from disk
+        pic2 = _PixelIndexCache()
+        (x3, y3) = pic2.get_xy_from_lonlat(fakearea, lons, lats)
+        fag.assert_called_once()
+        pic.get_xy_from_lonlat(fakearea, lons[:2], lats[:2])
+        pic.get_xy_from_lonlat(fakearea, lons[1:], lats[1:])
+        assert len(pic._cache) == 2
+        assert fag.call_count == 3
+    for (a, b) in ((x, x_exp), (y, y_exp), (x3, x_exp), (y3, y_exp)):
+        numpy.testing.assert_array_equal(a, b)
+        numpy.testing.assert_array_equal(
+                numpy.ma.getmaskarray(a), numpy.ma.getmaskarray(b))
+    assert len(list(pic.get_cache_dir().glob("*.npz"))) == 3
+    m = unittest.mock.MagicMock()
+    pic.get_xy_from_lonlat(m, lons, lats)
+    pic.get_xy_from_lonlat(m, lons, lats)
+    assert m.get_xy_from_lonlat.call_count == 2
+
+
+def test_assemble_columns():
+    from fogtools.db import _assemble_columns, FogDBError
     mix1 = pandas.MultiIndex.from_arrays(
             [pandas.DatetimeIndex(
                 ["1899-12-31T23:50:00"]*5 +
@@ -840,7 +1636,7 @@ def test_contact_mi_dfs():
             {"coconut": numpy.arange(10)/2,
              "walnut": numpy.arange(10)*10},
             index=mix3)
-    dfm = _concat_mi_df_with_date(df1, df2=df2, df3=df3)
+    dfm = _assemble_columns(df1, df2=df2, df3=df3)
     assert dfm.index.nlevels == 3
     assert dfm.index.names == ["DATE", "LATITUDE", "LONGITUDE"]
     numpy.testing.assert_array_equal(
@@ -848,3 +1644,12 @@ def test_contact_mi_dfs():
             ["aubergine", "banana", "date_df2", "raspberry", "strawberry",
              "date_df3", "coconut", "walnut"])
     assert dfm.shape == (10, 8)
+    assert dfm.index.equals(mix1)
+    numpy.testing.assert_array_equal(dfm["date_df2"], mix2.get_level_values(
+        "DATE"))
+    numpy.testing.assert_array_equal(dfm["walnut"], numpy.arange(10)*10)
+    with pytest.raises(FogDBError, match="Stations for df2 do not match"):
+        _assemble_columns(df1, df2=df2.iloc[::-1], df3=df3)
+    with pytest.raises(FogDBError, match="Repeated column"):
+        _assemble_columns(df1, df2=df2, df3=df3.rename(
+            columns={"coconut": "banana"}))
@@ -11,16 +11,19 @@ import pytest
 def test_get_parser(ap):
     import fogtools.processing.get_nwp
     fogtools.processing.get_nwp.get_parser()
-    assert ap.return_value.add_argument.call_count == 1
+    assert ap.return_value.add_argument.call_count == 5
 
 
 @patch("fogtools.processing.get_nwp.get_parser", autospec=True)
-@patch("subprocess.run", autospec=True)
+@patch("fogtools.sky.send_to_sky_async", autospec=True)
 def test_main(sr, fpgg, tmpdir):
     import fogtools.processing.get_nwp
     from fogtools.sky import SkyFailure
-    fpgg.return_value.parse_args.return_value.date = pandas.Period(
-            "19000101120000")
+    fpgg.return_value.parse_args.return_value.dates = [pandas.Period(
+            "19000101120000")]
+    fpgg.return_value.parse_args.return_value.crop = None
+    fpgg.return_value.parse_args.return_value.jobs = 2
+    fpgg.return_value.parse_args.return_value.timeout = None
     os.environ.pop("SAFNWC", None)
     with pytest.raises(SystemExit):
         fogtools.processing.get_nwp.main()
@@ -30,4 +33,4 @@ def test_main(sr, fpgg, tmpdir):
     with pytest.raises(SkyFailure):
         fogtools.processing.get_nwp.main()
     fpgg.assert_called_once_with()
-    sr.assert_called_once()
+    sr.assert_awaited_once()
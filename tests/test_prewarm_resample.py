@@ -0,0 +1,27 @@
+"""Test the fog-prewarm-resample script
+"""
+
+from unittest.mock import patch
+
+
+@patch("argparse.ArgumentParser", autospec=True)
+def test_get_parser(ap):
+    import fogtools.processing.prewarm_resample
+    fogtools.processing.prewarm_resample.get_parser()
+    assert ap.return_value.add_argument.call_count == 5
+
+
+@patch("fogtools.core.prewarm_resample_cache", autospec=True)
+def test_main(fcp):
+    import fogtools.processing.prewarm_resample
+    from fogtools.core import get_pkg_area_names
+    with patch("sys.argv", ["fog-prewarm-resample", "--sensor-files", "a",
+                            "b", "--cloud-files", "c"]):
+        fogtools.processing.prewarm_resample.main()
+    fcp.assert_called_once_with(
+            "abi_l1b", ["a", "b"], "nwcsaf-geo", ["c"], get_pkg_area_names())
+    with patch("sys.argv", ["fog-prewarm-resample", "--sensor-files", "a",
+                            "--cloud-files", "c", "--areas", "fribbulus"]):
+        fogtools.processing.prewarm_resample.main()
+    fcp.assert_called_with(
+            "abi_l1b", ["a"], "nwcsaf-geo", ["c"], ["fribbulus"])
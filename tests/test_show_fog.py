@@ -3,6 +3,8 @@
 
 from unittest.mock import patch, MagicMock
 
+import numpy
+import numpy.testing
 import xarray
 
 
@@ -10,15 +12,16 @@ import xarray
 def test_get_parser(ap):
     import fogtools.processing.show_fog
     fogtools.processing.show_fog.get_parser()
-    assert ap.return_value.add_argument.call_count == 4
+    assert ap.return_value.add_argument.call_count == 7
     assert ap.return_value.add_mutually_exclusive_group.call_count == 2
     assert ap.return_value.add_mutually_exclusive_group.return_value.\
         add_argument.call_count == 4
 
 
+@patch("satpy.writers.compute_writer_results", autospec=True)
 @patch("fogtools.processing.show_fog.parse_cmdline", autospec=True)
 @patch("fogtools.vis.get_fog_blend_for_sat", autospec=True)
-def test_main(fvg, fpsp, tmp_path, xrda):
+def test_main(fvg, fpsp, swc, tmp_path, xrda):
     import fogtools.processing.show_fog
     from satpy import Scene
     fpsp.return_value = fogtools.processing.show_fog.get_parser().parse_args(
@@ -45,7 +48,10 @@ def test_main(fvg, fpsp, tmp_path, xrda):
             ["/no/nwcsaf/files"],
             "fribbulus xax",
             "overview")
-    fvg.return_value[0].save.assert_called_once_with("/no/out/file")
+    fvg.return_value[0].save.assert_called_once_with(
+            "/no/out/file", compute=False)
+    swc.assert_called_once_with([fvg.return_value[0].save.return_value])
+    swc.reset_mock()
     fvg.reset_mock()
     fvg.return_value[0].reset_mock()
     fpsp.return_value = fogtools.processing.show_fog.get_parser().parse_args(
@@ -57,11 +63,16 @@ def test_main(fvg, fpsp, tmp_path, xrda):
     with patch("satpy.Scene", autospec=True) as sS:
         fogtools.processing.show_fog.main()
         fvg.return_value[0].save.assert_called_once_with(
-            str(tmp_path / "fog_blend.tif"))
+            str(tmp_path / "fog_blend.tif"), compute=False)
         sS.return_value.save_datasets.assert_called_once_with(
                 writer="cf",
                 datasets={"a", "b"},
-                filename=str(tmp_path / "intermediates.nc"))
+                filename=str(tmp_path / "intermediates.nc"),
+                compute=False)
+        # all outputs are computed together
+        swc.assert_called_once_with(
+                [fvg.return_value[0].save.return_value,
+                 sS.return_value.save_datasets.return_value])
         fvg.reset_mock()
         fvg.return_value[0].reset_mock()
     fpsp.return_value = fogtools.processing.show_fog.get_parser().parse_args(
@@ -74,4 +85,109 @@ def test_main(fvg, fpsp, tmp_path, xrda):
     fogtools.processing.show_fog.main()
     m_sc.save_datasets.assert_called_once_with(
             filename=str(tmp_path / "{name:s}.tif"),
-            datasets={"raspberry", "banana"})
+            datasets={"raspberry", "banana"},
+            compute=False)
+
+
+def test_expand_paths(tmp_path):
+    from fogtools.processing.show_fog import expand_paths
+    for d in ("a", "b"):
+        (tmp_path / d).mkdir()
+        for i in range(3):
+            (tmp_path / d / f"{d:s}{i:d}.nc").touch()
+    (tmp_path / "a" / "sub").mkdir()
+    assert expand_paths([tmp_path / "a", tmp_path / "b" / "*1.nc",
+                         tmp_path / "a" / "a0.nc",
+                         tmp_path / "nonexistent"]) == [
+        str(tmp_path / "a" / f"a{i:d}.nc") for i in range(3)] + [
+        str(tmp_path / "b" / "b1.nc")]
+
+
+@patch("satpy.writers.compute_writer_results", autospec=True)
+@patch("fogtools.processing.show_fog.parse_cmdline", autospec=True)
+@patch("fogtools.vis.get_fog_blend_for_sat", autospec=True)
+@patch("satpy.readers.group_files", autospec=True)
+def test_main_series(srg, fvg, fpsp, swc, tmp_path, caplog):
+    import datetime
+    import logging
+    import threading
+    import pytest
+    import fogtools.processing.show_fog
+    (tmp_path / "abi").mkdir()
+    for i in range(4):
+        (tmp_path / "abi" / f"abi{i:d}.nc").touch()
+    srg.return_value = [
+            {"abi_l1b": [str(tmp_path / "abi" / f"abi{i:d}.nc")],
+             "nwcsaf-geo": [f"cmic{i:d}.nc"]}
+            for i in range(4)]
+    threads = []
+    ims = []
+
+    def fake_blend(sr, sf, cr, cf, area, bg):
+        threads.append(threading.current_thread().name)
+        i = int(sf[0][-4])
+        if i == 2:
+            raise ValueError("no fog today")
+        sc = MagicMock()
+        sc.start_time = datetime.datetime(2020, 1, 1, 12, 10*i)
+        ims.append(MagicMock())
+        return (ims[-1], sc)
+    fvg.side_effect = fake_blend
+    out = tmp_path / "out"
+    fpsp.return_value = fogtools.processing.show_fog.get_parser().parse_args(
+            [str(out),
+             "--abi", str(tmp_path / "abi"),
+             "--nwcsaf", str(tmp_path / "cmic*"),
+             "-a", "fribbulus xax",
+             "-t", "-j", "2"])
+    with pytest.raises(SystemExit) as e, caplog.at_level(logging.ERROR):
+        fogtools.processing.show_fog.main()
+    assert "Failed for 1 out of 4 time slots" in str(e.value)
+    assert "Failed to process slot with files" in caplog.text
+    srg.assert_called_once_with(
+            [str(tmp_path / "abi" / f"abi{i:d}.nc") for i in range(4)],
+            reader=["abi_l1b", "nwcsaf-geo"], time_threshold=60,
+            group_keys=("start_time",), missing="skip")
+    assert fvg.call_count == 4
+    # first slot on its own, others in worker threads
+    assert not threads[0].startswith("show-fog")
+    assert all(t.startswith("show-fog") for t in threads[1:])
+    assert out.is_dir()
+    assert swc.call_count == 3
+    assert sorted(c.args[0] for im in ims for c in im.save.call_args_list) \
+        == [str(out / f"20200101-12{m:s}.tif") for m in ("00", "10", "30")]
+    fvg.assert_any_call("abi_l1b", [str(tmp_path / "abi" / "abi3.nc")],
+                        "nwcsaf-geo", ["cmic3.nc"], "fribbulus xax",
+                        "overview")
+
+
+def test_save_extras_single_compute(tmp_path, xrda):
+    """Test that fog blend and intermediates are computed in one pass."""
+    import dask
+    import dask.array as da
+    import satpy
+    import satpy.writers
+    from fogtools.processing.show_fog import save_extras
+    ncalls = []
+
+    def count(x):
+        if x.size > 0:  # not for dask meta inference
+            ncalls.append(1)
+        return x
+    base = da.from_array(numpy.arange(25.).reshape(5, 5), chunks=5)
+    expensive = base.map_blocks(count, dtype=base.dtype)
+    sc = satpy.Scene()
+    attrs = dict(xrda[0].attrs)
+    sc["fls_day_extra"] = xarray.Dataset(
+            {"a": xarray.DataArray(expensive + 1, dims=("y", "x"),
+                                   attrs=attrs),
+             "b": xarray.DataArray(expensive * 2, dims=("y", "x"),
+                                   attrs=attrs)})
+    res = save_extras(sc, tmp_path / "intermediates.nc")
+    assert not ncalls
+    with dask.config.set(scheduler="sync"):
+        satpy.writers.compute_writer_results([res])
+    assert len(ncalls) == 1
+    with xarray.open_dataset(tmp_path / "intermediates.nc") as ds:
+        numpy.testing.assert_array_equal(ds["a"], numpy.arange(25.).reshape(
+            5, 5) + 1)
@@ -1,7 +1,11 @@
+import os
 import pathlib
+import time
 import subprocess
 import pytest
 from unittest import mock
+import numpy
+import numpy.testing
 import pandas
 import lxml.etree
 
@@ -193,3 +197,257 @@ def test_get_and_send(sr, period):
     with pytest.raises(SkyFailure):
         get_and_send(pathlib.Path("/tmp/lentils"), period)
     sr.assert_called_once()
+
+
+@pytest.fixture
+def fake_sky(tmp_path, monkeypatch):
+    """Put a stand-in for sky on the PATH.
+
+    It writes each requested GRIB file and records the requests it got.
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    sky = bindir / "sky"
+    sky.write_text(
+        "#!/usr/bin/env python\n"
+        "import sys, re, pathlib\n"
+        "req = sys.stdin.buffer.read()\n"
+        f"with open({str(tmp_path / 'requests.log')!r}, 'ab') as fp:\n"
+        "    fp.write(req + b'\\0')\n"
+        "for f in set(re.findall(rb'name=\"([^\"]*\\.grib)\"', req)):\n"
+        "    pathlib.Path(f.decode()).write_bytes(b'GRIB')\n")
+    sky.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir!s}:{os.environ['PATH']:s}")
+    return tmp_path / "requests.log"
+
+
+def _get_fake_sky_requests(log):
+    if not log.exists():
+        return []
+    return [r for r in log.read_bytes().split(b"\0") if r]
+
+
+def test_plan_icon_retrieval(tmp_path):
+    from fogtools.sky import plan_icon_retrieval, make_icon_nwcsaf_filename
+    t1 = pandas.Timestamp("2020-02-24T13:10")
+    t2 = pandas.Timestamp("2020-02-24T17:40")  # rounds into next analysis
+    steps = plan_icon_retrieval(tmp_path, [t1, t2, t1])
+    a12 = pandas.Timestamp("2020-02-24T12")
+    a18 = pandas.Timestamp("2020-02-24T18")
+    assert steps == [(a12, i) for i in range(6)] + [(a18, i) for i in range(6)]
+    for i in (0, 1, 2):
+        f = make_icon_nwcsaf_filename(tmp_path, a12, i)
+        f.parent.mkdir(parents=True, exist_ok=True)
+        f.write_bytes(b"GRIB")
+    make_icon_nwcsaf_filename(tmp_path, a12, 3).touch()  # empty
+    steps = plan_icon_retrieval(tmp_path, [t1, t2])
+    assert steps == [(a12, i) for i in (3, 4, 5)] + [
+            (a18, i) for i in range(6)]
+
+
+def test_get_and_send_many(tmp_path, fake_sky):
+    from fogtools.sky import get_and_send_many, make_icon_nwcsaf_filename
+    tss = [pandas.Timestamp("2020-02-24T13:10"),
+           pandas.Timestamp("2020-02-25T01:00")]
+    files = get_and_send_many(tmp_path, tss)
+    reqs = _get_fake_sky_requests(fake_sky)
+    assert len(reqs) == 1
+    assert reqs[0].count(b"<sky:read ") == 2*6*3
+    exp = {make_icon_nwcsaf_filename(tmp_path, a, i)
+           for a in (pandas.Timestamp("2020-02-24T12"),
+                     pandas.Timestamp("2020-02-25T00"))
+           for i in range(6)}
+    assert {f for f in files if f.suffix == ".grib"} == exp
+    assert all(f.exists() for f in exp)
+    # everything present: no new request
+    assert get_and_send_many(tmp_path, tss) == set()
+    assert len(_get_fake_sky_requests(fake_sky)) == 1
+    # only the missing file is requested
+    make_icon_nwcsaf_filename(
+            tmp_path, pandas.Timestamp("2020-02-25T00"), 4).unlink()
+    get_and_send_many(tmp_path, tss)
+    reqs = _get_fake_sky_requests(fake_sky)
+    assert len(reqs) == 2
+    assert reqs[1].count(b"<sky:read ") == 3
+    assert b"2020-02-25T00:00:00Z_004.grib" in reqs[1]
+
+
+def test_get_icon_nwcsaf_filename(tmp_path):
+    from fogtools.sky import icon_analysis_step, get_icon_nwcsaf_filename
+    assert icon_analysis_step(pandas.Timestamp("2020-02-24T13:10")) == (
+            pandas.Timestamp("2020-02-24T12"), 1)
+    assert icon_analysis_step(pandas.Timestamp("2020-02-24T17:31")) == (
+            pandas.Timestamp("2020-02-24T18"), 0)
+    assert icon_analysis_step(pandas.Timestamp("2020-02-24T23:29")) == (
+            pandas.Timestamp("2020-02-24T18"), 5)
+    fn = get_icon_nwcsaf_filename(
+            tmp_path, pandas.Timestamp("2020-02-24T16:50"))
+    assert fn == (tmp_path / "import" / "NWP_data" /
+                  "S_NWC_NWP_2020-02-24T12:00:00Z_005.grib")
+    assert not (tmp_path / "import").exists()
+
+
+def _mk_global_grib(f):
+    """Write GRIB file with two messages on a global 1° grid.
+
+    The value at each gridpoint is 1000*lat + lon.
+    """
+    eccodes = pytest.importorskip("eccodes")
+    h = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+    for (k, v) in [("Ni", 360), ("Nj", 181),
+                   ("latitudeOfFirstGridPointInDegrees", 90.),
+                   ("longitudeOfFirstGridPointInDegrees", 0.),
+                   ("latitudeOfLastGridPointInDegrees", -90.),
+                   ("longitudeOfLastGridPointInDegrees", 359.),
+                   ("iDirectionIncrementInDegrees", 1.),
+                   ("jDirectionIncrementInDegrees", 1.),
+                   ("jScansPositively", 0)]:
+        eccodes.codes_set(h, k, v)
+    lats = numpy.linspace(90, -90, 181)[:, numpy.newaxis]
+    lons = numpy.arange(360)[numpy.newaxis, :]
+    eccodes.codes_set_values(h, (lats*1000 + lons).ravel())
+    with open(f, "wb") as fp:
+        eccodes.codes_write(h, fp)
+        eccodes.codes_write(h, fp)
+    eccodes.codes_release(h)
+
+
+def _read_grib(f):
+    import eccodes
+    res = []
+    with open(f, "rb") as fp:
+        while (h := eccodes.codes_grib_new_from_file(fp)) is not None:
+            res.append((eccodes.codes_get_array(h, "latitudes"),
+                        eccodes.codes_get_array(h, "longitudes"),
+                        eccodes.codes_get_values(h)))
+            eccodes.codes_release(h)
+    return res
+
+
+def test_crop_grib(tmp_path):
+    from fogtools.sky import crop_grib
+    f = tmp_path / "global.grib"
+    _mk_global_grib(f)
+    size = f.stat().st_size
+    crop_grib(f, (-80, 35, -60, 50), margin=1)
+    assert f.stat().st_size < size / 50
+    res = _read_grib(f)
+    assert len(res) == 2
+    for (lats, lons, vals) in res:
+        assert lats.size == 18*23
+        assert (lats.min(), lats.max()) == (34, 51)
+        assert (lons.min(), lons.max()) == (279, 301)
+        numpy.testing.assert_allclose(vals, lats*1000 + lons)
+    # box across the grid edge
+    _mk_global_grib(f)
+    crop_grib(f, (-5, 0, 5, 2), margin=0)
+    (lats, lons, vals) = _read_grib(f)[0]
+    assert lats.size == 3*11
+    assert set(lons % 360) == set(range(355, 360)) | set(range(6))
+    numpy.testing.assert_allclose(vals, lats*1000 + lons % 360)
+    with pytest.raises(ValueError):
+        crop_grib(f, (100, 0, 110, 2))
+    assert f.stat().st_size > 0
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_get_and_send_crop(tmp_path, fake_sky, monkeypatch):
+    import fogtools.sky
+    crop = mock.MagicMock()
+    monkeypatch.setattr(fogtools.sky, "crop_grib", crop)
+    files = fogtools.sky.get_and_send(tmp_path, pandas.Period(
+        "20200224120000"), crop=(-80, 35, -60, 50), margin=2)
+    gribs = {f for f in files if f.suffix == ".grib"}
+    assert len(gribs) == 6
+    assert {c.args[0] for c in crop.call_args_list} == gribs
+    crop.assert_called_with(mock.ANY, (-80, 35, -60, 50), 2)
+
+
+def _put_script_on_path(tmp_path, monkeypatch, body):
+    bindir = tmp_path / "bin"
+    bindir.mkdir(exist_ok=True)
+    sky = bindir / "sky"
+    sky.write_text("#!/usr/bin/env python\nimport sys, time, os\n" + body)
+    sky.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir!s}:{os.environ['PATH']:s}")
+
+
+def test_send_to_sky_async(tmp_path, monkeypatch, caplog):
+    import asyncio
+    import logging
+    from fogtools.sky import send_to_sky_async, SkyFailure
+    _put_script_on_path(
+        tmp_path, monkeypatch,
+        "req = sys.stdin.buffer.read()\n"
+        "print('got', len(req), flush=True)\n"
+        "print('complaint', file=sys.stderr, flush=True)\n"
+        "sys.exit(int(req == b'fail'))\n")
+    with caplog.at_level(logging.DEBUG):
+        cp = asyncio.run(send_to_sky_async(b"x" * 100000))
+    assert cp.stdout == b"got 100000\n"
+    assert cp.stderr == b"complaint\n"
+    assert "stdout: got 100000" in caplog.text
+    assert "stderr: complaint" in caplog.text
+    with pytest.raises(subprocess.CalledProcessError), \
+            caplog.at_level(logging.ERROR):
+        asyncio.run(send_to_sky_async(b"fail"))
+    assert "sky call failed with code 1" in caplog.text
+    _put_script_on_path(tmp_path, monkeypatch, "time.sleep(30)\n")
+    t0 = time.monotonic()
+    with pytest.raises(SkyFailure, match="did not finish within 0.2 s"):
+        asyncio.run(send_to_sky_async(b"slow", timeout=0.2))
+    assert time.monotonic() - t0 < 10
+
+
+def test_sky_runner(tmp_path, monkeypatch):
+    import threading
+    from fogtools.sky import SkyRunner
+    running = tmp_path / "running"
+    running.mkdir()
+    # record how many sky processes are running at the same time
+    _put_script_on_path(
+        tmp_path, monkeypatch,
+        f"d = {str(running)!r}\n"
+        "f = os.path.join(d, str(os.getpid()))\n"
+        "open(f, 'w').close()\n"
+        "n = len(os.listdir(d))\n"
+        "time.sleep(0.3)\n"
+        "os.unlink(f)\n"
+        "print(n)\n")
+    with pytest.raises(ValueError):
+        SkyRunner(0)
+    with SkyRunner(max_concurrent=2) as runner:
+        t0 = time.monotonic()
+        futs = [runner.submit(b"req") for _ in range(5)]
+        # the caller is not blocked
+        assert time.monotonic() - t0 < 0.3
+        counts = [int(f.result().stdout) for f in futs]
+        # can also be used from other threads
+        res = []
+        th = threading.Thread(target=lambda: res.append(runner.send(b"")))
+        th.start()
+        th.join()
+    assert max(counts) == 2
+    assert res[0].returncode == 0
+    assert runner._loop is None
+    # first used from another thread, after being closed
+    th = threading.Thread(target=lambda: res.extend(
+        f.result() for f in [runner.submit(b"") for _ in range(3)]))
+    th.start()
+    th.join()
+    runner.close()
+    assert [r.returncode for r in res[1:]] == [0, 0, 0]
+
+
+def test_get_and_send_periods(tmp_path, fake_sky):
+    from fogtools.sky import get_and_send_periods, make_icon_nwcsaf_filename
+    periods = [pandas.Period("20200224120000"),
+               pandas.Period("20200225000000")]
+    files = get_and_send_periods(tmp_path, periods, max_concurrent=2)
+    reqs = _get_fake_sky_requests(fake_sky)
+    assert len(reqs) == 2
+    exp = {make_icon_nwcsaf_filename(tmp_path, p.start_time, i)
+           for p in periods for i in range(6)}
+    assert {f for f in files if f.suffix == ".grib"} == exp
+    assert get_and_send_periods(tmp_path, periods) == set()
+    assert len(_get_fake_sky_requests(fake_sky)) == 2
@@ -0,0 +1,36 @@
+import os
+import threading
+
+import pytest
+
+
+def test_atomic_write(tmp_path):
+    from fogtools.util import atomic_write
+    f = tmp_path / "lentils.txt"
+    with atomic_write(f) as tmp:
+        assert tmp.parent == tmp_path
+        assert tmp.name == (f".lentils.txt.{os.getpid():d}-"
+                            f"{threading.get_ident():d}.tmp")
+        tmp.write_text("pea")
+        assert not f.exists()
+    assert f.read_text() == "pea"
+    with pytest.raises(ValueError):
+        with atomic_write(f, suffix=".txt") as tmp:
+            assert tmp.suffix == ".txt"
+            tmp.write_text("bean")
+            raise ValueError
+    assert f.read_text() == "pea"
+    assert [p.name for p in tmp_path.iterdir()] == ["lentils.txt"]
+    # other threads write to other temporary files
+    names = []
+
+    def write():
+        with atomic_write(f) as tmp:
+            names.append(tmp.name)
+            tmp.write_text("chickpea")
+    t = threading.Thread(target=write)
+    t.start()
+    t.join()
+    assert names[0] != (f".lentils.txt.{os.getpid():d}-"
+                        f"{threading.get_ident():d}.tmp")
+    assert f.read_text() == "chickpea"